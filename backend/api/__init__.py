@@ -82,6 +82,18 @@ def request_base_url():
     return "{}://{}".format(url.scheme, url.netloc)
 
 
+def report_file_response(report_cache, report_id, filename, content_type):
+    """ Returns response which sends the stored report by parts or None if the report isn't stored """
+    from utils import make_content_disposition
+
+    size, chunks = report_cache.open_report(report_id)
+    if not size:
+        return None
+    content_disposition = make_content_disposition(filename, request.environ.get('HTTP_USER_AGENT'))
+    return HTTPResponse(body=chunks, content_type=content_type,
+                        content_disposition=content_disposition, content_length=size)
+
+
 _registered = {}
 
 
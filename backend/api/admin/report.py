@@ -1,15 +1,13 @@
 import errors
 import json
 import logbook
-import bottle
 from model import autocommit, display, Customer
-from api import get, post, AdminApi
+from api import get, post, AdminApi, report_file_response
 from api.check_params import check_params
 from api.admin.role import TokenManager
 from api.cabinet.customer import DateHourBeforeNow
 from memdb.report_cache import ReportCache, ReportId, ReportTask
 from report import Report
-from utils import make_content_disposition
 from task.customer import report_file_generate
 from datetime import timedelta
 from api.validator import ActiveLocale, Choose, Bool
@@ -91,16 +89,16 @@ class ReportApi(AdminApi):
         report_task = ReportTask()
         report_id = ReportId(start, finish, report_type, report_format, locale)
 
-        data = report_cache.get_report(report_id)
-
-        if data:
-            if report_format == "json":
+        if report_format == "json":
+            data = report_cache.get_report(report_id)
+            if data:
                 return {"status": "completed",
                         "report": json.loads(data.decode("utf-8"))}
+        else:
             filename = Report.generate_file_name(report_type, start, finish, report_format)
-            content_disposition = make_content_disposition(filename, bottle.request.environ.get('HTTP_USER_AGENT'))
-            return bottle.HTTPResponse(body=data, content_type=Report.content_types[report_format],
-                                       content_disposition=content_disposition)
+            response = report_file_response(report_cache, report_id, filename, Report.content_types[report_format])
+            if response:
+                return response
 
         status = report_task.task_status(report_id)
         if not status:
@@ -215,15 +213,17 @@ class ReportApi(AdminApi):
         report_id = ReportId(None, None, report_type, report_format, locale)
 
         if not force:
-            data = report_cache.get_report(report_id)
-            if data:
-                if report_format == "json":
+            if report_format == "json":
+                data = report_cache.get_report(report_id)
+                if data:
                     return {"status": "completed",
                             "report": json.loads(data.decode("utf-8"))}
+            else:
                 filename = "%s.%s" % (report_type, report_format)
-                content_disposition = make_content_disposition(filename, bottle.request.environ.get('HTTP_USER_AGENT'))
-                return bottle.HTTPResponse(body=data, content_type=Report.content_types[report_format],
-                                           content_disposition=content_disposition)
+                response = report_file_response(report_cache, report_id, filename,
+                                                Report.content_types[report_format])
+                if response:
+                    return response
 
         status = report_task.task_status(report_id)
         if not status:
@@ -4,11 +4,12 @@ from model import display, autocommit
 from api import get, post, delete, put, AdminApi
 from api.check_params import check_params
 from api.validator import IntRange, String, TokenId, List, ModelId, Visibility, LocalizedName, JSONList, Bool, Date, \
-    SortFields
+    SortFields, PositiveInteger
 from api.admin.role import TokenAccount
-from model import Tariff, Service, TariffLocalization, TariffHistory
+from model import Tariff, Service, TariffLocalization, TariffHistory, Customer
 from api.admin.currency import ActiveCurrencies
-from utils.money import string_to_decimal
+from utils.money import string_to_decimal, decimal_to_string
+from task.customer import rerate_tariff_usage
 
 
 TariffIdExpand = ModelId(Tariff, errors.TariffNotFound)
@@ -347,6 +348,54 @@ class TariffApi(AdminApi):
 
         return {"tariff_info": display(tariff)}
 
+    @post('tariff/<tariff>/rerate/')
+    @check_params(
+        token=TokenAccount,
+        tariff=TariffIdExpand,
+        start=Date(),
+        finish=Date(),
+        customers=List(PositiveInteger()),
+        dry_run=Bool()
+    )
+    @autocommit
+    def rerate(self, tariff, start, finish, customers=None, dry_run=False):
+        """
+        Recalculates cost of the usage rated by the tariff in the period by current prices of the tariff
+        and corrects balances of customers.
+
+        :param Id tariff: Tariff Id.
+        :param Date start: Start of the period
+        :param Date finish: End of the period
+        :param List customers: Ids of customers to rerate. All customers are rerated by default.
+        :param Bool dry_run: Only calculate balance changes without changing anything.
+
+        Rerating is performed asynchronously. If dry_run is set, changes of customers withdraw are returned.
+
+        **Example**::
+
+            {
+                "status": "completed",
+                "rerating": [
+                    {"customer_id": 1, "tenant_id": "3d52e9f5d1b24b7e8b4a4a6f82a4c0e1",
+                     "currency": "RUB", "delta": "12.50"}
+                ]
+            }
+
+        """
+        if start >= finish:
+            raise errors.StartShouldBeEarlierFinish()
+
+        if not dry_run:
+            rerate_tariff_usage.delay(tariff.tariff_id, start, finish, customers)
+            return {"status": "started"}
+
+        if customers is not None:
+            customers = Customer.query.filter(Customer.customer_id.in_(customers)).all()
+        rerating = tariff.rerate_usage(start, finish, customers, dry_run=True)
+        for item in rerating:
+            item["delta"] = decimal_to_string(item["delta"])
+        return {"status": "completed", "rerating": rerating}
+
     @get('tariff/<tariff>/history/')
     @check_params(
         token=TokenId,
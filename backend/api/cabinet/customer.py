@@ -8,7 +8,8 @@ import errors
 from arrow import utcnow
 from urllib.parse import urljoin
 from api import (get, post, put, options, delete, CabinetApi, local_properties, request_base_url,
-                 API_ADMIN, API_ALL, API_CABINET, request_api_type, CABINET_TOKEN_NAME, enable_cors)
+                 API_ADMIN, API_ALL, API_CABINET, request_api_type, CABINET_TOKEN_NAME, enable_cors,
+                 report_file_response)
 from api.admin.currency import ActiveCurrencies
 from api.admin.role import TokenManager, TokenAccount
 from api.admin.tariff import TariffId, TariffIdExpand
@@ -1810,16 +1811,16 @@ class CustomerApi(CabinetApi):
 
         report_cache = ReportCache()
         report_id = CustomerReportId(customer.customer_id, start, finish, report_type, report_format, customer.locale)
-        data = report_cache.get_report(report_id)
-
-        if data:
-            if report_format == "json":
+        if report_format == "json":
+            data = report_cache.get_report(report_id)
+            if data:
                 return {"status": "completed",
                         "report": json.loads(data.decode("utf-8"))}
+        else:
             filename = Report.generate_file_name(customer.get_name(), start, finish, report_format, customer.locale)
-            content_disposition = make_content_disposition(filename, bottle.request.environ.get('HTTP_USER_AGENT'))
-            return bottle.HTTPResponse(body=data, content_type=Report.content_types[report_format],
-                                       content_disposition=content_disposition)
+            response = report_file_response(report_cache, report_id, filename, Report.content_types[report_format])
+            if response:
+                return response
 
         status = ReportTask().task_status(report_id)
         if not status:
@@ -489,7 +489,7 @@ class BaseTokenId:
             from api import local_properties
             self.LOCAL_PROPERTIES = local_properties
 
-        token = self.TOKEN.get(value)
+        token = self.TOKEN.get_cached(value)
 
         self.LOCAL_PROPERTIES.user_token = token
         return token
@@ -1,17 +1,28 @@
 from operator import attrgetter
+import calendar
 import conf
 import logbook
+import os
+import socket
+import time
 from datetime import datetime, timedelta
 from fitter.aggregation.timelabel import TimeLabel
-from fitter.aggregation.transformers import get_transformer
+from fitter.aggregation.scheduler import TenantScheduler
+from fitter.aggregation.sample_cache import SampleCache
+from fitter.aggregation.samples import SampleBatch, parse_timestamp, to_epoch
+from fitter.aggregation.transformers import get_transformer, ResourceStatistics
 from model.fitter.service_usage import ServiceUsage
 from utils import handle_exception, timed
 from model import db, Tenant, Customer
 from utils.periodic_task import PeriodicTask
+from bisect import bisect_left
 from collections import defaultdict
-from fitter.aggregation.constants import date_format, other_date_format
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from threading import Lock
 from os_interfaces import openstack_wrapper
-from memdb.mutex import RedisMutex
+from memdb.mutex import RedisMutex, RedisMutexBatch
+from memdb.work_queue import WorkQueue
 from memdb import MemDbModel
 from sqlalchemy.orm.exc import ObjectDeletedError
 
@@ -19,74 +30,417 @@ from sqlalchemy.orm.exc import ObjectDeletedError
 class TenantMutex(RedisMutex):
     prefix = "tenant_mutex:"
 
-    def __init__(self, tenant, ttl_ms=None):
-        name = "tenant_%s" % tenant.tenant_id
+    def __init__(self, tenant_id, ttl_ms=None):
+        self.tenant_id = tenant_id
+        name = "tenant_%s" % tenant_id
         super().__init__(name, MemDbModel.redis, ttl_ms=ttl_ms or conf.fitter.tenant_mutex_ttl * 1000)
 
 
+class TenantDelay(TenantMutex):
+    """ Prevents too often access to ceilometer for the tenant. It is held during delay after processing.
+    """
+    prefix = "tenant_delay:"
+
+
+class MeterSamples(object):
+    """
+    Samples of one meter for several hours sorted by timestamp.
+    Allows to split them to hourly windows without extra requests to ceilometer.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.timestamps = [sample.timestamp for sample in samples]
+        self._batch = None
+
+    def between(self, start, end):
+        """ Returns samples with start <= timestamp < end
+        """
+        return self.samples[bisect_left(self.timestamps, start):bisect_left(self.timestamps, end)]
+
+    @property
+    def batch(self):
+        """ Columnar view of the samples. It is built once for all hours of the window.
+        """
+        if self._batch is None:
+            self._batch = SampleBatch.from_samples(self.samples)
+        return self._batch
+
+    def batch_between(self, start, end):
+        """ Returns SampleBatch of samples with start <= timestamp < end
+        """
+        return self.batch.between(to_epoch(start), to_epoch(end))
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class MeterStatistics(object):
+    """
+    Statistics of one meter for several hours computed by ceilometer for every resource and hour.
+    Used instead of raw samples by transformers which need only max or sum of the meter.
+    """
+    HOUR = timedelta(seconds=TimeLabel.HOUR)
+
+    def __init__(self, statistics, metadata):
+        self.metadata = metadata
+        self.by_hour = defaultdict(dict)
+        for stat in statistics:
+            period_start = Collector.parse_timestamp(stat.period_start)
+            self.by_hour[period_start][stat.groupby["resource_id"]] = stat
+
+    def hour(self, time_label):
+        """ Returns ResourceStatistics for the hour. Usage of resource which exists in the previous (next) hour
+        is extended to the start (end) of the hour.
+        """
+        start, end = time_label.datetime_range()
+        previous_hour = self.by_hour.get(start - self.HOUR, {})
+        next_hour = self.by_hour.get(start + self.HOUR, {})
+        result = []
+        for resource_id, stat in self.by_hour.get(start, {}).items():
+            usage_start = start if resource_id in previous_hour else \
+                max(start, Collector.parse_timestamp(stat.duration_start))
+            usage_end = end if resource_id in next_hour else min(end, Collector.parse_timestamp(stat.duration_end))
+            result.append(ResourceStatistics(resource_id, stat.max, stat.sum, stat.unit, usage_start, usage_end,
+                                             self.metadata.get(resource_id) or {}))
+        return result
+
+    def __len__(self):
+        return sum(len(stats) for stats in self.by_hour.values())
+
+
+class ProjectWideSamples(object):
+    """
+    Samples of all projects for hours from start till end (exclusive), fetched by one query per meter
+    and grouped by project_id.
+    """
+
+    def __init__(self, start, end, samples_by_tenant):
+        self.start = start
+        self.end = end
+        self.samples_by_tenant = samples_by_tenant
+
+    def covers(self, start, end):
+        return self.start <= start and end <= self.end
+
+    def for_tenant(self, tenant_id):
+        tenant_samples = self.samples_by_tenant.get(tenant_id, {})
+        return {meter_name: tenant_samples.get(meter_name) or MeterSamples([])
+                for meter_name in conf.fitter.collection.meter_mappings}
+
+
+class PendingCharge(object):
+    """
+    Rated usage of several hours of the customer which is saved and charged at once: usages of all hours are written
+    by one bulk insert, and the cost of them less the cost of the replaced usage is applied by one charge per currency.
+    Crossing of the balance limits is checked by check_crossing() after the charge is committed, so the customer
+    isn't blocked or notified about a charge which is rolled back.
+    """
+
+    def __init__(self, customer):
+        self.customer = customer
+        self.usages = []
+        self.costs = {}  # time_label -> (usages as dicts, total cost)
+        self.crossing = None  # currency, balance before and after the last charge
+
+    def __len__(self):
+        return len(self.costs)
+
+    def add(self, time_label, usages, total_cost):
+        self.usages.extend(usages)
+        self.costs[time_label] = [usage.to_dict() for usage in usages], total_cost
+
+    def charge(self):
+        """ Saves usages and charges the customer.
+
+        :return: dict time_label -> (usages as dicts, total cost) of the charged hours
+        """
+        customer = self.customer
+        charged = self.costs
+        if not self.usages:
+            return charged
+
+        db.session.add(customer)
+        replaced = ServiceUsage.bulk_save(self.usages)
+        for currency, cost in replaced.items():
+            logbook.warning("Usage of {} for {} hours from {} is collected again. Previous cost {} {} is returned",
+                            customer, len(charged), min(charged), cost, currency)
+
+        currency = customer.tariff.currency.upper()
+        net_cost = sum(total_cost for _, total_cost in charged.values()) - replaced.pop(currency, 0)
+        if net_cost >= 0:
+            before, after = customer.withdraw(net_cost, currency, check_crossing=False)
+            self.crossing = currency, before, after
+        else:
+            replaced[currency] = -net_cost
+        # usage which was rated in other tariff currency is refunded only
+        for currency, cost in replaced.items():
+            account = customer.get_account(currency)
+            if account:
+                account.charge(-cost)
+
+        self.usages = []
+        self.costs = {}
+        return charged
+
+    def check_crossing(self):
+        crossing, self.crossing = self.crossing, None
+        if crossing:
+            self.customer.check_balance_crossing(*crossing)
+
+
 class Collector(PeriodicTask):
     def __init__(self):
         super().__init__(conf.fitter.fetch_interval)
         self.errors = 0
+        self._errors_lock = Lock()
         self.window_leading = timedelta(seconds=conf.fitter.window_leading)
         self.dawn_of_time = conf.fitter.dawn_of_time
+        self.project_wide_samples = None
+        self.queue = WorkQueue("tenants", "%s:%s" % (socket.gethostname(), os.getpid()))
+        self.coordinator = RedisMutex("fitter_coordinator", MemDbModel.redis,
+                                      ttl_ms=conf.fitter.fetch_interval * 2 * 1000)
+        self.scheduler = TenantScheduler()
+        self.sample_cache = SampleCache(conf.fitter.collection.sample_cache)
 
     def task(self):
-        res = self.run_usage_collection()
+        res = self.run_usage_collection(scheduler=self.scheduler)
         logbook.debug("usage: {}", res)
         db.session.remove()
+        if not conf.fitter.queue.enabled:
+            return self.scheduler.next_delay()
+
+    @staticmethod
+    def collected_before(end):
+        """ Tenants which were collected before this time have complete hours to collect """
+        return TimeLabel(end).datetime - timedelta(seconds=1)
 
     @handle_exception()
-    def run_usage_collection(self, end=None):
-        # Run usage collection on all tenants present in Keystone.
+    def run_usage_collection(self, end=None, scheduler=None):
+        # Run usage collection on all tenants present in Keystone which have complete hours to collect.
+        # The most behind tenants are processed first.
         db.session.close()
-        tenants = Tenant.all_active_tenants()
+        end = end or datetime.utcnow()
+        if conf.fitter.collection.project_wide_window:
+            self.project_wide_samples = self.fetch_project_wide_samples(end)
+
+        if conf.fitter.queue.enabled:
+            usage = self.run_queue_collection(end)
+        else:
+            tenants = Tenant.stale_tenants(self.collected_before(end))
+            if conf.fitter.workers > 1:
+                tenants = tenants.with_entities(Tenant.tenant_id, Tenant.last_collected).all()
+            else:
+                tenants = tenants.all()
+            if scheduler:
+                tenants = scheduler.due_tenants(tenants)
 
-        usage = {}
-        for tenant in tenants:
-            try:
-                tenant_id = tenant.tenant_id  # session can be closed during next call, so we should cache tenant_id
-            except ObjectDeletedError as e:
-                logbook.warning("Tenant {} was removed from db (probably during cleanup after test: ", tenant_id, e)
-
-            next_run_delay = None
-            with TenantMutex(tenant) as mutex:
-                if mutex:
-                    logbook.debug("Processing tenant: {}", tenant_id)
-                    tenant_usage = self.collect_usage(tenant, mutex, end)
-                    usage[tenant_id] = tenant_usage
-                    db.session.commit()
-
-                    next_run_delay = conf.fitter.min_tenant_interval if tenant_usage else conf.fitter.tenant_interval
-
-                    logbook.debug("Create mutex for tenant {} to prevent very often access to ceilometer. Delay: {}",
-                                  tenant, next_run_delay)
-            if next_run_delay and not conf.test:
-                mutex = TenantMutex(tenant)
-                mutex.acquire(ttl_ms=next_run_delay * 1000)
+            if conf.fitter.workers > 1:
+                usage = self.process_tenants_concurrently([tenant.tenant_id for tenant in tenants], end, scheduler)
+            else:
+                usage = {}
+                for offset, batch in self.lease_batches([tenant.tenant_id for tenant in tenants]):
+                    with batch:
+                        for tenant, mutex in zip(tenants[offset:], batch.mutexes):
+                            batch.keep_alive()
+                            tenant_id, tenant_usage = self.process_leased_tenant(tenant, mutex, batch, end)
+                            if tenant_usage is not None:
+                                usage[tenant_id] = tenant_usage
+                                if scheduler:
+                                    scheduler.processed(tenant_id, bool(tenant_usage))
 
         db.session.close()
+        self.project_wide_samples = None
 
+        self.sample_cache.log_stats()
         logbook.info("Usage collection run complete.")
         return usage
 
+    def run_queue_collection(self, end):
+        """ Distributed mode: the coordinator fitter pushes stale tenants to the queue and all fitters
+        (including the coordinator) process tenants pulled from the queue.
+        """
+        self.push_stale_tenants(end)
+        db.session.close()
+
+        if conf.fitter.workers == 1:
+            return self.pull_tenants(end)
+
+        usage = {}
+        with ThreadPoolExecutor(max_workers=conf.fitter.workers) as executor:
+            for worker_usage in executor.map(self._pull_tenants_in_thread, [end] * conf.fitter.workers):
+                usage.update(worker_usage or {})
+        return usage
+
+    def push_stale_tenants(self, end):
+        """ Pushes tenants which have complete hours to collect to the queue ordered by last_collected.
+        Only the fitter which holds coordinator mutex pushes them.
+
+        :return: number of new tenants in the queue
+        """
+        if not self.coordinator.acquire() or not self.coordinator.update_ttl():
+            return 0
+        tenants = Tenant.stale_tenants(self.collected_before(end)).with_entities(Tenant.tenant_id,
+                                                                                 Tenant.last_collected)
+        pushed = self.queue.push((tenant_id, calendar.timegm(last_collected.utctimetuple()))
+                                 for tenant_id, last_collected in tenants)
+        logbook.info("{} stale tenants are pushed to the queue. Queue size (pending, leased): {}",
+                     pushed, self.queue.size())
+        return pushed
+
+    def pull_tenants(self, end=None):
+        """ Processes tenants pulled from the queue by conf.fitter.queue.pull_size until the queue is empty.
+        Tenants are acked after processing, so tenants of crashed fitter are delivered again after visibility timeout.
+        """
+        usage = {}
+        visibility_timeout = conf.fitter.queue.visibility_timeout
+        while True:
+            tenant_ids = self.queue.pull(conf.fitter.queue.pull_size, visibility_timeout)
+            if not tenant_ids:
+                return usage
+            leased = time.time()
+            for i, tenant_id in enumerate(tenant_ids):
+                if time.time() - leased > visibility_timeout / 2:
+                    self.queue.extend(tenant_ids[i:], visibility_timeout)
+                    leased = time.time()
+                tenant = Tenant.get_by_id(tenant_id)
+                if tenant is None:
+                    logbook.warning("Tenant {} was removed from db before processing", tenant_id)
+                else:
+                    _, tenant_usage = self.process_tenant(tenant, end)
+                    if tenant_usage is not None:
+                        usage[tenant_id] = tenant_usage
+                self.queue.ack(tenant_id)
+
+    @handle_exception()
+    def _pull_tenants_in_thread(self, end=None):
+        try:
+            return self.pull_tenants(end)
+        finally:
+            db.session.remove()
+
+    @staticmethod
+    def lease_batches(tenant_ids):
+        """ Acquires mutexes of tenants by batches of conf.fitter.lease_batch_size tenants, one redis call per batch.
+        Tenants processed recently are skipped by their TenantDelay.
+        The next batch is acquired only when the previous one is released.
+
+        :return: iterator of offsets of batches in tenant_ids and batches
+        """
+        batch_size = conf.fitter.lease_batch_size
+        for offset in range(0, len(tenant_ids), batch_size):
+            tenant_ids_batch = tenant_ids[offset:offset + batch_size]
+            batch = RedisMutexBatch([TenantMutex(tenant_id) for tenant_id in tenant_ids_batch], MemDbModel.redis)
+            batch.acquire(guards=[TenantDelay(tenant_id) for tenant_id in tenant_ids_batch])
+            yield offset, batch
+
+    def process_leased_tenant(self, tenant, mutex, batch, end=None):
+        """ Processes the tenant by mutex acquired by the batch. The mutex is released right after processing,
+        so other fitters don't wait for the end of the batch.
+        If the mutex is held by other fitter, the tenant is skipped: it is processed by that fitter.
+        """
+        if mutex in batch.guarded:
+            logbook.debug("Tenant {} was processed recently", mutex.tenant_id)
+            return mutex.tenant_id, None
+        if not mutex.acquired:
+            logbook.debug("Tenant {} is processed by other fitter", mutex.tenant_id)
+            return mutex.tenant_id, None
+        try:
+            return self.process_tenant(tenant, end, mutex)
+        finally:
+            mutex.release()
+
+    def process_tenants_concurrently(self, tenant_ids, end=None, scheduler=None):
+        # Each worker thread uses its own scoped session, so only tenant ids are passed between threads
+        db.session.close()
+
+        usage = {}
+        with ThreadPoolExecutor(max_workers=conf.fitter.workers) as executor:
+            for _, batch in self.lease_batches(tenant_ids):
+                with batch:
+                    futures = [executor.submit(self._process_tenant_in_thread, mutex, batch, end)
+                               for mutex in batch.mutexes if mutex not in batch.guarded]
+                    for future in as_completed(futures):
+                        batch.keep_alive()
+                        result = future.result()
+                        if result is None:
+                            continue
+                        tenant_id, tenant_usage = result
+                        if tenant_usage is not None:
+                            usage[tenant_id] = tenant_usage
+                            if scheduler:
+                                scheduler.processed(tenant_id, bool(tenant_usage))
+        return usage
+
+    @handle_exception()
+    def _process_tenant_in_thread(self, mutex, batch, end=None):
+        try:
+            tenant = Tenant.get_by_id(mutex.tenant_id)
+            if tenant is None:
+                logbook.warning("Tenant {} was removed from db before processing", mutex.tenant_id)
+                return None
+            return self.process_leased_tenant(tenant, mutex, batch, end)
+        finally:
+            db.session.remove()
+
+    def process_tenant(self, tenant, end=None, mutex=None):
+        """ Collects usage of the tenant.
+
+        :param mutex: TenantMutex acquired by the caller. It is released by the caller too.
+        """
+        try:
+            tenant_id = tenant.tenant_id  # session can be closed during next call, so we should cache tenant_id
+        except ObjectDeletedError as e:
+            logbook.warning("Tenant was removed from db (probably during cleanup after test): {}", e)
+            return None, None
+
+        tenant_usage = None
+        leased = mutex is not None
+        if not leased:
+            if TenantDelay(tenant_id).locked():
+                logbook.debug("Tenant {} was processed recently", tenant_id)
+                return tenant_id, tenant_usage
+
+            # if the tenant is processed by other fitter, it is processed again as soon as the mutex is released
+            mutex = TenantMutex(tenant_id)
+            if not mutex.acquire(blocking=True, timeout=conf.fitter.tenant_mutex_wait):
+                return tenant_id, tenant_usage
+        try:
+            if not leased and TenantDelay(tenant_id).locked():
+                logbook.debug("Tenant {} was processed while waiting for mutex", tenant_id)
+                return tenant_id, tenant_usage
+
+            logbook.debug("Processing tenant: {}", tenant_id)
+            tenant_usage = self.collect_usage(tenant, mutex, end)
+            db.session.commit()
+
+            next_run_delay = conf.fitter.min_tenant_interval if tenant_usage else conf.fitter.tenant_interval
+            if next_run_delay and not conf.test:
+                logbook.debug("Create mutex for tenant {} to prevent very often access to ceilometer. Delay: {}",
+                              tenant, next_run_delay)
+                TenantDelay(tenant_id).acquire(ttl_ms=next_run_delay * 1000)
+        finally:
+            if not leased:
+                mutex.release()
+
+        return tenant_id, tenant_usage
+
     @staticmethod
     def filter_and_group(usage):
-        usage_by_resource = defaultdict(list)
+        """ Groups SampleBatch (or list of samples) by resource_id
+
+        :return: dict resource_id -> SampleBatch
+        """
         with timed("filter and group by resource"):
+            # the user can make their own samples, including those
+            # that would collide with what we care about for
+            # billing.
+            # if we have a list of trust sources configured, then
+            # discard everything not matching.
             trust_sources = set(conf.fitter.trust_sources)
-            for u in usage:
-                # the user can make their own samples, including those
-                # that would collide with what we care about for
-                # billing.
-                # if we have a list of trust sources configured, then
-                # discard everything not matching.
-                if trust_sources and u.source not in trust_sources:
-                    logbook.warning('ignoring untrusted usage sample from source `{}`', u['source'])
-                    continue
-
-                resource_id = u.resource_id
-                usage_by_resource[resource_id].append(u)
+            usage_by_resource, untrusted = SampleBatch.from_samples(usage).group_by_resource(trust_sources)
+            for source in set(untrusted):
+                logbook.warning('ignoring untrusted usage samples from source `{}`', source)
         return usage_by_resource
 
     def collect_usage(self, tenant, mutex, end=None):
@@ -105,31 +459,163 @@ class Collector(PeriodicTask):
             logbook.error("Customer for tenant {} not found", tenant)
             return usage
 
+        max_window = conf.fitter.collection.max_metric_limit
+        charge_hours = conf.fitter.collection.charge_hours
+        pending = PendingCharge(customer)
         while time_label < end_time_label:
+            window_end = min(TimeLabel(time_label.timestamp + max_window * TimeLabel.HOUR), end_time_label)
+            if self.project_wide_samples and time_label < self.project_wide_samples.start:
+                # hours before the project wide window are fetched for the tenant only
+                window_end = min(window_end, self.project_wide_samples.start)
             try:
-                usages = self._collect_usage(tenant, time_label, customer)
-                tenant.last_collected = time_label.datetime_range()[1]
-                if usages:
-                    db.session.add(customer)
-                    total_cost = customer.calculate_usage_cost(usages)
-                    customer.withdraw(total_cost)
-                    if not conf.test:
-                        db.session.commit()
-
-                    usage[time_label] = [usage.to_dict() for usage in usages], total_cost
+                samples = self.fetch_samples(tenant, time_label, window_end)
             except Exception:
-                self.errors += 1
-                import traceback
-
-                traceback.print_exc()
-                logbook.exception("Usage process failed for {} and {}", tenant, time_label)
-                db.session.rollback()
+                self._usage_failed(tenant, time_label, pending, usage)
                 return usage
 
-            time_label = time_label.next()
-            mutex.update_ttl()
+            while time_label < window_end:
+                try:
+                    usages = self._collect_usage(tenant, time_label, customer, samples)
+                    tenant.last_collected = time_label.datetime_range()[1]
+                    if usages:
+                        db.session.add(customer)
+                        pending.add(time_label, usages, customer.calculate_usage_cost(usages, add_to_session=False))
+                except Exception:
+                    self._usage_failed(tenant, time_label, pending, usage)
+                    return usage
+
+                if charge_hours and len(pending) >= charge_hours and not self.charge_pending(tenant, pending, usage):
+                    return usage
+
+                time_label = time_label.next()
+                if not mutex.update_ttl():
+                    # hours which are not charged yet are collected again by the owner of the mutex
+                    logbook.error("Mutex of tenant {} is lost. Collection is stopped at {}", tenant, time_label)
+                    if len(pending):
+                        db.session.rollback()
+                    return usage
+
+        self.charge_pending(tenant, pending, usage)
         return usage
 
+    def charge_pending(self, tenant, pending, usage):
+        """ Saves and charges pending hours and commits them together with last_collected of the tenant.
+
+        :return: False if charging failed
+        """
+        if not len(pending):
+            return True
+        first_hour = min(pending.costs)
+        try:
+            usage.update(pending.charge())
+            if not conf.test:
+                db.session.commit()
+        except Exception:
+            pending.crossing = None
+            self._usage_failed(tenant, first_hour)
+            return False
+
+        try:
+            pending.check_crossing()
+            if not conf.test:
+                db.session.commit()
+        except Exception:
+            # the charge is committed already, the exhausted balance is blocked by the next charge
+            self._usage_failed(tenant, first_hour)
+        return True
+
+    def _usage_failed(self, tenant, time_label, pending=None, usage=None):
+        with self._errors_lock:
+            self.errors += 1
+        import traceback
+
+        traceback.print_exc()
+        logbook.exception("Usage process failed for {} and {}", tenant, time_label)
+        db.session.rollback()
+        if pending is not None and len(pending):
+            # hours before the failed one are rated already, so they are charged instead of being collected again
+            tenant.last_collected = time_label.previous().datetime_range()[1]
+            self.charge_pending(tenant, pending, usage)
+
+    def fetch_samples(self, tenant, time_label, window_end):
+        """
+        Fetches samples of all meters for hours from time_label till window_end (exclusive)
+        by one query per meter.
+        """
+        project_wide_samples = self.project_wide_samples
+        if project_wide_samples and project_wide_samples.covers(time_label, window_end):
+            return project_wide_samples.for_tenant(tenant.tenant_id)
+
+        start, end = self._fetch_range(time_label, window_end)
+        samples = {}
+        resources = None
+        for meter_name, meter_info in conf.fitter.collection.meter_mappings.items():
+            if self.server_side_aggregation(meter_info):
+                if resources is None:
+                    resources = openstack_wrapper.openstack.get_tenant_resources(tenant.tenant_id)
+                samples[meter_name] = self.fetch_statistics(tenant, meter_name, time_label, window_end, resources)
+                continue
+            usage = self.sample_cache.get(tenant.tenant_id, meter_name, start, end,
+                                          partial(self.fetch_meter_samples, tenant.tenant_id, meter_name))
+            samples[meter_name] = MeterSamples(usage)
+        return samples
+
+    def fetch_meter_samples(self, tenant_id, meter_name, start, end):
+        usage = openstack_wrapper.openstack.get_tenant_usage(tenant_id, meter_name, start, end)
+        return self.sort_entries(usage)
+
+    def server_side_aggregation(self, meter_info):
+        """ Checks that max or sum of the meter can be computed by ceilometer instead of fetching raw samples.
+        Only one trusted source can be requested from ceilometer.
+        """
+        if not conf.fitter.collection.server_side_aggregation or len(conf.fitter.trust_sources) > 1:
+            return False
+        return bool(self.get_meter_transformer(meter_info).aggregate)
+
+    @staticmethod
+    def fetch_statistics(tenant, meter_name, time_label, window_end, resources):
+        """
+        Fetches hourly statistics of the meter per resource for hours from time_label till window_end (exclusive).
+        The previous and the next hours are requested too, to find resources which exist on bounds of the window.
+        """
+        start = time_label.datetime - MeterStatistics.HOUR
+        end = window_end.datetime + MeterStatistics.HOUR
+        source = conf.fitter.trust_sources[0] if conf.fitter.trust_sources else None
+        statistics = openstack_wrapper.openstack.get_tenant_statistics(tenant.tenant_id, meter_name, start, end,
+                                                                       TimeLabel.HOUR, source)
+        return MeterStatistics(statistics, resources)
+
+    @handle_exception()
+    def fetch_project_wide_samples(self, end):
+        """
+        Fetches samples of all projects for the last fitter.collection.project_wide_window hours
+        by one query per meter. Tenants which are not behind this window take their samples from here.
+        """
+        end_time_label = TimeLabel(end)
+        time_label = TimeLabel(end_time_label.timestamp - conf.fitter.collection.project_wide_window * TimeLabel.HOUR)
+        start, end = self._fetch_range(time_label, end_time_label)
+
+        samples = defaultdict(dict)
+        for meter_name in conf.fitter.collection.meter_mappings:
+            usage = openstack_wrapper.openstack.get_tenant_usage(None, meter_name, start, end)
+            usage_by_project = defaultdict(list)
+            for sample in usage:
+                usage_by_project[sample.project_id].append(sample)
+            for project_id, project_usage in usage_by_project.items():
+                samples[project_id][meter_name] = MeterSamples(self.sort_entries(project_usage))
+
+        logbook.info("Fetched project wide samples for {} projects from {} till {}",
+                     len(samples), time_label, end_time_label)
+        return ProjectWideSamples(time_label, end_time_label, samples)
+
+    def _fetch_range(self, time_label, window_end):
+        return (time_label.datetime - self.window_leading,
+                window_end.previous().datetime_range()[1] + self.window_leading)
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        return parse_timestamp(timestamp)
+
     @staticmethod
     def sort_entries(data):
         """
@@ -137,50 +623,51 @@ class Collector(PeriodicTask):
         and sort.
         """
         for entry in data:
-            timestamp = entry.timestamp
-            if isinstance(timestamp, datetime):
-                continue
-            try:
-                # noinspection PyTypeChecker
-                timestamp = datetime.strptime(timestamp, date_format)
-            except ValueError:
-                timestamp = datetime.strptime(timestamp, other_date_format)
-            entry.timestamp = timestamp
+            entry.timestamp = Collector.parse_timestamp(entry.timestamp)
         return sorted(data, key=attrgetter("timestamp"))
 
-    def _collect_usage(self, tenant, time_label, customer):
+    def _collect_usage(self, tenant, time_label, customer, samples=None):
         mappings = conf.fitter.collection.meter_mappings
+        if samples is None:
+            samples = self.fetch_samples(tenant, time_label, time_label.next())
 
         processed_usage = []
         for meter_name, meter_info in sorted(mappings.items()):
-            start, end = time_label.datetime_range()
-            usage = openstack_wrapper.openstack.get_tenant_usage(tenant.tenant_id,
-                                                                 meter_name,
-                                                                 start - self.window_leading,
-                                                                 end + self.window_leading)
-            usage = self.sort_entries(usage)
-
-            if not usage:
-                continue
-
             if 'service' in meter_info:
                 service = meter_info['service']
             else:
                 service = meter_name
 
+            meter_samples = samples[meter_name]
+            if isinstance(meter_samples, MeterStatistics):
+                statistics = meter_samples.hour(time_label)
+                processed_usage.extend(self.transform_statistics(tenant, statistics, service, meter_info,
+                                                                 time_label, customer))
+                continue
+
+            start, end = time_label.datetime_range()
+            usage = meter_samples.batch_between(start - self.window_leading, end + self.window_leading)
+
+            if not usage:
+                continue
+
             processed_usage.extend(self.transform_usage(tenant, usage, service, meter_info, time_label, customer))
 
         return processed_usage
 
-    def transform_usage(self, tenant, usage, service, meter_info, time_label, customer):
-        transformed_usage = []
-        usage_by_resource = self.filter_and_group(usage)
+    @staticmethod
+    def get_meter_transformer(meter_info):
         transformer_name = meter_info['transformer']
         transformer_args = {}
         if isinstance(transformer_name, dict):
             assert len(transformer_name) == 1
             transformer_name, transformer_args = next(iter(transformer_name.items()))
-        transformer = get_transformer(transformer_name, **transformer_args)
+        return get_transformer(transformer_name, **transformer_args)
+
+    def transform_usage(self, tenant, usage, service, meter_info, time_label, customer):
+        transformed_usage = []
+        usage_by_resource = self.filter_and_group(usage)
+        transformer = self.get_meter_transformer(meter_info)
 
         for resource_id, entries in usage_by_resource.items():
             # apply the transformer.
@@ -189,13 +676,31 @@ class Collector(PeriodicTask):
             except Exception as e:
                 logbook.warning("Error {} during processing usage for tenant {}, service: {}, "
                                 "meter_info: {}, time_label: {}, resource_id: {}: {}",
-                                e, tenant, service, meter_info, time_label, resource_id, entries)
+                                e, tenant, service, meter_info, time_label, resource_id, entries.samples)
                 raise
 
-            for su in transformed:
-                service_usage = ServiceUsage(tenant.tenant_id, su.service_id, time_label, resource_id,
-                                             customer.tariff, su.volume, su.start, su.end,
-                                             resource_name=su.resource_name)
-                db.session.add(service_usage)
-                transformed_usage.append(service_usage)
+            transformed_usage.extend(self.service_usage(tenant, resource_id, transformed, time_label, customer))
         return transformed_usage
+
+    def transform_statistics(self, tenant, statistics, service, meter_info, time_label, customer):
+        transformed_usage = []
+        transformer = self.get_meter_transformer(meter_info)
+
+        for resource_statistics in statistics:
+            try:
+                transformed = transformer.transform_statistics(service, resource_statistics, time_label)
+            except Exception as e:
+                logbook.warning("Error {} during processing statistics for tenant {}, service: {}, "
+                                "meter_info: {}, time_label: {}: {}",
+                                e, tenant, service, meter_info, time_label, resource_statistics)
+                raise
+
+            transformed_usage.extend(self.service_usage(tenant, resource_statistics.resource_id, transformed,
+                                                        time_label, customer))
+        return transformed_usage
+
+    @staticmethod
+    def service_usage(tenant, resource_id, transformed, time_label, customer):
+        return [ServiceUsage(tenant.tenant_id, su.service_id, time_label, resource_id, customer.tariff,
+                             su.volume, su.start, su.end, resource_name=su.resource_name)
+                for su in transformed]
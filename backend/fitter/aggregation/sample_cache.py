@@ -0,0 +1,94 @@
+import logbook
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+
+
+CachedSamples = namedtuple("CachedSamples", ["start", "end", "samples", "timestamps"])
+
+
+class SampleCache(object):
+    """
+    Keeps the tail of the last fetched samples of every tenant and meter.
+
+    Fetch windows of adjacent hours overlap by the leading window, so the next fetch requests from ceilometer only
+    the span after the cached tail. Samples newer than now - settle_time are not cached, because ceilometer can
+    still receive samples for this period.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._cache = OrderedDict()  # (tenant_id, meter_name) -> CachedSamples
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.cached_samples = 0
+        self.fetched_samples = 0
+        self.saved_seconds = 0
+
+    def get(self, tenant_id, meter_name, start, end, fetch):
+        """ Returns samples of the meter with start <= timestamp < end sorted by timestamp.
+
+        :param fetch: function (start, end) which returns sorted samples from ceilometer
+        """
+        if not self.config.enabled:
+            return fetch(start, end)
+
+        key = (tenant_id, meter_name)
+        with self._lock:
+            cached = self._cache.get(key)
+
+        if cached and cached.start <= start < cached.end:
+            fetch_start = max(cached.end, start)
+            samples = cached.samples[bisect_left(cached.timestamps, start):bisect_left(cached.timestamps, end)]
+            cached_count = len(samples)
+            if fetch_start < end:
+                samples = samples + fetch(fetch_start, end)
+            self._count(hit=True, cached=cached_count, fetched=len(samples) - cached_count,
+                        saved=(min(cached.end, end) - start).total_seconds())
+        else:
+            samples = fetch(start, end)
+            self._count(hit=False, fetched=len(samples))
+
+        self._store(key, start, end, samples)
+        return samples
+
+    def _store(self, key, start, end, samples):
+        end = min(end, datetime.utcnow() - timedelta(seconds=self.config.settle_time))
+        tail_start = max(start, end - timedelta(seconds=self.config.tail))
+        if tail_start >= end:
+            return
+        timestamps = [sample.timestamp for sample in samples]
+        left, right = bisect_left(timestamps, tail_start), bisect_left(timestamps, end)
+        cached = CachedSamples(tail_start, end, samples[left:right], timestamps[left:right])
+        with self._lock:
+            self._cache[key] = cached
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.config.max_entries:
+                self._cache.popitem(last=False)
+
+    def _count(self, hit, fetched=0, cached=0, saved=0):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.fetched_samples += fetched
+            self.cached_samples += cached
+            self.saved_seconds += saved
+
+    def stats(self):
+        requests = self.hits + self.misses
+        samples = self.cached_samples + self.fetched_samples
+        return {"entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+                "cached_samples": self.cached_samples,
+                "fetched_samples": self.fetched_samples,
+                "cached_samples_rate": round(self.cached_samples / samples, 3) if samples else None,
+                "saved_seconds": self.saved_seconds}
+
+    def log_stats(self):
+        logbook.info("Sample cache stats: {}", self.stats())
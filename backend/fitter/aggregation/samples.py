@@ -0,0 +1,126 @@
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+from fitter.aggregation.constants import date_format, other_date_format
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_timestamp(value):
+    """ Parses ceilometer timestamp 'YYYY-MM-DDTHH:MM:SS[.ffffff][+00:00]' (UTC) to naive datetime.
+    Timestamps in other formats are parsed by strptime.
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        if value[4] != "-" or value[10] not in "T " or value[13] != ":":
+            raise ValueError(value)
+        microsecond = 0
+        if len(value) > 20 and value[19] == ".":
+            fraction = value[20:26]
+            if not fraction.isdigit():
+                raise ValueError(value)
+            microsecond = int(fraction.ljust(6, "0"))
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]), microsecond)
+    except (ValueError, IndexError):
+        try:
+            # noinspection PyTypeChecker
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            return datetime.strptime(value, other_date_format)
+
+
+def to_epoch(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def from_epoch(timestamp):
+    return EPOCH + timedelta(seconds=timestamp)
+
+
+def get_counter_volume(sample):
+    if hasattr(sample, "counter_volume"):
+        return sample.counter_volume or 0
+    else:
+        return sample.volume or 0
+
+
+def get_metadata(sample):
+    return getattr(sample, "metadata", {})
+
+
+def get_counter_unit(sample):
+    if hasattr(sample, "counter_unit"):
+        return sample.counter_unit
+    else:
+        return sample.unit
+
+
+class SampleBatch(object):
+    """
+    Columnar representation of samples of one meter sorted by timestamp: parallel lists of resource ids,
+    epoch timestamps, volumes and sources. Timestamps and volumes are extracted from samples once, and batches of
+    hours and resources are built by slicing of the lists. Samples are kept for access to metadata and unit only.
+    """
+    __slots__ = ("samples", "resource_ids", "timestamps", "volumes", "sources")
+
+    def __init__(self, samples, resource_ids, timestamps, volumes, sources):
+        self.samples = samples
+        self.resource_ids = resource_ids
+        self.timestamps = timestamps
+        self.volumes = volumes
+        self.sources = sources
+
+    @classmethod
+    def from_samples(cls, samples):
+        """ Builds batch from samples sorted by timestamp """
+        if isinstance(samples, SampleBatch):
+            return samples
+        return cls(samples,
+                   [getattr(sample, "resource_id", None) for sample in samples],
+                   [to_epoch(parse_timestamp(sample.timestamp)) for sample in samples],
+                   [get_counter_volume(sample) for sample in samples],
+                   [getattr(sample, "source", None) for sample in samples])
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def slice(self, left, right):
+        return SampleBatch(self.samples[left:right], self.resource_ids[left:right], self.timestamps[left:right],
+                           self.volumes[left:right], self.sources[left:right])
+
+    def take(self, indexes):
+        return SampleBatch([self.samples[i] for i in indexes], [self.resource_ids[i] for i in indexes],
+                           [self.timestamps[i] for i in indexes], [self.volumes[i] for i in indexes],
+                           [self.sources[i] for i in indexes])
+
+    def between(self, start, end):
+        """ Returns samples with start <= timestamp < end (epoch seconds)
+        """
+        return self.slice(bisect_left(self.timestamps, start), bisect_left(self.timestamps, end))
+
+    def group_by_resource(self, trust_sources=None):
+        """ Splits the batch by resources. Samples of untrusted sources are skipped.
+
+        :return: dict resource_id -> SampleBatch, list of untrusted sources
+        """
+        indexes = defaultdict(list)
+        untrusted = []
+        for i, (resource_id, source) in enumerate(zip(self.resource_ids, self.sources)):
+            if trust_sources and source not in trust_sources:
+                untrusted.append(source)
+                continue
+            indexes[resource_id].append(i)
+        return {resource_id: self.take(resource_indexes) for resource_id, resource_indexes in indexes.items()}, \
+            untrusted
+
+    def datetime(self, index):
+        return from_epoch(self.timestamps[index])
+
+    def metadata(self, index):
+        return get_metadata(self.samples[index])
+
+    def unit(self, index):
+        return get_counter_unit(self.samples[index])
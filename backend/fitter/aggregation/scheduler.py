@@ -0,0 +1,73 @@
+import conf
+import logbook
+import random
+import time
+from fitter.aggregation.timelabel import TimeLabel
+
+
+class TenantScheduler(object):
+    """
+    Chooses tenants for the next collection run and time of the run.
+
+    Stale tenants are served in order of their collection lag (the oldest last_collected first).
+    Tenant without usage is polled less often: its poll interval is doubled from fitter.min_tenant_interval
+    up to fitter.tenant_interval and is reset when usage appears.
+    Number of tenants in one run can be limited by fitter.scheduler.max_tenants_per_run to keep load of ceilometer
+    fixed; the rest is collected by the next run which starts without delay.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or conf.fitter.scheduler
+        self._due = {}  # tenant_id -> time when the tenant can be polled again
+        self._intervals = {}  # tenant_id -> current poll interval
+        self._next_due = None
+        self._backlog = False
+
+    def due_tenants(self, tenants, now=None):
+        """ Filters tenants which can be polled now
+
+        :param tenants: stale tenants (with tenant_id and last_collected) ordered by last_collected
+        :return: list of due tenants, the most behind first
+        """
+        now = now or time.time()
+        limit = self.config.max_tenants_per_run
+        due = []
+        self._next_due = None
+        self._backlog = False
+        for tenant in tenants:
+            due_time = self._due.get(tenant.tenant_id, 0)
+            if due_time > now:
+                self._next_due = min(self._next_due or due_time, due_time)
+            elif limit and len(due) >= limit:
+                self._backlog = True
+            else:
+                due.append(tenant)
+        logbook.debug("{} tenants are due. Backlog: {}", len(due), self._backlog)
+        return due
+
+    def processed(self, tenant_id, has_usage, now=None):
+        now = now or time.time()
+        if has_usage:
+            interval = conf.fitter.min_tenant_interval
+        else:
+            interval = min(self._intervals.get(tenant_id, conf.fitter.min_tenant_interval / 2) * 2,
+                           conf.fitter.tenant_interval)
+        self._intervals[tenant_id] = interval
+        self._due[tenant_id] = now + self._jitter(interval)
+
+    def next_delay(self, now=None):
+        """ Returns seconds till the next run: it starts when the earliest stale tenant is due or when the current
+        hour is completed, but not later than fitter.fetch_interval.
+        """
+        now = now or time.time()
+        if self._backlog:
+            return self.config.min_sleep
+
+        wake_up = TimeLabel(now).next().timestamp
+        if self._next_due:
+            wake_up = min(wake_up, self._next_due)
+        delay = min(max(wake_up - now, self.config.min_sleep), conf.fitter.fetch_interval)
+        return self._jitter(delay)
+
+    def _jitter(self, seconds):
+        return seconds * (1 + random.uniform(-self.config.jitter, self.config.jitter))
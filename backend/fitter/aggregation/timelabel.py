@@ -16,6 +16,7 @@ class TimeLabel(object):
     min_label = "2000010100"
     label_length = len(min_label)
     day_label_length = 4 + 2 + 2
+    month_label_length = 4 + 2
     HOUR = 3600
 
     def __init__(self, timestamp, _label=None):
@@ -48,6 +49,13 @@ class TimeLabel(object):
         t = calendar.timegm(t)
         return TimeLabel(t, _label=time_label)
 
+    @staticmethod
+    def from_label(time_label):
+        """ Fast version of from_str for labels read from database """
+        t = calendar.timegm((int(time_label[0:4]), int(time_label[4:6]), int(time_label[6:8]),
+                             int(time_label[8:10]), 0, 0))
+        return TimeLabel(t, _label=time_label)
+
     def __str__(self):
         return self.label
 
@@ -5,6 +5,7 @@ import errors
 from collections import namedtuple
 from fitter.aggregation import constants
 from fitter.aggregation.helpers import convert_to
+from fitter.aggregation.samples import SampleBatch, from_epoch, get_metadata
 from model import Flavor, Service, autocommit
 from os_interfaces.openstack_wrapper import openstack
 from kids.cache import cache
@@ -12,23 +13,10 @@ from kids.cache import cache
 
 Usage = namedtuple('Usage', ['service_id', 'volume', 'resource_name', 'start', 'end'])
 
-
-def get_counter_volume(sample):
-    if hasattr(sample, "counter_volume"):
-        return sample.counter_volume or 0
-    else:
-        return sample.volume or 0
-
-
-def get_metadata(sample):
-    return getattr(sample, "metadata", {})
-
-
-def get_counter_unit(sample):
-    if hasattr(sample, "counter_unit"):
-        return sample.counter_unit
-    else:
-        return sample.unit
+# Statistics of one resource for one hour computed by ceilometer.
+# start and end are bounds of the resource usage within the hour.
+ResourceStatistics = namedtuple('ResourceStatistics', ['resource_id', 'max', 'sum', 'unit', 'start', 'end',
+                                                       'metadata'])
 
 
 def get_flavor(sample):
@@ -54,33 +42,47 @@ def handle_unknown_flavor(flavor_name):
 
 
 class Transformer(object):
+    # ceilometer aggregate used by transform_statistics. Transformers without it need raw samples.
+    aggregate = None
 
     def __init__(self, name_field="name"):
         self.name_field = name_field
 
     def transform_usage(self, name, data, time_label):
+        """ Transforms samples of one resource sorted by timestamp.
+
+        :param data: SampleBatch or list of samples
+        """
+        return self._transform_usage(name, SampleBatch.from_samples(data), time_label)
+
+    def _transform_usage(self, name, data, time_label):
+        raise NotImplementedError()
+
+    def transform_statistics(self, name, statistics, time_label):
+        """ Transforms ResourceStatistics of one resource for the hour instead of raw samples """
         raise NotImplementedError()
 
     @staticmethod
     def filter_by_timelabel(data, time_label):
-        start, end = time_label.datetime_range()
-        return (entry for entry in data if start <= entry.timestamp < end)
+        start, end = time_label.timestamp_range()
+        return data.between(start, end)
 
     def max_volume(self, data, time_label):
-        max_event = max(self.filter_by_timelabel(data, time_label), default=None, key=get_counter_volume)
-        if max_event is not None:
-            return get_counter_volume(max_event)
-        return None
+        return max(self.filter_by_timelabel(data, time_label).volumes, default=None)
 
     @staticmethod
     def time_range(data, time_label):
         start, end = time_label.datetime_range()
-        return max(start, data[0].timestamp), min(end, data[-1].timestamp)
+        return max(start, data.datetime(0)), min(end, data.datetime(-1))
 
     def get_name(self, data):
-        if not data or not self.name_field:
+        if not data:
+            return None
+        return self.name_from_metadata(data.metadata(-1))
+
+    def name_from_metadata(self, metadata):
+        if not self.name_field or not metadata:
             return None
-        metadata = get_metadata(data[-1])
         return metadata.get(self.name_field)
 
 
@@ -90,14 +92,14 @@ class Uptime(Transformer):
     which is broken apart into flavor at point in time.
     """
 
-    def transform_usage(self, name, data, time_label):
+    def _transform_usage(self, name, data, time_label):
         # get tracked states from config
         tracked = conf.fitter.transformers.uptime.tracked_states
         tracked_states = {constants.states[state] for state in tracked}
 
         used_by_flower = {}
 
-        start, end = time_label.datetime_range()
+        start, end = time_label.timestamp_range()
 
         if not data:
             # there was no data for this period.
@@ -119,22 +121,22 @@ class Uptime(Transformer):
                 min_max_ts = used_by_flower[previous_flavor]
                 used_by_flower[previous_flavor] = min_max_ts[0], ts
 
-        for val in data:
-            if get_counter_volume(val) in tracked_states:
-                flavor_name = get_flavor(val)
-                _add_usage(flavor_name, val.timestamp, previous_flavor)
+        for i, (timestamp, volume) in enumerate(zip(data.timestamps, data.volumes)):
+            if volume in tracked_states:
+                flavor_name = get_flavor(data.samples[i])
+                _add_usage(flavor_name, timestamp, previous_flavor)
                 previous_flavor = flavor_name
             else:
                 if previous_flavor:
-                    ts = min(end, max(start, val.timestamp))
+                    ts = min(end, max(start, timestamp))
                     min_max_ts = used_by_flower[previous_flavor]
                     used_by_flower[previous_flavor] = min_max_ts[0], ts
                     previous_flavor = None
 
         # extend the last state we know about, to the end of the window,
         # if we saw any actual uptime.
-        if get_counter_volume(data[-1]) in tracked_states and data[-1].timestamp > start:
-            _add_usage(get_flavor(data[-1]), end, previous_flavor)
+        if data.volumes[-1] in tracked_states and data.timestamps[-1] > start:
+            _add_usage(get_flavor(data.samples[-1]), end, previous_flavor)
 
         # map the flavors to names on the way out
         result = []
@@ -149,7 +151,7 @@ class Uptime(Transformer):
                                   flavor_name)
                     flavor_id = handle_unknown_flavor(flavor_name)
 
-                result.append(Usage(flavor_id, 1, resource_name, usage_start, usage_end))
+                result.append(Usage(flavor_id, 1, resource_name, from_epoch(usage_start), from_epoch(usage_end)))
         return result
 
 
@@ -161,7 +163,7 @@ class FromImage(Transformer):
     This relies heavily on instance metadata.
     """
 
-    def transform_usage(self, name, data, time_label):
+    def _transform_usage(self, name, data, time_label):
         from_image = conf.fitter.transformers.from_image
         checks = from_image.md_keys
         none_values = from_image.none_values
@@ -170,7 +172,7 @@ class FromImage(Transformer):
         resource_name = self.get_name(data)
 
         size = 0
-        for entry in self.filter_by_timelabel(data, time_label):
+        for entry in self.filter_by_timelabel(data, time_label).samples:
             metadata = get_metadata(entry)
             for source in checks:
                 if metadata.get(source, object()) in none_values:
@@ -195,14 +197,19 @@ class GaugeMax(Transformer):
     If the raw unit is 'gigabytes', then the transformed unit is
     'gigabyte-hours'.
     """
+    aggregate = "max"
 
-    def transform_usage(self, name, data, time_label):
+    def _transform_usage(self, name, data, time_label):
         max_vol = self.max_volume(data, time_label)
         if max_vol is not None:
             return [Usage(name, max_vol, self.get_name(data), *self.time_range(data, time_label))]
         else:
             return []
 
+    def transform_statistics(self, name, statistics, time_label):
+        return [Usage(name, statistics.max, self.name_from_metadata(statistics.metadata),
+                      statistics.start, statistics.end)]
+
 
 class StorageMax(Transformer):
     """
@@ -211,6 +218,7 @@ class StorageMax(Transformer):
     default service name.
     """
     UPDATE_INTERVAL = 5 * 60
+    aggregate = "max"
 
     def __init__(self, name_field=None, volume_types=None):
         super().__init__(name_field)
@@ -240,36 +248,50 @@ class StorageMax(Transformer):
 
         return volume_type
 
-    def transform_usage(self, name, data, time_label):
+    def _transform_usage(self, name, data, time_label):
         max_vol = self.max_volume(data, time_label)
         if max_vol is None:
             return []
 
-        unit = get_counter_unit(data[-1])
+        return [self._usage(name, max_vol, data.unit(-1), data.metadata(-1),
+                            *self.time_range(data, time_label))]
+
+    def transform_statistics(self, name, statistics, time_label):
+        return [self._usage(name, statistics.max, statistics.unit, statistics.metadata,
+                            statistics.start, statistics.end)]
+
+    def _usage(self, name, max_vol, unit, metadata, start, end):
         max_vol = convert_to(max_vol, unit, 'B')
-        resource_name = self.get_name(data)
+        resource_name = self.name_from_metadata(metadata)
 
-        metadata = get_metadata(data[-1])
         service = name
-        if "volume_type" in metadata:
+        if metadata and "volume_type" in metadata:
             volume_type = self.volume_type(metadata['volume_type'])
             if volume_type:
                 service = self.volume_types.get(volume_type, service)
 
-        return [Usage(service, max_vol, resource_name, *self.time_range(data, time_label))]
+        return Usage(service, max_vol, resource_name, start, end)
 
 
 class GaugeSum(Transformer):
     """
     Transformer for sum-integration of a gauge value for given period.
     """
-    def transform_usage(self, name, data, time_label):
-        total = sum(get_counter_volume(entry) for entry in self.filter_by_timelabel(data, time_label))
+    aggregate = "sum"
+
+    def _transform_usage(self, name, data, time_label):
+        total = sum(self.filter_by_timelabel(data, time_label).volumes)
         if total:
-            return [Usage(name, total, self.get_name(data), data[0].timestamp, data[-1].timestamp)]
+            return [Usage(name, total, self.get_name(data), data.datetime(0), data.datetime(-1))]
         else:
             return []
 
+    def transform_statistics(self, name, statistics, time_label):
+        if statistics.sum:
+            return [Usage(name, statistics.sum, self.name_from_metadata(statistics.metadata),
+                          statistics.start, statistics.end)]
+        return []
+
 
 class GaugeNetworkService(Transformer):
     """Transformer for Neutron network service, such as LBaaS, VPNaaS,
@@ -278,15 +300,14 @@ class GaugeNetworkService(Transformer):
 
     STATE_ACTIVE = 1
 
-    def transform_usage(self, name, data, time_label):
+    def _transform_usage(self, name, data, time_label):
         # The network service pollster of Ceilometer is using
         # status as the volume(see https://github.com/openstack/ceilometer/
         # blob/master/ceilometer/network/services/vpnaas.py#L55), so we have
         # to check the volume to make sure only the active service is
         # charged(0=inactive, 1=active).
 
-        active = any(get_counter_volume(entry) == self.STATE_ACTIVE
-                     for entry in self.filter_by_timelabel(data, time_label))
+        active = self.STATE_ACTIVE in self.filter_by_timelabel(data, time_label).volumes
         if active:
             return [Usage(name, active, self.get_name(data), *self.time_range(data, time_label))]
         else:
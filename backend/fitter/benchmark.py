@@ -0,0 +1,170 @@
+"""
+Benchmark of the fitter collector against local ceilometer stand-in.
+
+Tenants of the fleet are created in the configured database (it should be a local one), their last_collected is
+reset to the start of the fleet and the collector processes all hours of the fleet by one run.
+"""
+import conf
+import json
+import logbook
+import resource
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from functools import wraps
+from threading import Lock
+
+
+class PhaseTimer(object):
+    """ Measures latency of methods of the collector and the models they call
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self._lock = Lock()
+        self._wrapped = []
+
+    def wrap(self, owner, name, phase):
+        """ Replaces the method of the class or of the instance by the timed one """
+        if isinstance(owner, type):
+            original = vars(owner)[name]
+            if isinstance(original, (classmethod, staticmethod)):
+                setattr(owner, name, type(original)(self._timed(original.__func__, phase)))
+            else:
+                setattr(owner, name, self._timed(original, phase))
+        else:
+            original = None
+            setattr(owner, name, self._timed(getattr(owner, name), phase))
+        self._wrapped.append((owner, name, original))
+
+    def _timed(self, method, phase):
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            started = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.time() - started
+                with self._lock:
+                    self.latencies[phase].append(elapsed)
+        return timed_method
+
+    def restore(self):
+        for owner, name, original in reversed(self._wrapped):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self._wrapped = []
+
+    @staticmethod
+    def _percentile(values, percent):
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    def report(self):
+        result = {}
+        for phase, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            result[phase] = {"count": len(latencies),
+                             "total": round(sum(latencies), 3),
+                             "mean": round(sum(latencies) / len(latencies), 6),
+                             "p50": round(self._percentile(latencies, 50), 6),
+                             "p95": round(self._percentile(latencies, 95), 6),
+                             "max": round(latencies[-1], 6)}
+        return result
+
+
+class FitterBenchmark(object):
+    def __init__(self, standin, tenant_ids, start, hours, workers=None):
+        self.standin = standin
+        self.tenant_ids = tenant_ids
+        self.start = start
+        self.end = start + timedelta(hours=hours)
+        self.workers = workers or conf.fitter.workers
+
+    def prepare(self):
+        """ Creates customers of missing tenants and resets collection of all tenants of the fleet
+        """
+        from model import db, Tenant, Customer, ServiceUsage, ServiceUsageDay, ServiceUsageMonth
+
+        existing = set()
+        for offset in range(0, len(self.tenant_ids), 1000):
+            chunk = self.tenant_ids[offset:offset + 1000]
+            existing.update(tenant_id for tenant_id, in
+                            Tenant.query.filter(Tenant.tenant_id.in_(chunk)).with_entities(Tenant.tenant_id))
+            for model in (ServiceUsage, ServiceUsageDay, ServiceUsageMonth):
+                model.query.filter(model.tenant_id.in_(chunk)).delete(synchronize_session=False)
+            Tenant.query.filter(Tenant.tenant_id.in_(chunk)).update({"last_collected": self.start, "deleted": None},
+                                                                    synchronize_session=False)
+        db.session.commit()
+
+        missing = [tenant_id for tenant_id in self.tenant_ids if tenant_id not in existing]
+        logbook.info("Creating {} customers for benchmark tenants", len(missing))
+        for tenant_id in missing:
+            customer = Customer.new_customer("%s@benchmark.local" % tenant_id, None, None)
+            customer.email_confirmed = True
+            customer.modify_balance(Decimal(10 ** 9), customer.tariff.currency, None, "Benchmark balance")
+            tenant = Tenant.create(tenant_id, tenant_id, self.start)
+            customer.os_tenant_id = tenant.tenant_id
+            db.session.commit()
+
+    def run(self):
+        from model import db, Customer, ServiceUsage
+        from os_interfaces.openstack_wrapper import openstack
+        from fitter.aggregation.collector import Collector
+
+        collector = Collector()
+        timer = PhaseTimer()
+        timer.wrap(collector, "fetch_samples", "fetch")
+        timer.wrap(collector, "_collect_usage", "transform")
+        timer.wrap(collector, "process_leased_tenant", "tenant")
+        timer.wrap(ServiceUsage, "bulk_save", "save")
+        timer.wrap(Customer, "calculate_usage_cost", "cost")
+        timer.wrap(self.standin, "get_tenant_usage", "ceilometer")
+        workers = conf.fitter.workers
+        conf.fitter.workers = self.workers
+        try:
+            with self.standin.installed(openstack):
+                started = time.time()
+                usage = collector.run_usage_collection(self.end)
+                elapsed = time.time() - started
+        finally:
+            conf.fitter.workers = workers
+            timer.restore()
+            db.session.remove()
+
+        tenants = len(usage or {})
+        return {"tenants": tenants,
+                "hours": int((self.end - self.start).total_seconds() // 3600),
+                "samples": self.standin.served_samples,
+                "seconds": round(elapsed, 3),
+                "samples_per_second": round(self.standin.served_samples / elapsed, 1) if elapsed else None,
+                "tenants_per_second": round(tenants / elapsed, 3) if elapsed else None,
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "phases": timer.report()}
+
+
+def compare(result, baseline, tolerance):
+    """ Returns list of regressions of throughput compared to baseline result
+    """
+    regressions = []
+    for key in ("samples_per_second", "tenants_per_second"):
+        if baseline.get(key) and result.get(key) is not None and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append("%s: %s < %s" % (key, result[key], baseline[key]))
+    return regressions
+
+
+def print_result(result):
+    for key, value in result.items():
+        if key != "phases":
+            print("%-20s %s" % (key, value))
+    print("%-20s %8s %10s %10s %10s %10s" % ("phase", "count", "total", "mean", "p95", "max"))
+    for phase, stats in sorted(result["phases"].items()):
+        print("%-20s %8s %10.3f %10.6f %10.6f %10.6f" % (phase, stats["count"], stats["total"], stats["mean"],
+                                                        stats["p95"], stats["max"]))
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,261 @@
+"""
+Local stand-in of ceilometer for benchmarks of the fitter.
+
+Samples are replayed from dumps recorded by "metrics --dump" or generated for a synthetic fleet of tenants.
+The stand-in replaces ceilometer methods of openstack_wrapper.openstack, so the collector works with it
+as with real ceilometer.
+"""
+import json
+import math
+import random
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Lock
+from ceilometerclient.v2.samples import Sample
+from ceilometerclient.v2.statistics import Statistics
+from fitter.aggregation.constants import states, other_date_format
+from fitter.aggregation.samples import parse_timestamp, to_epoch, from_epoch
+
+
+NovaFlavor = namedtuple("NovaFlavor", ["name", "vcpus", "ram", "disk"])
+
+
+class RecordedSamples(object):
+    """
+    Samples replayed from a dump: one json sample per line as it is returned by ceilometer
+    """
+
+    def __init__(self, path):
+        self._samples = defaultdict(list)  # (project_id, meter) -> samples sorted by timestamp
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    info = json.loads(line)
+                    meter = info.get("meter") or info.get("counter_name")
+                    self._samples[(info["project_id"], meter)].append(info)
+
+        self._timestamps = {}
+        for key, samples in self._samples.items():
+            samples.sort(key=lambda info: parse_timestamp(info["timestamp"]))
+            self._timestamps[key] = [parse_timestamp(info["timestamp"]) for info in samples]
+        self.tenant_ids = sorted({project_id for project_id, _ in self._samples})
+        self.start = min((timestamps[0] for timestamps in self._timestamps.values()), default=None)
+
+    def samples(self, tenant_id, meter_name, start, end):
+        keys = [(tenant_id, meter_name)] if tenant_id else \
+            [(project_id, meter) for project_id, meter in self._samples if meter == meter_name]
+        result = []
+        for key in keys:
+            timestamps = self._timestamps.get(key, [])
+            result.extend(self._samples[key][bisect_left(timestamps, start):bisect_left(timestamps, end)])
+        return result
+
+    def resources(self, tenant_id):
+        return {info["resource_id"]: info.get("metadata") or {}
+                for (project_id, _), samples in self._samples.items() if project_id == tenant_id
+                for info in samples}
+
+
+class SyntheticFleet(object):
+    """
+    Synthetic fleet of tenants with vms. Every vm has a random but reproducible (by seed) timeline:
+    it is created during the first hours, is stopped, resized and deleted from time to time.
+    Every second vm has a volume and every fourth vm has a floating ip.
+    Samples are generated on request, so the fleet doesn't keep all samples in memory.
+    """
+    flavors = ("m1.tiny", "m1.small", "m1.medium")
+    mean_state_time = 12 * 3600
+
+    def __init__(self, tenants, vms, start, hours, seed=0, polling_interval=600):
+        self.tenant_ids = ["bench%027d" % i for i in range(tenants)]
+        self.vms = vms
+        self.start = to_epoch(start)
+        self.end = self.start + hours * 3600
+        self.seed = seed
+        self.polling_interval = polling_interval
+        self._timelines = {}
+        self._lock = Lock()
+
+    def _timeline(self, tenant_id, vm):
+        """ Returns creation time, times and (state, flavor) of the vm events
+        """
+        key = (tenant_id, vm)
+        timeline = self._timelines.get(key)
+        if timeline is not None:
+            return timeline
+
+        rng = random.Random("%s:%s:%s" % (self.seed, tenant_id, vm))
+        created = self.start + rng.uniform(0, 2 * 3600)
+        flavor = rng.choice(self.flavors)
+        times, events = [created], [("active", flavor)]
+        t = created
+        while True:
+            t += rng.expovariate(1 / self.mean_state_time)
+            if t >= self.end:
+                break
+            state = events[-1][0]
+            if state != "active":
+                events.append(("active", flavor))
+            else:
+                action = rng.random()
+                if action < 0.5:
+                    events.append((rng.choice(("stopped", "suspended", "paused")), flavor))
+                elif action < 0.8:
+                    flavor = rng.choice(self.flavors)
+                    events.append(("active", flavor))
+                else:
+                    events.append(("deleted", flavor))
+            times.append(t)
+            if events[-1][0] == "deleted":
+                break
+
+        timeline = (created, times, events)
+        with self._lock:
+            self._timelines[key] = timeline
+        return timeline
+
+    @staticmethod
+    def resource_id(tenant_id, vm, meter_name):
+        return "%s-%s-%05d" % (tenant_id, meter_name, vm)
+
+    def _metadata(self, tenant_id, vm, meter_name, flavor, state):
+        name = "vm-%05d" % vm
+        if meter_name == "instance":
+            return {"display_name": name, "flavor.name": flavor, "instance_type": flavor, "status": state}
+        if meter_name == "ip.floating":
+            return {"address": "10.%s.%s.%s" % (int(tenant_id[5:]) % 256, vm // 256 % 256, vm % 256)}
+        return {"display_name": "volume of " + name}
+
+    def _volume(self, vm, meter_name, state):
+        if meter_name == "instance":
+            return states[state]
+        if meter_name == "volume.size":
+            return 10 * (1 + vm % 5)
+        return 1
+
+    def _has_meter(self, vm, meter_name):
+        if meter_name == "instance":
+            return True
+        if meter_name == "volume.size":
+            return vm % 2 == 0
+        if meter_name == "ip.floating":
+            return vm % 4 == 0
+        return False
+
+    def samples(self, tenant_id, meter_name, start, end):
+        tenant_ids = [tenant_id] if tenant_id else self.tenant_ids
+        start, end = max(to_epoch(start), self.start), min(to_epoch(end), self.end)
+        result = []
+        for tenant_id in tenant_ids:
+            for vm in range(self.vms):
+                if self._has_meter(vm, meter_name):
+                    result.extend(self._vm_samples(tenant_id, vm, meter_name, start, end))
+        result.sort(key=lambda info: info["timestamp"])
+        return result
+
+    def _vm_samples(self, tenant_id, vm, meter_name, start, end):
+        created, times, events = self._timeline(tenant_id, vm)
+        if events[-1][0] == "deleted":
+            end = min(end, times[-1] + self.polling_interval)
+        t = created + max(0, math.ceil((start - created) / self.polling_interval)) * self.polling_interval
+        resource_id = self.resource_id(tenant_id, vm, meter_name)
+        samples = []
+        while t < end:
+            state, flavor = events[bisect_right(times, t) - 1]
+            if meter_name != "instance" and state == "deleted":
+                break
+            samples.append({"id": "%s-%d" % (resource_id, t),
+                            "meter": meter_name,
+                            "type": "gauge",
+                            "unit": "GB" if meter_name == "volume.size" else meter_name,
+                            "volume": self._volume(vm, meter_name, state),
+                            "project_id": tenant_id,
+                            "resource_id": resource_id,
+                            "source": "openstack",
+                            "user_id": None,
+                            "timestamp": from_epoch(t).strftime(other_date_format),
+                            "recorded_at": from_epoch(t + 1).strftime(other_date_format),
+                            "metadata": self._metadata(tenant_id, vm, meter_name, flavor, state)})
+            t += self.polling_interval
+        return samples
+
+    def resources(self, tenant_id):
+        resources = {}
+        for vm in range(self.vms):
+            _, _, events = self._timeline(tenant_id, vm)
+            state, flavor = events[-1]
+            for meter_name in ("instance", "volume.size", "ip.floating"):
+                if self._has_meter(vm, meter_name):
+                    resources[self.resource_id(tenant_id, vm, meter_name)] = \
+                        self._metadata(tenant_id, vm, meter_name, flavor, state)
+        return resources
+
+
+class CeilometerStandIn(object):
+    """
+    Serves samples of RecordedSamples or SyntheticFleet by the interface of openstack_wrapper.
+    Samples are returned as ceilometerclient resources, so parsing of them is the same as for real ceilometer.
+    """
+    nova_flavors = {"m1.tiny": NovaFlavor("m1.tiny", 1, 512, 1),
+                    "m1.small": NovaFlavor("m1.small", 1, 2048, 20),
+                    "m1.medium": NovaFlavor("m1.medium", 2, 4096, 40)}
+
+    def __init__(self, source):
+        self.source = source
+        self.served_samples = 0
+        self.requests = 0
+        self._lock = Lock()
+
+    def _served(self, samples):
+        with self._lock:
+            self.requests += 1
+            self.served_samples += samples
+
+    def get_tenant_usage(self, tenant_id, meter_name, start, end, limit=None):
+        infos = self.source.samples(tenant_id, meter_name, start, end)
+        if limit:
+            infos = infos[-limit:]
+        self._served(len(infos))
+        return [Sample(None, info) for info in infos]
+
+    def get_tenant_statistics(self, tenant_id, meter_name, start, end, period, source=None):
+        infos = self.source.samples(tenant_id, meter_name, start, end)
+        statistics = {}
+        for info in infos:
+            if source and info.get("source") != source:
+                continue
+            timestamp = parse_timestamp(info["timestamp"])
+            period_start = start + timedelta(seconds=(timestamp - start).total_seconds() // period * period)
+            key = (period_start, info["resource_id"])
+            stat = statistics.get(key)
+            if stat is None:
+                stat = statistics[key] = {"groupby": {"resource_id": info["resource_id"]},
+                                          "period_start": period_start.strftime(other_date_format),
+                                          "unit": info.get("unit"), "max": info["volume"], "sum": 0,
+                                          "duration_start": info["timestamp"]}
+            stat["max"] = max(stat["max"], info["volume"])
+            stat["sum"] += info["volume"]
+            stat["duration_end"] = info["timestamp"]
+        self._served(len(infos))
+        return [Statistics(None, stat) for stat in statistics.values()]
+
+    def get_tenant_resources(self, tenant_id):
+        return self.source.resources(tenant_id)
+
+    def get_nova_flavor(self, name):
+        return self.nova_flavors.get(name) or NovaFlavor(name, 1, 1024, 10)
+
+    @contextmanager
+    def installed(self, openstack):
+        """ Replaces ceilometer methods of openstack_wrapper.openstack by the stand-in """
+        names = ["get_tenant_usage", "get_tenant_statistics", "get_tenant_resources", "get_nova_flavor"]
+        for name in names:
+            setattr(openstack, name, getattr(self, name))
+        try:
+            yield self
+        finally:
+            for name in names:
+                delattr(openstack, name)
@@ -15,10 +15,13 @@ Options:
   --end=END                 Specify end metric range. By default current time is used.
                             Format like this: 2013-05-11T13:23:58
   --limit=LIMIT             Limit for number of returned samples [default: 10]
+  --dump=FILE               Append samples to the file as json lines. The dump can be replayed by
+                            "bossmngr fitter_benchmark --replay". Use --limit=0 to dump all samples of the range
 
 
 """
 import conf
+import json
 import logbook
 import arrow
 from pprint import pprint
@@ -63,6 +66,11 @@ def main():
 
     samples = openstack.get_tenant_usage(tenant_id, metric, start, end, limit=int(opt["--limit"]))
     logbook.info("Found {} samples", len(samples))
+    if opt["--dump"]:
+        with open(opt["--dump"], "a") as f:
+            for s in samples:
+                f.write(json.dumps(s._info) + "\n")
+        return
     for s in samples:
         pprint(s._info)
 
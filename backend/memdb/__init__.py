@@ -1,6 +1,7 @@
 import conf
 
-from redis import sentinel, StrictRedis
+from redis import sentinel, StrictRedis, ConnectionPool
+from threading import Lock
 
 
 def create_redis_client(db=None):
@@ -9,17 +10,49 @@ def create_redis_client(db=None):
         db = c.db_main_index
     if conf.test:
         db += c.db_index_test_offset
+    max_connections = c.get("max_connections")
     if c.sentinel:
         sent = sentinel.Sentinel(c.hosts, socket_timeout=c.sentinel_timeout, socket_keepalive=True)
-        return sent.master_for(c.sentinel, socket_timeout=c.timeout, db=db)
+        return sent.master_for(c.sentinel, socket_timeout=c.timeout, db=db, max_connections=max_connections)
     else:
         host, port = c.hosts[0]
-        return StrictRedis(host=host, port=port, db=db, socket_keepalive=True)
+        pool = ConnectionPool(host=host, port=port, db=db, socket_keepalive=True, max_connections=max_connections)
+        return StrictRedis(connection_pool=pool)
+
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def redis_client(db=None):
+    """ Returns redis client shared by the process. All clients of the same db use one connection pool,
+    and the pool reconnects itself after fork.
+    """
+    client = _clients.get(db)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(db)
+            if client is None:
+                client = _clients[db] = create_redis_client(db)
+    return client
+
+
+def pipeline(redis=None, transaction=True):
+    """ Returns pipeline which sends buffered commands in one round trip on execute().
+    With transaction the commands are wrapped into MULTI/EXEC.
+
+    Usage:
+        with pipeline() as p:
+            p.get(key)
+            p.ttl(key)
+            value, ttl = p.execute()
+    """
+    return (redis or redis_client()).pipeline(transaction=transaction)
 
 
 class MemDbModel(object):
 
-    redis = create_redis_client()
+    redis = redis_client()
     _key_prefix = ""
     _key_join_symbol = "-"
 
@@ -41,3 +74,6 @@ def clear_mem_db():
         raise Exception("clear_redis is called for not test configuration")
 
     MemDbModel().clear()
+
+    from memdb.token import token_cache
+    token_cache.clear()
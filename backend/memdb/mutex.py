@@ -2,12 +2,86 @@ import binascii
 import logbook
 import time
 from os import urandom
+from redis.client import Script
+
+
+# Script objects keep sha of the script, so it is computed once per process.
+# Scripts are sent by EVALSHA and loaded only if redis doesn't know them yet.
+_scripts = {}  # source -> Script
+
+
+def call_script(redis, source, keys, args):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = Script(redis, source)
+    return script(keys, args, client=redis)
 
 
 class RedisMutex:
-    """ Distributed mutex with ttl.
+    """
+    Distributed mutex with ttl.
+
+    Waiters of blocking acquire are queued, so the lock is granted to them in order of arrival. Waiters which
+    stopped polling are dropped from the queue after waiter_ttl_ms.
     """
     prefix = "mutex:"
+    poll_interval = 0.05
+    waiter_ttl_ms = 5000
+
+    # KEYS: lock, queue, waiters, ticket
+    # ARGV: token, ttl_ms, now_ms, enqueue, waiter_ttl_ms
+    # returns 1 if the lock is acquired
+    _acquire_script = """
+    local expired = redis.call("zrangebyscore", KEYS[3], "-inf", ARGV[3])
+    for _, waiter in ipairs(expired) do
+        redis.call("zrem", KEYS[2], waiter)
+        redis.call("zrem", KEYS[3], waiter)
+    end
+
+    local holder = redis.call("get", KEYS[1])
+    if holder == ARGV[1] then
+        return 1
+    end
+    if not holder then
+        local first = redis.call("zrange", KEYS[2], 0, 0)[1]
+        if not first or first == ARGV[1] then
+            redis.call("set", KEYS[1], ARGV[1], "px", ARGV[2])
+            redis.call("zrem", KEYS[2], ARGV[1])
+            redis.call("zrem", KEYS[3], ARGV[1])
+            return 1
+        end
+    end
+
+    if ARGV[4] == "1" then
+        if not redis.call("zscore", KEYS[2], ARGV[1]) then
+            redis.call("zadd", KEYS[2], redis.call("incr", KEYS[4]), ARGV[1])
+        end
+        redis.call("zadd", KEYS[3], ARGV[3] + ARGV[5], ARGV[1])
+        redis.call("pexpire", KEYS[2], ARGV[5])
+        redis.call("pexpire", KEYS[3], ARGV[5])
+        redis.call("pexpire", KEYS[4], ARGV[5])
+    end
+    return false
+    """
+
+    # KEYS: lock, ARGV: token, ttl_ms
+    _renew_script = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("pexpire", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    # KEYS: lock, queue, waiters, ARGV: token
+    # snippet from http://redis.io/commands/set
+    _release_script = """
+    redis.call("zrem", KEYS[2], ARGV[1])
+    redis.call("zrem", KEYS[3], ARGV[1])
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
 
     def __init__(self, name, redis, token_length=4, ttl_ms=None):
         self.name = name
@@ -15,49 +89,68 @@ class RedisMutex:
         self._token = urandom(token_length)
         self.ttl_ms = ttl_ms
         self.acquired = None
-        # snippet from http://redis.io/commands/set
-        self._delete_lock_cmd = self.redis.register_script("""
-        if redis.call("get", KEYS[1]) == ARGV[1]
-        then
-            return redis.call("del", KEYS[1])
-        else
-            return 0
-        end
-        """)
+
+    def _call(self, name, keys, args):
+        return call_script(self.redis, getattr(self, name), keys, args)
 
     @property
     def key(self):
         return self.prefix + self.name
 
+    def _keys(self):
+        return [self.key, self.key + ":queue", self.key + ":waiters", self.key + ":ticket"]
+
     def __str__(self):
         return "<RedisMutex '%s' (%s) acquired: %s>" % (self.name, binascii.hexlify(self._token).decode("ascii"),
                                                         self.acquired)
 
-    def acquire(self, ttl_ms=None):
-        # NOTE: blocking until mutex available is not implemented
+    def _try_acquire(self, ttl_ms, enqueue):
+        now_ms = int(time.time() * 1000)
+        return self._call("_acquire_script", self._keys(),
+                          [self._token, ttl_ms, now_ms, 1 if enqueue else 0, self.waiter_ttl_ms])
+
+    def acquire(self, ttl_ms=None, blocking=False, timeout=None):
+        """ Acquires the mutex.
+
+        :param ttl_ms: Time to live of the lock
+        :param blocking: Wait in queue until the mutex is released by other holder
+        :param timeout: Max waiting time in seconds, None means waiting forever
+        :return: True if the mutex is acquired
+        """
         ttl_ms = ttl_ms or self.ttl_ms
         assert ttl_ms
-        token = self.redis.get(self.key)
-        if token is None:
-            if not self.redis.set(self.key, self._token, px=ttl_ms, nx=True):
-                logbook.debug("RedisMutex '{}' was acquired during acquiring", self.name)
+        deadline = time.time() + timeout if blocking and timeout is not None else None
+        while True:
+            if self._try_acquire(ttl_ms, blocking):
+                break
+            if not blocking or (deadline is not None and time.time() >= deadline):
+                if blocking:
+                    self._leave_queue()
+                logbook.debug("RedisMutex '{}' is already acquired by other holder", self.name)
                 return False
-        elif token != self._token:
-            logbook.debug("RedisMutex '{}' is already acquired by token {}", self.name,
-                          binascii.hexlify(token).decode("ascii"))
-            return False
+            time.sleep(self.poll_interval)
 
         logbook.info("{} is acquired for {} ms", self, ttl_ms)
         self.acquired = time.time()
 
         return True
 
+    def locked(self):
+        """ Checks that the mutex is held by anybody """
+        return bool(self.redis.exists(self.key))
+
+    def _leave_queue(self):
+        with self.redis.pipeline() as p:
+            p.zrem(self.key + ":queue", self._token)
+            p.zrem(self.key + ":waiters", self._token)
+            p.execute()
+
     def release(self):
         if not self.acquired:
             logbook.debug("Release skipping for {}", self)
             return False
 
-        res = self._delete_lock_cmd([self.key], [self._token])
+        res = self._call("_release_script", self._keys()[:3], [self._token])
         acquiring_time = time.time() - self.acquired
         self.acquired = None
         if res:
@@ -67,9 +160,15 @@ class RedisMutex:
         return False
 
     def update_ttl(self, ttl_ms=None):
-        # NOTE it's not really safe in concurrent environment
+        """ Extends the lock only if it is still held by this mutex
+
+        :return: False if the lock was lost
+        """
         logbook.debug("{} update_ttl", self)
-        return self.redis.set(self.key, self._token, px=ttl_ms or self.ttl_ms)
+        res = bool(self._call("_renew_script", [self.key], [self._token, ttl_ms or self.ttl_ms]))
+        if not res:
+            logbook.warning("{} is lost and can't be extended", self)
+        return res
 
     def __enter__(self):
         return self if self.acquire() else False
@@ -77,3 +176,133 @@ class RedisMutex:
     # noinspection PyUnusedLocal
     def __exit__(self, t, v, tb):
         self.release()
+
+
+class RedisMutexBatch:
+    """
+    Mutexes which are acquired, renewed and released together by one script call.
+    Mutexes of the batch share one token, so every mutex still can be renewed or released separately.
+    """
+
+    # KEYS: lock, queue, guard of every mutex
+    # ARGV: token, ttl_ms
+    # returns for every mutex: 1 if it is acquired, 0 if it is held by other holder or has waiters,
+    # -1 if its guard is held
+    _acquire_script = """
+    local result = {}
+    for i = 1, #KEYS, 3 do
+        if redis.call("exists", KEYS[i + 2]) == 1 and KEYS[i + 2] ~= KEYS[i] then
+            table.insert(result, -1)
+        elseif redis.call("exists", KEYS[i]) == 0 and redis.call("zcard", KEYS[i + 1]) == 0 then
+            redis.call("set", KEYS[i], ARGV[1], "px", ARGV[2])
+            table.insert(result, 1)
+        else
+            table.insert(result, 0)
+        end
+    end
+    return result
+    """
+
+    # KEYS: locks, ARGV: token, ttl_ms
+    _renew_script = """
+    local result = {}
+    for i = 1, #KEYS do
+        if redis.call("get", KEYS[i]) == ARGV[1] then
+            table.insert(result, redis.call("pexpire", KEYS[i], ARGV[2]))
+        else
+            table.insert(result, 0)
+        end
+    end
+    return result
+    """
+
+    # KEYS: locks, ARGV: token
+    _release_script = """
+    local released = 0
+    for i = 1, #KEYS do
+        if redis.call("get", KEYS[i]) == ARGV[1] then
+            released = released + redis.call("del", KEYS[i])
+        end
+    end
+    return released
+    """
+
+    def __init__(self, mutexes, redis=None, token_length=4):
+        self.mutexes = list(mutexes)
+        self.redis = redis or (self.mutexes[0].redis if self.mutexes else None)
+        self._token = urandom(token_length)
+        for mutex in self.mutexes:
+            mutex._token = self._token
+        self.ttl_ms = None
+        self.renewed = None
+        self.guarded = set()  # mutexes which weren't acquired because their guards were held
+
+    def acquired(self):
+        return [mutex for mutex in self.mutexes if mutex.acquired]
+
+    def acquire(self, ttl_ms=None, guards=None):
+        """ Acquires free mutexes of the batch by one call
+
+        :param ttl_ms: Time to live of the locks, ttl of the first mutex is used by default
+        :param guards: Mutexes in order of the batch. A mutex isn't acquired while its guard is held.
+        :return: list of acquired mutexes
+        """
+        if not self.mutexes:
+            return []
+        self.ttl_ms = ttl_ms = ttl_ms or self.mutexes[0].ttl_ms
+        assert ttl_ms
+        keys = []
+        for i, mutex in enumerate(self.mutexes):
+            guard = guards[i].key if guards else mutex.key
+            keys.extend([mutex.key, mutex.key + ":queue", guard])
+        result = call_script(self.redis, self._acquire_script, keys, [self._token, ttl_ms])
+
+        now = time.time()
+        self.renewed = now
+        self.guarded = {mutex for mutex, acquired in zip(self.mutexes, result) if acquired < 0}
+        for mutex, acquired in zip(self.mutexes, result):
+            if acquired > 0:
+                mutex.acquired = now
+        acquired = self.acquired()
+        logbook.info("{} of {} mutexes are acquired by batch for {} ms", len(acquired), len(self.mutexes), ttl_ms)
+        return acquired
+
+    def renew(self, ttl_ms=None):
+        """ Extends acquired locks which are still held by the batch
+
+        :return: list of mutexes which are still held
+        """
+        mutexes = self.acquired()
+        if not mutexes:
+            return []
+        ttl_ms = ttl_ms or self.ttl_ms
+        result = call_script(self.redis, self._renew_script, [mutex.key for mutex in mutexes], [self._token, ttl_ms])
+        self.renewed = time.time()
+        for mutex, renewed in zip(mutexes, result):
+            if not renewed:
+                logbook.warning("{} is lost and can't be extended", mutex)
+                mutex.acquired = None
+        return self.acquired()
+
+    def keep_alive(self):
+        """ Renews the locks if half of their ttl has passed since the last renewing """
+        if self.renewed and time.time() - self.renewed > self.ttl_ms / 2000:
+            return self.renew()
+        return self.acquired()
+
+    def release(self):
+        mutexes = self.acquired()
+        if not mutexes:
+            return 0
+        released = call_script(self.redis, self._release_script, [mutex.key for mutex in mutexes], [self._token])
+        for mutex in mutexes:
+            mutex.acquired = None
+        logbook.info("{} of {} mutexes are released by batch", released, len(mutexes))
+        return released
+
+    def __enter__(self):
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, t, v, tb):
+        self.release()
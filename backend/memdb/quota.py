@@ -20,19 +20,38 @@ class QuotaCache(MemDbModel):
         self.redis.setex(self.key(customer), conf.customer.quota.ttl, self.pack(quotas))
 
     def get(self, customer):
-        key = self.key(customer)
-        res = self.redis.get(key)
+        return self.get_many([customer])[0]
+
+    def get_many(self, customers):
+        """ Reads quotas of customers in one round trip
+
+        :return: list of Quota in order of customers, None if quotas of customer aren't cached
+        """
+        if not customers:
+            return []
+        keys = [self.key(customer) for customer in customers]
+        with self.redis.pipeline() as p:
+            p.mget(keys)
+            for key in keys:
+                p.ttl(key)
+            result = p.execute()
+
+        quotas = []
+        for customer, res, ttl in zip(customers, result[0], result[1:]):
+            quotas.append(self._quota(customer, res, ttl))
+        return quotas
+
+    @staticmethod
+    def _quota(customer, res, ttl):
         if res is None:
             return None
 
         try:
-            used = self.unpack(res)
+            used = QuotaCache.unpack(res)
         except Exception as e:
             logbook.error("Corrupted quotas for customer {}: {}", customer, e)
             return None
 
-        ttl = self.redis.ttl(key)
-
         live_time = conf.customer.quota.ttl - ttl
         fresh = live_time < conf.customer.quota.fresh
         return Quota(used, ttl, fresh, live_time)
@@ -3,11 +3,13 @@ import logbook
 import msgpack
 import datetime
 from memdb import MemDbModel
+from memdb.mutex import call_script
 from decimal import Decimal
 from utils.money import decimal_to_string
 from celery.result import AsyncResult
 from celery import states as celery_states
 from arrow import utcnow
+from uuid import uuid4
 
 
 def default_json(obj):
@@ -128,14 +130,31 @@ class ReportTask(MemDbModel):
         return None
 
 
+class ReportChanged(Exception):
+    """ Stored report expired or was replaced during reading of it """
+
+
 class ReportCache(MemDbModel):
-    """ Used for storing aggregated reports in cache
+    """ Used for storing aggregated reports in cache.
+    Every stored report has random version which is replaced together with the report, so the report is read
+    by parts only while it isn't replaced.
     """
     _prefix = "report:"
 
+    # KEYS: report, version, ARGV: version, start, end
+    _read_script = """
+    if redis.call("get", KEYS[2]) ~= ARGV[1] then
+        return false
+    end
+    return redis.call("getrange", KEYS[1], ARGV[2], ARGV[3])
+    """
+
     def key(self, report_id):
         return self._prefix + report_id.key
 
+    def version_key(self, report_id):
+        return self.key(report_id) + ":version"
+
     def aggregation_key(self, report_id):
         return self._prefix + report_id.aggregation_key
 
@@ -150,7 +169,75 @@ class ReportCache(MemDbModel):
     def set_report(self, report_id, data, cache_time=None):
         assert isinstance(data, bytes)
         logbook.debug("Store report {}. Size: {}. Key: {}", report_id, len(data), self.key(report_id))
-        self.redis.setex(self.key(report_id), cache_time or conf.report.report_store_time, data)
+        cache_time = cache_time or conf.report.report_store_time
+        with self.redis.pipeline() as p:
+            p.setex(self.key(report_id), cache_time, data)
+            p.setex(self.version_key(report_id), cache_time, uuid4().hex)
+            p.execute()
+
+    def set_report_chunks(self, report_id, chunks, cache_time=None):
+        """ Stores report by parts, so the whole report is never kept in memory.
+        Stored report is available only when all parts are stored.
+
+        :return: size of the stored report
+        """
+        key = self.key(report_id)
+        partial_key = "%s:partial:%s" % (key, uuid4().hex)
+        cache_time = cache_time or conf.report.report_store_time
+        size = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if size:
+                self.redis.append(partial_key, chunk)
+            else:
+                with self.redis.pipeline() as p:
+                    p.append(partial_key, chunk)
+                    p.expire(partial_key, cache_time)
+                    p.execute()
+            size += len(chunk)
+
+        if size:
+            pipe = self.redis.pipeline()
+            pipe.rename(partial_key, key)
+            pipe.expire(key, cache_time)
+            pipe.setex(self.version_key(report_id), cache_time, uuid4().hex)
+            pipe.execute()
+        logbook.debug("Store report {} by parts. Size: {}. Key: {}", report_id, size, key)
+        return size
+
+    def report_size(self, report_id):
+        return self.redis.strlen(self.key(report_id))
+
+    def open_report(self, report_id, chunk_size=None):
+        """ Returns size of the stored report and iterator of its parts of chunk_size bytes,
+        or (0, None) if the report isn't stored.
+        The iterator raises ReportChanged if the report expires or is replaced during reading, so the response
+        is aborted instead of sending truncated report or parts of different reports.
+        """
+        key, version_key = self.key(report_id), self.version_key(report_id)
+        with self.redis.pipeline() as p:
+            p.strlen(key)
+            p.get(version_key)
+            size, version = p.execute()
+        if not size or version is None:
+            return 0, None
+        return size, self.iter_report(report_id, version, size, chunk_size)
+
+    def iter_report(self, report_id, version, size, chunk_size=None):
+        """ Reads the version of stored report by parts of chunk_size bytes
+        """
+        keys = [self.key(report_id), self.version_key(report_id)]
+        chunk_size = chunk_size or conf.report.chunk_size
+        offset = 0
+        while offset < size:
+            end = min(offset + chunk_size, size)
+            chunk = call_script(self.redis, self._read_script, keys, [version, offset, end - 1])
+            if not chunk or len(chunk) != end - offset:
+                logbook.warning("Report {} is changed after {} of {} bytes are read", report_id, offset, size)
+                raise ReportChanged(report_id)
+            yield chunk
+            offset = end
 
     @staticmethod
     def pack_aggregated(aggregated):
@@ -2,9 +2,11 @@ import binascii
 import conf
 import errors
 import logbook
-from memdb import MemDbModel, create_redis_client
+import time
+from memdb import MemDbModel, redis_client
 from os import urandom
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from threading import Lock, Thread
 
 
 def random_id(bytes_count):
@@ -14,6 +16,119 @@ def random_id(bytes_count):
     return binascii.hexlify(raw).decode("ascii")
 
 
+class TokenCache(object):
+    """
+    Per process LRU cache of validated tokens. Tokens are kept not longer than conf.api.token_cache.ttl seconds.
+    Keys of removed tokens are published to redis channel, so they are evicted from caches of all processes at once.
+    The cache isn't used while the process isn't subscribed to the channel.
+    Every eviction increments generation of the cache, so a token fetched before it isn't put to the cache.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.subscribed = False
+        self.hits = 0
+        self.misses = 0
+        self._tokens = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+        self._listener = None
+
+    def get(self, key):
+        if not self.config.size:
+            return None
+        self._start_listener()
+        if not self.subscribed:
+            return None
+
+        with self._lock:
+            item = self._tokens.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._tokens.move_to_end(key)
+                self.hits += 1
+                token = item[1]
+            else:
+                if item is not None:
+                    del self._tokens[key]
+                self.misses += 1
+                token = None
+            lookups = self.hits + self.misses
+
+        if lookups % self.config.stats_interval == 0:
+            logbook.info("Token cache stats: {}", self.stats())
+        return token
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def put(self, key, token, generation):
+        """ Caches the token fetched at the generation, unless some tokens were evicted since """
+        if not self.subscribed:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._tokens[key] = (time.monotonic() + self.config.ttl, token)
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > self.config.size:
+                self._tokens.popitem(last=False)
+
+    def evict(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._tokens.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._tokens.clear()
+
+    def revoke(self, redis, keys):
+        """ Evicts tokens from cache of this process and publishes them for other processes """
+        keys = [key.decode("ascii") if isinstance(key, bytes) else key for key in keys]
+        if not keys or not self.config.size:
+            return
+        self.evict(*keys)
+        redis.publish(self.config.channel, " ".join(keys))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self._tokens),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None}
+
+    def _start_listener(self):
+        if self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is None:
+                self._listener = Thread(target=self._listen, name="token-cache-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = redis_client().pubsub()
+                pubsub.subscribe(self.config.channel)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        self.subscribed = True
+                    elif message["type"] == "message":
+                        self.evict(*message["data"].decode("ascii").split())
+            except Exception as e:
+                logbook.warning("Token cache is disabled, because subscription to {} is lost: {}",
+                                self.config.channel, e)
+            self.subscribed = False
+            self.clear()
+            time.sleep(self.config.reconnect_delay)
+
+
+token_cache = TokenCache(conf.api.token_cache)
+
+
 class BaseToken(MemDbModel):
     """
     Base Model of tokens.
@@ -25,14 +140,9 @@ class BaseToken(MemDbModel):
     invalid_token = None
     Token = namedtuple("Token", ["id"])
 
-    _redis_client = None
-
     @classmethod
     def redis(cls):
-        if not cls._redis_client:
-            db_index = cls.config.get("db_index", None)
-            cls._redis_client = create_redis_client(db_index)
-        return cls._redis_client
+        return redis_client(cls.config.get("db_index", None))
 
     @classmethod
     def generate_random_id(cls, bytes_count=None):
@@ -56,15 +166,15 @@ class BaseToken(MemDbModel):
     def save(cls, token):
         key = cls.prefixed_key(token.id)
         ttl = cls.config.ttl
-        cls.redis().hmset(key, cls.serialize(token))
-        cls.redis().expire(key, ttl)
+        with cls.redis().pipeline() as p:
+            p.hmset(key, cls.serialize(token))
+            p.expire(key, ttl)
+            p.execute()
         return token
 
     # noinspection PyCallingNonCallable
     @classmethod
-    def get(cls, token_id):
-        key = cls.prefixed_key(token_id)
-        data = cls.redis().hgetall(key)
+    def _load(cls, key, data):
         if not data:
             logbook.debug("Token {} not found in memdb {}", cls.__name__, key)
             raise cls.invalid_token()
@@ -75,6 +185,30 @@ class BaseToken(MemDbModel):
             logbook.exception()
             raise cls.invalid_token()
 
+    @classmethod
+    def get(cls, token_id):
+        key = cls.prefixed_key(token_id)
+        return cls._load(key, cls.redis().hgetall(key))
+
+    @classmethod
+    def get_many(cls, token_ids):
+        """ Reads tokens in one round trip
+
+        :return: list of tokens in order of token_ids, None for invalid tokens
+        """
+        keys = [cls.prefixed_key(token_id) for token_id in token_ids]
+        with cls.redis().pipeline(transaction=False) as p:
+            for key in keys:
+                p.hgetall(key)
+            result = p.execute()
+        tokens = []
+        for key, data in zip(keys, result):
+            try:
+                tokens.append(cls._load(key, data))
+            except cls.invalid_token:
+                tokens.append(None)
+        return tokens
+
     @classmethod
     def remove(cls, token):
         key = cls.prefixed_key(token.id)
@@ -94,6 +228,10 @@ class BaseToken(MemDbModel):
 
 
 class BaseScannableToken(BaseToken):
+    """
+    Token which can be found by second index (user or customer).
+    Keys of tokens are kept in sorted set of the second index with expiration time of the token as score.
+    """
     second_index = ""
 
     @classmethod
@@ -102,6 +240,44 @@ class BaseScannableToken(BaseToken):
         second_index = str(getattr(model, cls.second_index))
         return cls._key_join_symbol.join([second_index, cls.generate_random_id()])
 
+    @classmethod
+    def index_key(cls, second_index):
+        return "%sindex:%s" % (cls._key_prefix, second_index)
+
+    @classmethod
+    def save(cls, token):
+        key = cls.prefixed_key(token.id)
+        index_key = cls.index_key(getattr(token, cls.second_index))
+        ttl = cls.config.ttl
+        now = time.time()
+        with cls.redis().pipeline() as p:
+            p.hmset(key, cls.serialize(token))
+            p.expire(key, ttl)
+            p.zadd(index_key, now + ttl, key)
+            p.zremrangebyscore(index_key, "-inf", now)
+            p.expire(index_key, ttl)
+            p.execute()
+        return token
+
+    @classmethod
+    def get_cached(cls, token_id):
+        key = cls.prefixed_key(token_id)
+        generation = token_cache.generation
+        token = token_cache.get(key)
+        if token is None:
+            token = cls.get(token_id)
+            token_cache.put(key, token, generation)
+        return token
+
+    @classmethod
+    def remove(cls, token):
+        key = cls.prefixed_key(token.id)
+        with cls.redis().pipeline() as p:
+            p.delete(key)
+            p.zrem(cls.index_key(getattr(token, cls.second_index)), key)
+            p.execute()
+        token_cache.revoke(cls.redis(), [key])
+
     @classmethod
     def update_by(cls, second_index, **kwargs):
         keys = cls._find_keys_by(second_index)
@@ -109,22 +285,64 @@ class BaseScannableToken(BaseToken):
             return
         with cls.redis().pipeline(transaction=False) as p:
             for key in keys:
+                p.exists(key)
+            existing = [key for key, exists in zip(keys, p.execute()) if exists]
+            for key in existing:
                 p.hmset(key, kwargs)
             p.execute()
+        token_cache.revoke(cls.redis(), existing)
 
     @classmethod
     def find_by(cls, second_index):
-        return [cls(key.lstrip(cls._key_prefix)) for key in cls._find_keys_by(second_index)]
+        token_ids = [key.decode("ascii")[len(cls._key_prefix):] for key in cls._find_keys_by(second_index)]
+        return [token for token in cls.get_many(token_ids) if token is not None]
 
     @classmethod
     def _find_keys_by(cls, second_index):
-        return cls.redis().keys(cls.prefixed_key(str(second_index), "*"))
+        index_key = cls.index_key(second_index)
+        with cls.redis().pipeline() as p:
+            p.zremrangebyscore(index_key, "-inf", time.time())
+            p.zrange(index_key, 0, -1)
+            return p.execute()[1]
 
     @classmethod
     def remove_by(cls, second_index):
         keys = cls._find_keys_by(second_index)
-        if keys:
-            return cls.redis().delete(*keys)
+        with cls.redis().pipeline() as p:
+            if keys:
+                p.delete(*keys)
+            p.delete(cls.index_key(second_index))
+            removed = p.execute()[0] if keys else None
+        token_cache.revoke(cls.redis(), keys)
+        return removed
+
+    @classmethod
+    def rebuild_index(cls):
+        """ Adds existing tokens to indexes of second index. Keys are iterated by SCAN, so redis isn't blocked.
+
+        :return: number of indexed tokens
+        """
+        redis = cls.redis()
+        index_prefix = cls.index_key("").encode("ascii")
+        now = time.time()
+        count = 0
+        for key in redis.scan_iter(match=cls._key_prefix + "*", count=1000):
+            if key.startswith(index_prefix):
+                continue
+            with redis.pipeline() as p:
+                p.hget(key, cls.second_index)
+                p.ttl(key)
+                second_index, ttl = p.execute()
+            if second_index is None or ttl is None or ttl < 0:
+                continue
+            index_key = cls.index_key(second_index.decode("ascii"))
+            with redis.pipeline() as p:
+                p.zadd(index_key, now + ttl, key)
+                p.expire(index_key, cls.config.ttl)
+                p.execute()
+            count += 1
+        logbook.info("Rebuilt index of {} for {} tokens", cls.__name__, count)
+        return count
 
 
 class UserToken(BaseScannableToken):
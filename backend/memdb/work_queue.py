@@ -0,0 +1,125 @@
+import logbook
+import time
+from memdb import MemDbModel
+from memdb.mutex import call_script
+
+
+class WorkQueue(MemDbModel):
+    """
+    Queue of work items ordered by priority (lower score is pulled first).
+
+    Pulled items are leased by the worker for visibility timeout. Items which aren't acked in time (e.g. the worker
+    crashed) are returned to the queue with the highest priority and delivered to the next pull.
+    """
+    _prefix = "work_queue:"
+
+    # KEYS: pending, leased, owners
+    # ARGV: score, item, score, item...
+    # items which are leased now are not queued again
+    _push_script = """
+    local pushed = 0
+    for i = 1, #ARGV, 2 do
+        if not redis.call("zscore", KEYS[2], ARGV[i + 1]) then
+            pushed = pushed + redis.call("zadd", KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    return pushed
+    """
+
+    # KEYS: pending, leased, owners
+    # ARGV: now_ms, count, visibility_timeout_ms, worker
+    _pull_script = """
+    local expired = redis.call("zrangebyscore", KEYS[2], "-inf", ARGV[1])
+    for _, item in ipairs(expired) do
+        redis.call("zrem", KEYS[2], item)
+        redis.call("hdel", KEYS[3], item)
+        redis.call("zadd", KEYS[1], "-inf", item)
+    end
+
+    local items = redis.call("zrange", KEYS[1], 0, ARGV[2] - 1)
+    for _, item in ipairs(items) do
+        redis.call("zrem", KEYS[1], item)
+        redis.call("zadd", KEYS[2], ARGV[1] + ARGV[3], item)
+        redis.call("hset", KEYS[3], item, ARGV[4])
+    end
+    return items
+    """
+
+    # KEYS: pending, leased, owners
+    # ARGV: now_ms, visibility_timeout_ms or "", worker, item, item...
+    # extends (or removes if visibility timeout is empty) leases which are still owned by the worker
+    _lease_script = """
+    local result = 0
+    for i = 4, #ARGV do
+        if redis.call("hget", KEYS[3], ARGV[i]) == ARGV[3] then
+            if ARGV[2] == "" then
+                redis.call("zrem", KEYS[2], ARGV[i])
+                redis.call("hdel", KEYS[3], ARGV[i])
+            else
+                redis.call("zadd", KEYS[2], ARGV[1] + ARGV[2], ARGV[i])
+            end
+            result = result + 1
+        end
+    end
+    return result
+    """
+
+    def __init__(self, name, worker):
+        self.name = name
+        self.worker = worker
+
+    def _keys(self):
+        key = self._prefix + self.name
+        return [key + ":pending", key + ":leased", key + ":owners"]
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    def push(self, items):
+        """ Adds items to the queue or changes their priority if they are already queued.
+
+        :param items: iterable of (item, score)
+        :return: number of new queued items
+        """
+        args = []
+        for item, score in items:
+            args.extend([score, item])
+        if not args:
+            return 0
+        pushed = call_script(self.redis, self._push_script, self._keys(), args)
+        logbook.debug("{} new items are pushed to queue {}", pushed, self.name)
+        return pushed
+
+    def pull(self, count, visibility_timeout):
+        """ Leases up to count items with the lowest score for visibility_timeout seconds
+        """
+        items = call_script(self.redis, self._pull_script, self._keys(),
+                            [self._now_ms(), count, int(visibility_timeout * 1000), self.worker])
+        return [item.decode("utf-8") for item in items]
+
+    def extend(self, items, visibility_timeout):
+        """ Extends leases of the items
+
+        :return: number of items which are still leased by the worker
+        """
+        if not items:
+            return 0
+        return call_script(self.redis, self._lease_script, self._keys(),
+                           [self._now_ms(), int(visibility_timeout * 1000), self.worker] + list(items))
+
+    def ack(self, *items):
+        """ Removes processed items from the queue
+        """
+        if not items:
+            return 0
+        return call_script(self.redis, self._lease_script, self._keys(),
+                           [self._now_ms(), "", self.worker] + list(items))
+
+    def size(self):
+        """ Returns number of pending and leased items """
+        keys = self._keys()
+        with self.redis.pipeline(transaction=False) as p:
+            p.zcard(keys[0])
+            p.zcard(keys[1])
+            return tuple(p.execute())
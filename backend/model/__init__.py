@@ -224,12 +224,14 @@ from model.account.customer_info import PrivateCustomerInfo, EntityCustomerInfo
 from model.account.user import User
 from model.account.service import FixedService, Measure, Category, Service, ServiceLocalization, ServiceDescription,\
     Flavor
-from model.account.tariff import TariffLocalization, Tariff, TariffHistory, ServicePrice
+from model.account.tariff import TariffLocalization, Tariff, TariffHistory, ServicePrice, TariffPriceIndex, \
+    TariffPrice, RerateCommitFailed
 from model.account.news import News
-from model.fitter.service_usage import ServiceUsage
+from model.fitter.service_usage import ServiceUsage, ServiceUsageDay, ServiceUsageMonth
 from model.account.tenant import Tenant
 from model.account.deferred import Deferred
 from model.account.account import Account, AccountHistory
+from model.account.balance_forecast import BalanceForecast
 from model.account.customer_history import CustomerHistory
 from model.account.option import Option
 from model.account.time_state import TimeState, TimeMachine
@@ -38,8 +38,14 @@ class Account(db.Model, AccountDb):
         db.session.flush()
 
     def charge(self, delta):
+        """ Increases withdraw by delta.
+
+        :return: current balance before and after the charge
+        """
         self.withdraw = Account.withdraw + delta
         db.session.flush()
+        after = self.current
+        return after + delta, after
 
     @property
     def current(self):
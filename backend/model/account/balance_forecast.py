@@ -0,0 +1,77 @@
+import arrow
+import conf
+import logbook
+from datetime import timedelta
+from sqlalchemy import Column, ForeignKey
+from model import db, AccountDb, Customer
+
+
+DAY = 24 * 60 * 60
+
+
+class BalanceForecast(db.Model, AccountDb):
+    """
+    Daily spend of the customer in the tariff currency over the trailing window and the number of days
+    till the balance reaches the balance limit. Forecasts of all customers are recomputed by update().
+    Only customers who spent anything during the window have forecast.
+    """
+    customer_id = Column(db.Integer, ForeignKey("customer.customer_id"), primary_key=True)
+    currency = Column(db.String(3))
+    day_withdraw = Column(db.DECIMAL(precision=conf.backend.decimal.precision, scale=conf.backend.decimal.scale))
+    available = Column(db.DECIMAL(precision=conf.backend.decimal.precision, scale=conf.backend.decimal.scale))
+    # large balance with tiny spend gives more days than decimal column of money can keep
+    days_left = Column(db.Float, index=True)
+    updated = Column(db.DateTime)
+
+    def __str__(self):
+        return "<BalanceForecast {0.customer_id} {0.day_withdraw} {0.currency} days left: {0.days_left}>".format(self)
+
+    @classmethod
+    def update(cls, now=None):
+        """
+        Recomputes forecasts of all customers: spend of all tenants is summed by one grouped query and is joined
+        with balances of accounts in the tariff currency, which are read by one query too.
+
+        :return: number of customers with forecast
+        """
+        from model import Account, Tariff, ServiceUsage
+
+        now = now or arrow.utcnow().datetime
+        window = conf.customer.blocking.forecast_window
+        withdraw_by_tenant = ServiceUsage.aggregate_all(now - timedelta(seconds=window), now, "currency")
+
+        balances = db.session.query(Customer.customer_id, Customer.os_tenant_id, Customer.balance_limit,
+                                    Tariff.currency, Account.balance, Account.withdraw).\
+            join(Tariff, Tariff.tariff_id == Customer.tariff_id).\
+            join(Account, (Account.customer_id == Customer.customer_id) & (Account.currency == Tariff.currency)).\
+            filter(Customer.deleted == None, Customer.os_tenant_id != None)
+
+        forecasts = []
+        for customer_id, tenant_id, balance_limit, currency, balance, withdraw in balances:
+            spent = sum(cost for usage_currency, cost, _ in withdraw_by_tenant.get(tenant_id, ())
+                        if usage_currency == currency and cost)
+            if not spent:
+                continue
+            day_withdraw = spent * DAY / window
+            available = balance - withdraw - (balance_limit or 0)
+            forecasts.append({"customer_id": customer_id, "currency": currency, "day_withdraw": day_withdraw,
+                              "available": available, "days_left": float(available / day_withdraw), "updated": now})
+
+        cls.query.delete(False)
+        if forecasts:
+            db.session.execute(cls.__table__.insert(), forecasts)
+        logbook.info("Balance forecasts of {} customers are updated", len(forecasts))
+        return len(forecasts)
+
+    @classmethod
+    def low_balance(cls, days):
+        """
+        Returns (customer, forecast) of not blocked customers whose balance reaches the limit in the days,
+        ordered by customer_id
+        """
+        return db.session.query(Customer, cls).join(cls, cls.customer_id == Customer.customer_id).\
+            filter(Customer.blocked == False, cls.days_left <= days).order_by(Customer.customer_id)
+
+    @classmethod
+    def get_by_customer(cls, customer_id):
+        return cls.query.filter_by(customer_id=customer_id).first()
@@ -4,7 +4,7 @@ import logbook
 
 from model import db, display, AccountDb, duplicate_handle, MessageTemplate, ScheduledTask
 from memdb.token import CustomerToken
-from sqlalchemy import Column, ForeignKey, UniqueConstraint, desc, Enum
+from sqlalchemy import Column, ForeignKey, UniqueConstraint, desc, Enum, func, case
 from sqlalchemy.orm import relationship
 # noinspection PyUnresolvedReferences
 from passlib.hash import pbkdf2_sha256
@@ -443,7 +443,13 @@ class Customer(db.Model, AccountDb):
         self.check_balance(account, currency)
         db.session.flush()
 
-    def withdraw(self, delta, currency=None):
+    def withdraw(self, delta, currency=None, check_crossing=True):
+        """ Charges the account of the customer.
+
+        :param check_crossing: Check crossing of the balance limits by check_balance_crossing. The caller which
+                               commits the charge later can check it itself after the commit.
+        :return: current balance before and after the charge
+        """
         assert isinstance(delta, Decimal)
         assert delta >= 0
         currency = (currency or self.tariff.currency).upper()
@@ -452,9 +458,32 @@ class Customer(db.Model, AccountDb):
         if account is None:
             raise Exception("Customer %s doesn't have account in %s, but withdraw %s %s is required" %
                             (self, currency, delta, currency))
-        account.charge(delta)
-        self.check_balance(account, currency)
+        before, after = account.charge(delta)
+        if check_crossing:
+            self.check_balance_crossing(currency, before, after)
         db.session.flush()
+        return before, after
+
+    def check_balance_crossing(self, currency, before, after):
+        """ Blocks the customer or notifies about low balance when the charge moves the balance over the limits.
+        Withdraw only decreases the balance, so unblocking is not checked here.
+        """
+        if currency != self.tariff.currency or self.blocked or after >= before:
+            return
+        if after < self.balance_limit:
+            self.block(blocked=True, user_id=None, message='insufficient funds')
+            return
+
+        from model import BalanceForecast
+        forecast = BalanceForecast.get_by_customer(self.customer_id)
+        if not forecast or not forecast.day_withdraw:
+            return
+        threshold = self.balance_limit + forecast.day_withdraw * conf.customer.blocking.notification
+        if before > threshold >= after:
+            from task.notifications import send_email_limit_notification
+            days = (after - self.balance_limit) / forecast.day_withdraw
+            logbook.info("Balance of {} is enough for {} days only", self, days)
+            send_email_limit_notification(self.email, int(days), self.locale_language())
 
     def change_auto_withdraw(self, enabled, balance_limit, payment_amount):
         if enabled is not None:
@@ -507,7 +536,7 @@ class Customer(db.Model, AccountDb):
 
     @classmethod
     def delete_by_prefix(cls, prefix, field=None):
-        from model import Account, AccountHistory, Tenant
+        from model import Account, AccountHistory, Tenant, BalanceForecast
         from task.openstack import final_delete_from_os
 
         field = field or cls.unique_field
@@ -527,6 +556,7 @@ class Customer(db.Model, AccountDb):
         SubscriptionSwitch.query.filter(SubscriptionSwitch.customer_id.in_(ids)).delete(False)
         AccountHistory.query.filter(AccountHistory.customer_id.in_(ids)).delete(False)
         Account.query.filter(Account.customer_id.in_(ids)).delete(False)
+        BalanceForecast.query.filter(BalanceForecast.customer_id.in_(ids)).delete(False)
         Quote.query.filter(Quote.customer_id.in_(ids)).delete(False)
         CustomerCard.query.filter(CustomerCard.customer_id.in_(ids)).delete(False)
         customers = cls.query.filter(cls.customer_id.in_(ids))
@@ -735,14 +765,15 @@ class Customer(db.Model, AccountDb):
                                                             ServiceUsage.end <= time_end)
         total_cost = self.calculate_usage_cost(service_usages_to_clean.all())
         self.get_account(self.tariff.currency).charge(-total_cost)
+        ServiceUsage.remove_from_rollups(self.os_tenant_id, time_end)
         service_usages_to_clean.delete(False)
 
     @classmethod
     def get_by_tenant_id(cls, tenant_id):
         return cls.query.filter_by(os_tenant_id=tenant_id).first()
 
-    def calculate_usage_cost(self, usages):
-        from model import Service, Category, ServicePrice
+    def calculate_usage_cost(self, usages, add_to_session=True):
+        from model import Service, Category, ServicePrice, TariffPriceIndex, TariffPrice
         from task.notifications import notify_managers_about_new_service_in_tariff
 
         total_cost = Decimal()
@@ -750,12 +781,18 @@ class Customer(db.Model, AccountDb):
         if not tariff:
             raise Exception("Tariff is not set for customer %s" % self)
 
-        services = tariff.services_as_dict(lower=True)
+        prices = tariff.price_index()
         for usage in usages:
-            db.session.add(usage)
+            if add_to_session:
+                db.session.add(usage)
             service_id = usage.service_id.lower() if isinstance(usage.service_id, str) else str(usage.service_id)
-            service_price = services.get(service_id)
-            service = Service.get_by_id(service_id)
+            service_price = prices.get(service_id)
+            if service_price is None:
+                # index of this process can be outdated if the tariff was changed in the same second
+                prices = TariffPriceIndex.get_missing(tariff, service_id)
+                service_price = prices.get(service_id)
+
+            service = service_price if service_price is not None else Service.get_by_id(service_id)
 
             usage.tariff_id = tariff.tariff_id
             usage.customer_mode = self.customer_mode
@@ -774,14 +811,19 @@ class Customer(db.Model, AccountDb):
                         logbook.error("Service {} not found in {} for {}. But this service is archived",
                                       service_id, tariff, self)
                     else:
-                        service_price = ServicePrice(service_id=service_id, price=Decimal(0), need_changing=True)
-                        self.tariff.services.append(service_price)
-                        services = tariff.services_as_dict(lower=True)
-                        flavor_name = Service.get_by_id(service_id).flavor.flavor_id
+                        self.tariff.services.append(ServicePrice(service_id=service_id, price=Decimal(0),
+                                                                 need_changing=True))
+                        tariff.prices_changed()
+                        TariffPriceIndex.invalidate(tariff.tariff_id)
+                        service_price = TariffPrice(service_id, Decimal(0), tariff.currency, service.measure,
+                                                    service.category_id, service.deleted)
+                        prices = dict(prices)
+                        prices[service_id] = service_price
+                        flavor_name = service.flavor.flavor_id
                         notify_managers_about_new_service_in_tariff.delay(self.customer_id, flavor_name)
                 else:
                     logbook.warning("Service {} not found in {} for {}. Allowed services: {}",
-                                    service_id, tariff, self, services.keys())
+                                    service_id, tariff, self, list(prices.keys()))
 
             if service_price:
                 usage_cost = usage_volume * service_price.price / service.hours
@@ -829,8 +871,8 @@ class Customer(db.Model, AccountDb):
             fn = min(fn, finish)
             service_usage = ServiceUsage(customer.os_tenant_id, service_id, time_label, resource_id,
                                          customer.tariff, volume, st, fn, resource_name=resource_name)
-            db.session.add(service_usage)
-            cost = customer.calculate_usage_cost([service_usage])
+            cost = customer.calculate_usage_cost([service_usage], add_to_session=False)
+            ServiceUsage.bulk_save([service_usage])
             customer.withdraw(cost)
             total_cost += cost
             time_label = time_label.next()
@@ -860,24 +902,31 @@ class Customer(db.Model, AccountDb):
 
     @classmethod
     def customers_stat(cls):
-        result = {"total": cls.query.count()}
-
+        """ Counts customers by modes and types. All figures are computed by one grouped query
+        """
+        counts = {}
+        query = db.session.query(cls.customer_type, cls.customer_mode, func.count(cls.customer_id),
+                                 func.sum(case([(cls.blocked.is_(True), 1)], else_=0)),
+                                 func.sum(case([(cls.deleted.isnot(None), 1)], else_=0))).\
+            group_by(cls.customer_type, cls.customer_mode)
+        for customer_type, mode, count, blocked, deleted in query:
+            counts[(customer_type, mode)] = count, int(blocked or 0), int(deleted or 0)
+
+        result = {"total": sum(count for count, _, _ in counts.values())}
         total_deleted = 0
         total_by_mode = Counter()
         total_blocked = 0
         for customer_type in cls.ALL_TYPES:
-            query_by_type = cls.query.filter_by(customer_type=customer_type)
+            deleted = 0
             for mode in cls.ALL_MODES:
-                query = cls.query.filter_by(customer_mode=mode, customer_type=customer_type)
+                count, blocked, mode_deleted = counts.get((customer_type, mode), (0, 0, 0))
                 metric_name = "%s_%s" % (mode, customer_type)
-                count = query.count()
                 total_by_mode[mode] += count
                 result[metric_name] = count
-                blocked = query.filter(cls.blocked.is_(True)).count()
                 result[metric_name + "_blocked"] = blocked
                 total_blocked += blocked
+                deleted += mode_deleted
 
-            deleted = query_by_type.filter(cls.deleted.isnot(None)).count()
             result[customer_type + "_deleted"] = deleted
             total_deleted += deleted
         result["total_deleted"] = total_deleted
@@ -2,8 +2,13 @@ import conf
 import errors
 import json
 import logbook
+from collections import namedtuple
+from decimal import Decimal
 from datetime import timedelta
+from threading import Lock
+from types import MappingProxyType
 from model import db, AccountDb, duplicate_handle, Service, User, Category
+from model.account.service import BaseService
 from sqlalchemy import Column, ForeignKey, UniqueConstraint, desc, or_
 from sqlalchemy.orm import relationship, deferred
 from arrow import utcnow
@@ -57,6 +62,84 @@ class ServicePrice(db.Model, AccountDb):
         return Service.get_by_id(self.service_id)
 
 
+class TariffPrice(namedtuple("TariffPrice", ["service_id", "price", "currency", "measure", "category_id", "deleted"]),
+                  BaseService):
+    """ Price of the service in the tariff together with the service attributes which are required for rating.
+    """
+
+
+class RerateCommitFailed(Exception):
+    """ Usages and balances are stored in different databases, so a failed commit of rerated chunk
+    can leave one of them committed. Rerating can't be simply repeated after it.
+    """
+
+
+class TariffPriceIndex(object):
+    """
+    Per-process index of tariff prices. For every tariff it keeps an immutable mapping
+    from lower case service_id to TariffPrice. The mapping is built once per tariff revision
+    (Tariff.revision, it is incremented by every change of prices) and is rebuilt when the revision changes
+    or the tariff is invalidated.
+    Services which are missing in the revision are remembered, so they don't cause rebuilds of the index.
+    """
+    _indexes = {}  # tariff_id -> (revision, prices, missing service ids)
+    _lock = Lock()
+
+    @classmethod
+    def get(cls, tariff):
+        version = tariff.revision
+        cached = cls._indexes.get(tariff.tariff_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        prices = MappingProxyType(cls.build(tariff))
+        with cls._lock:
+            cls._indexes[tariff.tariff_id] = version, prices, set()
+        logbook.debug("Price index for {} (revision {}) is built: {} services", tariff, version, len(prices))
+        return prices
+
+    @classmethod
+    def get_missing(cls, tariff, service_id):
+        """ Rebuilds the index once for the service which is not found in it, because the service can be added
+        to the tariff in this process without commit of the revision. If the service is still missing,
+        it doesn't cause rebuilds until the revision of the tariff changes.
+
+        :return: the price index
+        """
+        cached = cls._indexes.get(tariff.tariff_id)
+        if cached is not None and cached[0] == tariff.revision and service_id in cached[2]:
+            return cached[1]
+
+        cls.invalidate(tariff.tariff_id)
+        prices = cls.get(tariff)
+        if service_id not in prices:
+            with cls._lock:
+                cached = cls._indexes.get(tariff.tariff_id)
+                if cached is not None and cached[1] is prices:
+                    cached[2].add(service_id)
+        return prices
+
+    @staticmethod
+    def build(tariff):
+        prices = {}
+        for service_price in tariff.services:
+            service = Service.get_by_id(service_price.service_id)
+            if service is None:
+                continue
+            service_id = str(service_price.service_id).lower()
+            prices[service_id] = TariffPrice(service_id, service_price.price, tariff.currency, service.measure,
+                                             service.category_id, service.deleted)
+        return prices
+
+    @classmethod
+    def invalidate(cls, tariff_id=None):
+        with cls._lock:
+            if tariff_id is None:
+                cls._indexes.clear()
+            else:
+                cls._indexes.pop(tariff_id, None)
+
+
 class Tariff(db.Model, AccountDb):
     id_field = "tariff_id"
     unique_field = "localized_name"
@@ -72,6 +155,7 @@ class Tariff(db.Model, AccountDb):
     deleted = Column(db.DateTime())
     created = Column(db.DateTime())
     modified = Column(db.DateTime())
+    revision = Column(db.Integer, nullable=False, default=0)
     services = relationship("ServicePrice", cascade="save-update, merge, delete, delete-orphan")
     mutable = Column(db.Boolean())
     default = Column(db.Boolean(), index=True)
@@ -114,6 +198,7 @@ class Tariff(db.Model, AccountDb):
         now = utcnow().datetime
         tariff.created = now
         tariff.modified = now
+        tariff.revision = 0
         tariff.deleted = None
         tariff.update_localized_name(localized_name)
         tariff.mutable = True
@@ -123,6 +208,7 @@ class Tariff(db.Model, AccountDb):
             tariff.update_services(services)
         db.session.add(tariff)
         db.session.flush()
+        TariffPriceIndex.invalidate(tariff.tariff_id)
         return tariff
 
     @duplicate_handle(errors.TariffAlreadyExists)
@@ -137,10 +223,13 @@ class Tariff(db.Model, AccountDb):
             self.update_localized_name(localized_name)
         if description:
             self.description = description
-        if services:
-            self.update_services(services)
-        if currency:
+        prices_changed = bool(services) and self.update_services(services)
+        if currency and currency.upper() != self.currency:
             self.currency = currency.upper()
+            prices_changed = True
+        if prices_changed:
+            self.prices_changed()
+        TariffPriceIndex.invalidate(self.tariff_id)
         if db.session.is_modified(self):
             self.modified = utcnow().datetime
             return True
@@ -151,6 +240,104 @@ class Tariff(db.Model, AccountDb):
 
         return {lower_func(service.service_id): service for service in self.services}
 
+    def price_index(self):
+        return TariffPriceIndex.get(self)
+
+    def prices_changed(self):
+        """ Increments revision of the tariff, so price indexes of all processes are rebuilt """
+        self.modified = utcnow().datetime
+        if self.tariff_id is None:
+            self.revision = (self.revision or 0) + 1
+        else:
+            # concurrent changes don't get the same revision
+            self.revision = Tariff.revision + 1
+            db.session.flush()
+
+    def rerate_usage(self, start, finish, customers=None, dry_run=False, chunk_size=None):
+        """
+        Recalculates cost of usages rated by this tariff between start and finish by current prices of the tariff
+        and corrects balances of customers. Usages of every tenant are rerated under its TenantMutex, so the fitter
+        doesn't charge the same hours meanwhile. Every chunk of usages is committed with the balance changes,
+        so interrupted rerating can be just restarted.
+
+        :param customers: list of customers to rerate, all customers if None
+        :param dry_run: only calculate balance changes
+        :return: list of dicts with balance change of every customer and currency
+        :raise RerateCommitFailed: if commit of a chunk failed, so its usages and balances can be committed partly
+        """
+        from model import Customer, ServiceUsage
+        from fitter.aggregation.collector import TenantMutex
+
+        # prices are read from the session instead of the price index, which can be outdated in this process
+        prices = []
+        for service_price in self.services:
+            service = service_price.service
+            if service is not None:
+                prices.append((str(service_price.service_id).lower(), service_price.price, service.hours))
+        tenant_ids = None
+        if customers is not None:
+            tenant_ids = [customer.os_tenant_id for customer in customers if customer.os_tenant_id]
+
+        logbook.info("Rerating usage of {} from {} to {} for {} customers{}", self, start, finish,
+                     "all" if customers is None else len(customers), " (dry run)" if dry_run else "")
+        customers_by_tenant = {}
+        total = {}
+
+        def apply(deltas):
+            new_tenants = {tenant_id for tenant_id, _ in deltas} - customers_by_tenant.keys()
+            if new_tenants:
+                customers_by_tenant.update((customer.os_tenant_id, customer) for customer in
+                                           Customer.query.filter(Customer.os_tenant_id.in_(new_tenants)))
+            for (tenant_id, currency), delta in deltas.items():
+                total[tenant_id, currency] = total.get((tenant_id, currency), 0) + delta
+                customer = customers_by_tenant.get(tenant_id)
+                if dry_run:
+                    continue
+                account = customer.get_account(currency) if customer else None
+                if account is None:
+                    logbook.error("Account in {} for tenant {} not found. Balance is not changed by rerating: {}",
+                                  currency, tenant_id, delta)
+                    continue
+                account.charge(delta)
+                customer.check_balance(account, currency)
+
+        if dry_run:
+            for deltas in ServiceUsage.rerate(self.tariff_id, prices, start, finish, tenant_ids, chunk_size, True):
+                apply(deltas)
+        else:
+            if tenant_ids is None:
+                tenant_ids = ServiceUsage.rated_tenants(self.tariff_id, start, finish)
+            # usages of every tenant are read by a new transaction after its mutex is acquired
+            db.session.commit()
+            for tenant_id in tenant_ids:
+                mutex = TenantMutex(tenant_id)
+                mutex.acquire(blocking=True)
+                try:
+                    for deltas in ServiceUsage.rerate(self.tariff_id, prices, start, finish, [tenant_id],
+                                                      chunk_size):
+                        apply(deltas)
+                        try:
+                            db.session.commit()
+                        except Exception as e:
+                            raise RerateCommitFailed("Commit of rerated usage of tenant %s failed: %s" %
+                                                     (tenant_id, e))
+                except Exception:
+                    # not committed chunk is rolled back as a whole
+                    db.session.rollback()
+                    raise
+                finally:
+                    mutex.release()
+
+        result = []
+        for (tenant_id, currency), delta in sorted(total.items()):
+            customer = customers_by_tenant.get(tenant_id)
+            result.append({"customer_id": customer.customer_id if customer else None,
+                           "tenant_id": tenant_id,
+                           "currency": currency,
+                           "delta": delta})
+        logbook.info("Rerating of {} changed balances of {} accounts", self, len(result))
+        return result
+
     def service_price(self, service_id):
         service_id = str(service_id)
         sp = self.services_as_dict(lower=True).get(service_id.lower())
@@ -176,15 +363,25 @@ class Tariff(db.Model, AccountDb):
     def update_new_vm_services(self, services):
         current_services = self.services_as_dict()
         services_to_update = self.services_to_change()
+        changed = False
         for service in services:
             service_id = service['service_id']
             if service_id in services_to_update:
                 current_services[service_id].price = service['price']
                 current_services[service_id].need_changing = False
+                changed = True
+        if changed:
+            self.prices_changed()
+        TariffPriceIndex.invalidate(self.tariff_id)
 
     def update_services(self, services):
+        """ Replaces services of the tariff by the services.
+
+        :return: True if any price is changed or any service is added or removed
+        """
         current_services = self.services_as_dict()
         new_services = set()
+        changed = False
         for service in services:
             if isinstance(service, dict):
                 service_id = service["service_id"]
@@ -194,15 +391,21 @@ class Tariff(db.Model, AccountDb):
                 price = service.price
 
             if service_id in current_services:
+                if current_services[service_id].price is None or \
+                        Decimal(str(current_services[service_id].price)) != Decimal(str(price)):
+                    changed = True
                 current_services[service_id].price = price
             else:
                 self.services.append(ServicePrice(service_id, price))
+                changed = True
             new_services.add(service_id)
         removed_services = set(current_services.keys()) - new_services
         if removed_services:
             logbook.debug("Remove services {} from tariff {}", removed_services, self)
             for service_id in removed_services:
                 self.services.remove(current_services[service_id])
+            changed = True
+        return changed
 
     def display(self, short=True):
         res = super().display(short)
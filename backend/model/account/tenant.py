@@ -34,6 +34,12 @@ class Tenant(db.Model, AccountDb):
     def all_active_tenants(cls):
         return cls.query.filter_by(deleted=None)
 
+    @classmethod
+    def stale_tenants(cls, collected_before):
+        """ Returns active tenants which usage isn't collected till collected_before, the most behind are first
+        """
+        return cls.all_active_tenants().filter(cls.last_collected < collected_before).order_by(cls.last_collected)
+
     def mark_removed(self):
         logbook.info("Remove {} from db", self)
         self.deleted = utcnow().datetime
@@ -1,10 +1,117 @@
 # -*- coding: utf-8 -*-
 import conf
-from sqlalchemy import Column, DateTime, String, Integer, func, BigInteger, UniqueConstraint
+import logbook
+from sqlalchemy import Column, DateTime, String, Integer, func, BigInteger, UniqueConstraint, text
 from fitter.aggregation.timelabel import TimeLabel
 from model import db, FitterDb, Customer
 from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import timedelta
+from collections import Counter, OrderedDict, defaultdict
+
+
+def _add(total, value):
+    if total is None:
+        return value
+    if value is None:
+        return total
+    return total + value
+
+
+def _next_month_label(month_label):
+    year, month = int(month_label[:4]), int(month_label[4:6])
+    if month == 12:
+        return "%04d01" % (year + 1)
+    return "%04d%02d" % (year, month + 1)
+
+
+class UsageRollup(object):
+    """
+    Sums of cost and usage volume of ServiceUsage by tenant, service, tariff, currency and period.
+    time_label of the rollup is the prefix of ServiceUsage.time_label with label_length chars.
+    """
+    label_length = None
+
+    # NULLs never collide in unique key of MySQL, so usage without tariff or currency is summed up with these values
+    NO_TARIFF = 0
+    NO_CURRENCY = ""
+
+    rollup_id = Column(Integer, primary_key=True, autoincrement=True)
+    tenant_id = Column(String(100), nullable=False)
+    service_id = Column(String(100), nullable=False)
+    tariff_id = Column(Integer, nullable=False, default=NO_TARIFF)
+    currency = Column(db.String(3), nullable=False, default=NO_CURRENCY)
+    cost = Column(db.DECIMAL(precision=conf.backend.decimal.precision, scale=conf.backend.decimal.scale),
+                  nullable=False, default=0)
+    usage_volume = Column(BigInteger, nullable=False, default=0)
+
+    _key_columns = ("tenant_id", "service_id", "tariff_id", "currency", "time_label")
+
+    @classmethod
+    def _insert_statement(cls, values):
+        return "INSERT INTO `{table}` ({columns}, cost, usage_volume) {values} " \
+               "ON DUPLICATE KEY UPDATE `{table}`.cost = `{table}`.cost + VALUES(cost), " \
+               "`{table}`.usage_volume = `{table}`.usage_volume + VALUES(usage_volume)".format(
+                   table=cls.__table__.name, columns=", ".join(cls._key_columns), values=values)
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        Adds changes of usages to the rollup.
+
+        :param deltas: dict {(tenant_id, service_id, tariff_id, currency, time_label of usage): [cost, usage_volume]}
+        """
+        grouped = {}
+        for (tenant_id, service_id, tariff_id, currency, time_label), (cost, usage_volume) in deltas.items():
+            key = (tenant_id, service_id, cls.NO_TARIFF if tariff_id is None else tariff_id,
+                   currency or cls.NO_CURRENCY, time_label[:cls.label_length])
+            total = grouped.setdefault(key, [0, 0])
+            total[0] += cost
+            total[1] += usage_volume
+        rows = [dict(zip(cls._key_columns, key), cost=cost, usage_volume=usage_volume)
+                for key, (cost, usage_volume) in grouped.items() if cost or usage_volume]
+        if not rows:
+            return
+        values = "VALUES (%s, :cost, :usage_volume)" % ", ".join(":%s" % c for c in cls._key_columns)
+        db.session.execute(text(cls._insert_statement(values)), rows, mapper=cls)
+
+    @classmethod
+    def add_from_usage(cls, source, where, params, cost="u.cost", usage_volume="u.usage_volume"):
+        """
+        Adds sums of usages selected by one INSERT ... SELECT statement.
+
+        :param source: FROM clause where service_usage table is aliased as u
+        :param where: WHERE clause
+        :param cost: expression of the cost added to the rollup
+        :param usage_volume: expression of the usage volume added to the rollup
+        """
+        label = "LEFT(u.time_label, %s)" % cls.label_length
+        key = "u.tenant_id, u.service_id, COALESCE(u.tariff_id, %s), COALESCE(u.currency, '%s'), %s" % (
+            cls.NO_TARIFF, cls.NO_CURRENCY, label)
+        select = "SELECT {key}, COALESCE(SUM({cost}), 0), COALESCE(SUM({usage_volume}), 0) FROM {source} " \
+                 "WHERE {where} GROUP BY {key}".format(key=key, cost=cost, usage_volume=usage_volume, source=source,
+                                                     where=where)
+        db.session.execute(text(cls._insert_statement(select)), params, mapper=cls)
+
+    @classmethod
+    def nullable_key(cls, names, values):
+        """ Replaces NO_TARIFF and NO_CURRENCY in values of the columns by None as it is stored in ServiceUsage """
+        return tuple(None if (name == "tariff_id" and value == cls.NO_TARIFF) or
+                     (name == "currency" and value == cls.NO_CURRENCY) else value
+                     for name, value in zip(names, values))
+
+
+class ServiceUsageDay(db.Model, FitterDb, UsageRollup):
+    label_length = TimeLabel.day_label_length
+    time_label = Column(String(TimeLabel.day_label_length), nullable=False)
+
+    __table_args__ = (UniqueConstraint("tenant_id", "time_label", "service_id", "tariff_id", "currency"), )
+
+
+class ServiceUsageMonth(db.Model, FitterDb, UsageRollup):
+    label_length = TimeLabel.month_label_length
+    time_label = Column(String(TimeLabel.month_label_length), nullable=False)
+
+    __table_args__ = (UniqueConstraint("tenant_id", "time_label", "service_id", "tariff_id", "currency"), )
 
 
 class ServiceUsage(db.Model, FitterDb):
@@ -47,55 +154,306 @@ class ServiceUsage(db.Model, FitterDb):
     def __str__(self):
         return "<Usage {0.time_label} {0.tenant_id} {0.service_id} {0.resource_id} {0.currency} {0.volume} {0.length}>".format(self)
 
+    _bulk_columns = ("tenant_id", "service_id", "time_label", "resource_id", "resource_name", "volume", "start",
+                     "end", "tariff_id", "currency", "customer_mode", "cost", "usage_volume")
+    _bulk_unique_columns = ("tenant_id", "service_id", "time_label", "resource_id")
+    rollups = (ServiceUsageDay, ServiceUsageMonth)
+
     @hybrid_property
     def length(self):
         return self.end - self.start + timedelta(seconds=1)
 
     @classmethod
-    def get_usage(cls, customer, start, finish):
-        tenant_id = customer.os_tenant_id
+    def bulk_save(cls, usages):
+        """
+        Writes usages by one INSERT ... ON DUPLICATE KEY UPDATE statement, so already stored usages
+        for the same tenant, service, time label and resource are replaced. Rollups are updated by the difference.
+        Usages shouldn't be added to the session.
 
-        start_tl = TimeLabel(start).label
-        finish_tl = TimeLabel(finish).label
-        query = db.session.query(cls.service_id, cls.tariff_id, func.sum(cls.cost), func.sum(cls.usage_volume)).\
-            filter(cls.tenant_id == tenant_id, cls.time_label >= start_tl, cls.time_label < finish_tl)
-        query = query.group_by(cls.tariff_id, cls.service_id)
-        return query
+        :return: Counter of cost of the replaced usages by currency
+        """
+        if not usages:
+            return Counter()
+
+        keys = {tuple(getattr(usage, c) for c in cls._bulk_unique_columns) for usage in usages}
+        query = db.session.query(cls.tenant_id, cls.service_id, cls.time_label, cls.resource_id,
+                                 cls.tariff_id, cls.currency, cls.cost, cls.usage_volume).\
+            filter(cls.tenant_id.in_({usage.tenant_id for usage in usages}),
+                   cls.time_label.in_({usage.time_label for usage in usages}))
+        replaced = Counter()
+        rollup_deltas = {}
+        for tenant_id, service_id, time_label, resource_id, tariff_id, currency, cost, usage_volume in query:
+            if (tenant_id, service_id, time_label, resource_id) in keys:
+                if cost:
+                    replaced[currency] += cost
+                delta = rollup_deltas.setdefault((tenant_id, service_id, tariff_id, currency, time_label), [0, 0])
+                delta[0] -= cost or 0
+                delta[1] -= usage_volume or 0
+        for usage in usages:
+            delta = rollup_deltas.setdefault((usage.tenant_id, usage.service_id, usage.tariff_id, usage.currency,
+                                              usage.time_label), [0, 0])
+            delta[0] += usage.cost or 0
+            delta[1] += usage.usage_volume or 0
+
+        table = cls.__table__.name
+        updated = [c for c in cls._bulk_columns if c not in cls._bulk_unique_columns]
+        statement = text("INSERT INTO `{table}` ({columns}) VALUES ({values}) ON DUPLICATE KEY UPDATE {update}".format(
+            table=table,
+            columns=", ".join("`%s`" % c for c in cls._bulk_columns),
+            values=", ".join(":%s" % c for c in cls._bulk_columns),
+            update=", ".join("`{0}` = VALUES(`{0}`)".format(c) for c in updated)))
+        rows = [{c: getattr(usage, c) for c in cls._bulk_columns} for usage in usages]
+        db.session.execute(statement, rows, mapper=cls)
+        for rollup in cls.rollups:
+            rollup.add(rollup_deltas)
+        return replaced
+
+    @classmethod
+    def rerate(cls, tariff_id, prices, start, finish, tenant_ids=None, chunk_size=None, dry_run=False):
+        """
+        Recalculates cost of usages rated by the tariff using set based statements.
+        Prices are joined as a derived table, because service_price is stored in the account database.
+        Usages are processed by ranges of service_usage_id with chunk_size rows at most.
+
+        :param prices: list of (service_id, price, hours)
+        :return: generator which yields dict {(tenant_id, currency): cost delta} for every processed chunk
+        """
+        if not prices:
+            return
+        chunk_size = chunk_size or conf.tariff.rerating.chunk_size
+        table = cls.__table__.name
+        params = {"tariff_id": tariff_id,
+                  "start": TimeLabel(start).label,
+                  "finish": TimeLabel(finish).label}
+
+        price_rows = []
+        for n, (service_id, price, hours) in enumerate(prices):
+            params.update({"service%s" % n: service_id, "price%s" % n: price, "hours%s" % n: hours})
+            price_rows.append("SELECT :service{0} AS service_id, :price{0} AS price, :hours{0} AS hours".format(n))
+
+        conditions = ["u.tariff_id = :tariff_id", "u.time_label >= :start", "u.time_label < :finish"]
+        if tenant_ids is not None:
+            if not tenant_ids:
+                return
+            for n, tenant_id in enumerate(tenant_ids):
+                params["tenant%s" % n] = tenant_id
+            conditions.append("u.tenant_id IN (%s)" % ", ".join(":tenant%s" % n for n in range(len(tenant_ids))))
+        where = " AND ".join(conditions)
+
+        id_range = "SELECT MIN(u.service_usage_id), MAX(u.service_usage_id) FROM `{table}` u WHERE {where}"
+        first_id, last_id = db.session.execute(text(id_range.format(table=table, where=where)),
+                                               params, mapper=cls).first()
+        if first_id is None:
+            return
+
+        cost = "CAST(u.usage_volume * p.price / p.hours AS DECIMAL({precision}, {scale}))".format(
+            precision=conf.backend.decimal.precision, scale=conf.backend.decimal.scale)
+        source = "`{table}` u JOIN ({prices}) p ON u.service_id = p.service_id".format(
+            table=table, prices=" UNION ALL ".join(price_rows))
+        where += " AND u.service_usage_id >= :first AND u.service_usage_id < :last"
+        delta_statement = text("SELECT u.tenant_id, u.currency, SUM({cost} - COALESCE(u.cost, 0)) FROM {source} "
+                               "WHERE {where} GROUP BY u.tenant_id, u.currency".format(cost=cost, source=source,
+                                                                                      where=where))
+        update_statement = text("UPDATE {source} SET u.cost = {cost} WHERE {where}".format(source=source, cost=cost,
+                                                                                          where=where))
+
+        for chunk_start in range(first_id, last_id + 1, chunk_size):
+            params["first"] = chunk_start
+            params["last"] = chunk_start + chunk_size
+            deltas = {(tenant_id, currency): delta
+                      for tenant_id, currency, delta in db.session.execute(delta_statement, params, mapper=cls)
+                      if delta}
+            if deltas and not dry_run:
+                for rollup in cls.rollups:
+                    rollup.add_from_usage(source, where, params, cost="%s - COALESCE(u.cost, 0)" % cost,
+                                          usage_volume="0")
+                db.session.execute(update_statement, params, mapper=cls)
+            yield deltas
+
+    @classmethod
+    def rated_tenants(cls, tariff_id, start, finish):
+        """ Returns ids of tenants which have usages rated by the tariff between start and finish """
+        query = db.session.query(cls.tenant_id).distinct().\
+            filter(cls.tariff_id == tariff_id, cls.time_label >= TimeLabel(start).label,
+                   cls.time_label < TimeLabel(finish).label)
+        return sorted(tenant_id for tenant_id, in query)
+
+    @staticmethod
+    def rollup_ranges(start_label, finish_label):
+        """
+        Splits range of hour time labels to ranges of rollup time labels.
+
+        :return: list of (rollup model, first time label, last time label) or None if range is not aligned by days
+        """
+        if not start_label.endswith("00") or not finish_label.endswith("00"):
+            return None
+        start_day = start_label[:TimeLabel.day_label_length]
+        finish_day = finish_label[:TimeLabel.day_label_length]
+        first_month = start_day[:TimeLabel.month_label_length]
+        if not start_day.endswith("01"):
+            first_month = _next_month_label(first_month)
+        last_month = finish_day[:TimeLabel.month_label_length]
+        if first_month >= last_month:
+            return [(ServiceUsageDay, start_day, finish_day)]
+
+        ranges = [(ServiceUsageMonth, first_month, last_month)]
+        if start_day < first_month + "01":
+            ranges.append((ServiceUsageDay, start_day, first_month + "01"))
+        if last_month + "01" < finish_day:
+            ranges.append((ServiceUsageDay, last_month + "01", finish_day))
+        return ranges
+
+    @classmethod
+    def aggregate(cls, tenant_id, start, finish, *group_by):
+        """
+        Sums cost and usage volume of the tenant usages between start and finish grouped by the columns.
+        Rollups are used if start and finish are day boundaries.
+
+        :return: list of tuples with values of group_by columns, sum of cost and sum of usage volume
+        """
+        return [key + value for key, value in cls._sums(start, finish, group_by, tenant_id).items()]
+
+    @classmethod
+    def aggregate_all(cls, start, finish, *group_by):
+        """
+        Sums cost and usage volume of usages of all tenants between start and finish grouped by tenant and the columns.
+        Unlike aggregate for every tenant, it runs one grouped query per rollup range (three at most).
+
+        :return: dict tenant_id -> list of tuples with values of group_by columns, sum of cost and sum of usage volume
+        """
+        result = defaultdict(list)
+        for key, value in cls._sums(start, finish, ("tenant_id", ) + group_by).items():
+            result[key[0]].append(key[1:] + value)
+        return result
+
+    @classmethod
+    def _sums(cls, start, finish, group_by, tenant_id=None):
+        """
+        :return: OrderedDict {tuple with values of group_by columns: (sum of cost, sum of usage volume)}
+        """
+        start_label = TimeLabel(start).label
+        finish_label = TimeLabel(finish).label
+        ranges = cls.rollup_ranges(start_label, finish_label) if conf.report.usage_rollups else None
+        if ranges is None:
+            ranges = [(cls, start_label, finish_label)]
+
+        result = OrderedDict()
+        for model, first, last in ranges:
+            columns = [getattr(model, name) for name in group_by]
+            query = db.session.query(*(columns + [func.sum(model.cost), func.sum(model.usage_volume)])).\
+                filter(model.time_label >= first, model.time_label < last).\
+                group_by(*columns)
+            if tenant_id is not None:
+                query = query.filter(model.tenant_id == tenant_id)
+            for row in query:
+                key = tuple(row[:-2])
+                if model is not cls:
+                    key = model.nullable_key(group_by, key)
+                cost, usage_volume = result.get(key, (None, None))
+                result[key] = (_add(cost, row[-2]), _add(usage_volume, row[-1]))
+        return result
+
+    @classmethod
+    def get_usage(cls, customer, start, finish):
+        return cls.aggregate(customer.os_tenant_id, start, finish, "service_id", "tariff_id")
 
     @classmethod
     def get_detailed_usage(cls, customer, start, finish):
+        """
+        Returns only columns required for detailed report ordered by resource and time label.
+        Rows are read from the server by batches of conf.report.detailed_batch_size.
+        """
         tenant_id = customer.os_tenant_id
 
         start_tl = TimeLabel(start).label
         finish_tl = TimeLabel(finish).label
-        query = cls.query.filter(cls.tenant_id == tenant_id, cls.time_label >= start_tl, cls.time_label < finish_tl)
-        return query
+        query = db.session.query(cls.tariff_id, cls.service_id, cls.resource_id, cls.resource_name, cls.time_label,
+                                 cls.usage_volume, cls.cost, cls.start, cls.end).\
+            filter(cls.tenant_id == tenant_id, cls.time_label >= start_tl, cls.time_label < finish_tl).\
+            order_by(cls.tariff_id, cls.service_id, cls.resource_id, cls.time_label)
+        return query.yield_per(conf.report.detailed_batch_size)
 
     @classmethod
     def get_withdraw(cls, customer, start, finish):
-        start_tl = TimeLabel(start).label
-        finish_tl = TimeLabel(finish).label
-        query = db.session.query(cls.currency, func.sum(cls.cost)).\
-            filter(cls.tenant_id == customer.os_tenant_id, cls.time_label >= start_tl, cls.time_label < finish_tl)
-        query = query.group_by(cls.currency)
-        return dict(query)
+        return {currency: cost for currency, cost, _ in cls.aggregate(customer.os_tenant_id, start, finish,
+                                                                        "currency")}
+
+    @classmethod
+    def remove_from_rollups(cls, tenant_id, time_end):
+        """
+        Subtracts usages of the tenant which are finished before time_end from rollups. It should be called before
+        the usages are deleted.
+        """
+        for rollup in cls.rollups:
+            rollup.add_from_usage("`%s` u" % cls.__table__.name, "u.tenant_id = :tenant_id AND u.end <= :time_end",
+                                  {"tenant_id": tenant_id, "time_end": time_end},
+                                  cost="-u.cost", usage_volume="-u.usage_volume")
+
+    @classmethod
+    def rebuild_rollups(cls, start=None, finish=None):
+        """
+        Recalculates rollups from usages month by month. Rollups of every tenant are rebuilt and committed
+        under its TenantMutex, so deltas which the fitter adds meanwhile are neither lost nor counted twice.
+
+        :return: number of rebuilt months
+        """
+        from fitter.aggregation.collector import TenantMutex
+
+        query = db.session.query(func.min(cls.time_label), func.max(cls.time_label))
+        if start:
+            query = query.filter(cls.time_label >= TimeLabel(start).label)
+        if finish:
+            query = query.filter(cls.time_label < TimeLabel(finish).label)
+        first_label, last_label = query.one()
+        if first_label is None:
+            return 0
+
+        month = first_label[:TimeLabel.month_label_length]
+        last_month = last_label[:TimeLabel.month_label_length]
+        months = 0
+        while month <= last_month:
+            next_month = _next_month_label(month)
+            params = {"first": month + "0100", "last": next_month + "0100"}
+            tenant_ids = {tenant_id for tenant_id, in db.session.query(cls.tenant_id).distinct().
+                          filter(cls.time_label >= params["first"], cls.time_label < params["last"])}
+            tenant_ids.update(tenant_id for tenant_id, in db.session.query(ServiceUsageMonth.tenant_id).distinct().
+                              filter(ServiceUsageMonth.time_label == month))
+            db.session.commit()
+            for tenant_id in sorted(tenant_ids):
+                mutex = TenantMutex(tenant_id)
+                mutex.acquire(blocking=True)
+                try:
+                    ServiceUsageDay.query.filter(ServiceUsageDay.tenant_id == tenant_id,
+                                                 ServiceUsageDay.time_label >= month + "01",
+                                                 ServiceUsageDay.time_label < next_month + "01").delete(False)
+                    ServiceUsageMonth.query.filter(ServiceUsageMonth.tenant_id == tenant_id,
+                                                   ServiceUsageMonth.time_label == month).delete(False)
+                    for rollup in cls.rollups:
+                        rollup.add_from_usage("`%s` u" % cls.__table__.name,
+                                              "u.tenant_id = :tenant_id AND u.time_label >= :first AND "
+                                              "u.time_label < :last", dict(params, tenant_id=tenant_id))
+                    db.session.commit()
+                finally:
+                    mutex.release()
+            logbook.info("Usage rollups for {} are rebuilt for {} tenants", month, len(tenant_ids))
+            months += 1
+            month = next_month
+        return months
 
     @classmethod
     def customers_get_usage(cls, start, finish):
+        """
+        Returns withdraw of active customers between start and finish. Usage of all customers is summed by
+        aggregate_all, so number of queries doesn't depend on number of customers.
+
+        :return: generator of (customer, list of (currency, cost)) ordered by customer_id
+        """
         from model import Customer
-        start_tl = TimeLabel(start).label
-        finish_tl = TimeLabel(finish).label
         deleted_gap = timedelta(seconds=conf.report.deleted_gap)
         active_customers = Customer.query.filter((Customer.deleted == None) |
-                                                 (Customer.deleted < start -  deleted_gap))
+                                                 (Customer.deleted < start -  deleted_gap)).\
+            filter(Customer.os_tenant_id != None).order_by(Customer.customer_id)
 
-        result = {}
+        usage_by_tenant = cls.aggregate_all(start, finish, "currency")
         for customer in active_customers:
-            if customer.os_tenant_id:
-                query = db.session.query(cls.currency, func.sum(cls.cost)).\
-                    filter(cls.tenant_id == customer.os_tenant_id,
-                           cls.time_label >= start_tl, cls.time_label < finish_tl)
-                query = query.group_by(cls.currency)
-                result[customer] = query.all()
-        return result
-
+            yield customer, [(currency, cost) for currency, cost, _ in usage_by_tenant.get(customer.os_tenant_id, [])]
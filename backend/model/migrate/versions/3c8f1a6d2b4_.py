@@ -0,0 +1,56 @@
+"""Added balance forecasts
+
+Forecasts are computed by the daily task check_customers_for_balance.
+
+Revision ID: 3c8f1a6d2b4
+Revises: 5a1f3c9d2e7
+Create Date: 2016-02-10 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c8f1a6d2b4'
+down_revision = '5a1f3c9d2e7'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+
+
+
+def upgrade_account():
+    op.create_table('balance_forecast',
+    sa.Column('customer_id', sa.Integer(), nullable=False),
+    sa.Column('currency', sa.String(length=3), nullable=True),
+    sa.Column('day_withdraw', sa.DECIMAL(precision=28, scale=20), nullable=True),
+    sa.Column('available', sa.DECIMAL(precision=28, scale=20), nullable=True),
+    sa.Column('days_left', sa.Float(), nullable=True),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['customer_id'], ['customer.customer_id'], ),
+    sa.PrimaryKeyConstraint('customer_id')
+    )
+    op.create_index(op.f('ix_balance_forecast_days_left'), 'balance_forecast', ['days_left'], unique=False)
+
+
+def downgrade_account():
+    op.drop_index(op.f('ix_balance_forecast_days_left'), table_name='balance_forecast')
+    op.drop_table('balance_forecast')
+
+
+def upgrade_fitter():
+    pass
+
+
+def downgrade_fitter():
+    pass
@@ -0,0 +1,58 @@
+"""Added daily and monthly usage rollups
+
+Existing usage should be summed up to the rollups by 'bossmngr rebuild_rollups' after the upgrade.
+
+Revision ID: 5a1f3c9d2e7
+Revises: 41b6fb3ddef
+Create Date: 2016-02-01 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a1f3c9d2e7'
+down_revision = '41b6fb3ddef'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+
+
+
+def upgrade_account():
+    pass
+
+
+def downgrade_account():
+    pass
+
+
+def upgrade_fitter():
+    for table, label_length in (('service_usage_day', 8), ('service_usage_month', 6)):
+        op.create_table(table,
+        sa.Column('rollup_id', sa.Integer(), nullable=False),
+        sa.Column('tenant_id', sa.String(length=100), nullable=False),
+        sa.Column('service_id', sa.String(length=100), nullable=False),
+        sa.Column('tariff_id', sa.Integer(), nullable=False),
+        sa.Column('currency', sa.String(length=3), nullable=False),
+        sa.Column('cost', sa.DECIMAL(precision=28, scale=20), nullable=False),
+        sa.Column('usage_volume', sa.BigInteger(), nullable=False),
+        sa.Column('time_label', sa.String(length=label_length), nullable=False),
+        sa.PrimaryKeyConstraint('rollup_id'),
+        sa.UniqueConstraint('tenant_id', 'time_label', 'service_id', 'tariff_id', 'currency')
+        )
+
+
+def downgrade_fitter():
+    op.drop_table('service_usage_month')
+    op.drop_table('service_usage_day')
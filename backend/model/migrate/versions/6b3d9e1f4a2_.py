@@ -0,0 +1,45 @@
+"""Added revision of tariff prices
+
+Price indexes of tariffs are rebuilt by all processes when the revision is changed.
+
+Revision ID: 6b3d9e1f4a2
+Revises: 3c8f1a6d2b4
+Create Date: 2016-02-15 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b3d9e1f4a2'
+down_revision = '3c8f1a6d2b4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+
+
+
+def upgrade_account():
+    op.add_column('tariff', sa.Column('revision', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade_account():
+    op.drop_column('tariff', 'revision')
+
+
+def upgrade_fitter():
+    pass
+
+
+def downgrade_fitter():
+    pass
@@ -823,7 +823,11 @@ class OpenStackWrapper(OpenStackAuth):
 
     def get_tenant_usage(self, tenant_id, meter_name, start, end, limit=None):
         """ Queries ceilometer for all the entries in a given range,
-           for a given meter, from this tenant."""
+           for a given meter, from this tenant.
+
+           If limit is not set, the samples are fetched by pages of
+           fitter.collection.sample_page_size entries, so a range of many hours
+           can be requested at once."""
 
         query = [self.filter('timestamp', 'ge', start), self.filter('timestamp', 'lt', end)]
 
@@ -834,11 +838,63 @@ class OpenStackWrapper(OpenStackAuth):
             query.append(self.filter('meter', 'eq', meter_name))
 
         with timed('fetch global usage for meter %s' % meter_name):
-            result = openstack.client_ceilometer.new_samples.list(q=query, limit=limit)
+            if limit:
+                result = openstack.client_ceilometer.new_samples.list(q=query, limit=limit)
+            else:
+                result = self._get_samples_paginated(query, conf.fitter.collection.sample_page_size)
             log.debug("Get usage for tenant: {} and meter_name {} ({} - {}). Number records: {}",
                       tenant_id, meter_name, start, end, len(result))
             return result
 
+    def get_tenant_statistics(self, tenant_id, meter_name, start, end, period, source=None):
+        """ Queries ceilometer for statistics (max, sum, duration, etc) of the meter of this tenant
+           computed for every resource and every period from start till end."""
+
+        query = [self.filter('timestamp', 'ge', start), self.filter('timestamp', 'lt', end),
+                 self.filter('project_id', 'eq', tenant_id)]
+        if source:
+            query.append(self.filter('source', 'eq', source))
+
+        with timed('fetch statistics for meter %s' % meter_name):
+            result = openstack.client_ceilometer.statistics.list(meter_name, q=query, period=period,
+                                                                  groupby=["resource_id"])
+            log.debug("Get statistics for tenant: {} and meter_name {} ({} - {}). Number records: {}",
+                      tenant_id, meter_name, start, end, len(result))
+            return result
+
+    def get_tenant_resources(self, tenant_id):
+        """ Returns the last known metadata of resources of the tenant by resource id """
+        with timed('fetch resources of tenant %s' % tenant_id):
+            resources = openstack.client_ceilometer.resources.list(q=[self.filter('project_id', 'eq', tenant_id)])
+        return {resource.resource_id: resource.metadata for resource in resources}
+
+    @staticmethod
+    def _sample_id(sample):
+        return getattr(sample, "id", None) or getattr(sample, "message_id", None)
+
+    def _get_samples_paginated(self, query, page_size):
+        # Ceilometer returns the newest samples first and doesn't support markers for samples,
+        # so the next page is requested with the upper bound moved to the oldest received timestamp.
+        # Samples with the boundary timestamp are received twice and are deduplicated by id.
+        result = []
+        seen = set()
+        base_query = [q for q in query if not (q["field"] == "timestamp" and q["op"] == "lt")]
+        page_query = query
+        while True:
+            page = openstack.client_ceilometer.new_samples.list(q=page_query, limit=page_size)
+            new_samples = [sample for sample in page if self._sample_id(sample) not in seen]
+            result.extend(new_samples)
+            seen.update(self._sample_id(sample) for sample in new_samples)
+            if len(page) < page_size:
+                break
+            if not new_samples:
+                log.warning("More than {} samples have the same timestamp for query {}. Some of them are skipped",
+                            page_size, query)
+                break
+            oldest = min(sample.timestamp for sample in page)
+            page_query = base_query + [self.filter('timestamp', 'le', oldest)]
+        return result
+
     def create_user_role(self, role_name):
         role = self.client_keystone.roles.create(role_name)
         return role
@@ -74,6 +74,11 @@ class Report:
         f = LocaleFormatter(report_id.locale)
         return r.render(aggregated, self.report_type, report_id.locale, money=f.money)
 
+    def render_chunks(self, aggregated, report_id):
+        r = Render.get_render(report_id.report_format)
+        f = LocaleFormatter(report_id.locale)
+        return r.render_chunks(aggregated, self.report_type, report_id.locale, money=f.money)
+
     @staticmethod
     def generate_file_name(customer_name, start, end, report_format, locale=None):
         customer_name = customer_name or ""
@@ -1,6 +1,7 @@
 from collections import namedtuple
 from io import StringIO
 import codecs
+import conf
 import csv
 import re
 
@@ -13,10 +14,6 @@ class CSVRender(Render):
     output_format = "csv"
     money_pattern = re.compile(r"\d+\.\d\d")
 
-    def __init__(self, template_dir=None):
-        super().__init__(template_dir)
-        self.writer = None
-
     @staticmethod
     def linear(aggregated):
         for tariff in aggregated["tariffs"]:
@@ -32,15 +29,37 @@ class CSVRender(Render):
 
         return money
 
-    def encode(self, csvfile, locale):
-        encoding = "cp1251" if locale and locale.startswith("ru") else "ascii"
-        return csvfile.getvalue().encode(encoding)
+    # noinspection PyMethodMayBeStatic
+    def encoding(self, locale):
+        return "cp1251" if locale and locale.startswith("ru") else "ascii"
+
+    # noinspection PyMethodMayBeStatic
+    def prefix(self):
+        return b""
 
     def _render(self, aggregated, configuration, locale, language, **kwargs):
+        return b"".join(self._render_chunks(aggregated, configuration, locale, language, **kwargs))
+
+    def _render_chunks(self, aggregated, configuration, locale, language, **kwargs):
+        """ Writes rows of the report to a small buffer and yields it encoded every conf.report.chunk_size chars
+        """
         render = configuration["render"]
-        render_method = getattr(self, render)
-        rendered = render_method(aggregated, configuration, locale, language, **kwargs)
-        return self.encode(rendered, locale)
+        rows = getattr(self, render)(aggregated, configuration, locale, language, **kwargs)
+        encoding = self.encoding(locale)
+        csvfile = StringIO()
+        writer = self.get_writer(csvfile, locale)
+
+        prefix = self.prefix()
+        if prefix:
+            yield prefix
+        for row in rows:
+            writer.writerow(row)
+            if csvfile.tell() >= conf.report.chunk_size:
+                yield csvfile.getvalue().encode(encoding)
+                csvfile.seek(0)
+                csvfile.truncate()
+        if csvfile.tell():
+            yield csvfile.getvalue().encode(encoding)
 
     def get_writer(self, csvfile, locale):
         delimiter = ";" if locale.startswith("ru") else ","
@@ -49,16 +68,14 @@ class CSVRender(Render):
     def detailed(self, aggregated, configuration, locale, language, **kwargs):
         formatter = LocaleFormatter(locale)
 
-        csvfile = StringIO()
         customer = aggregated["customer"]
         report_range = aggregated["report_range"]
-        self.writer = self.get_writer(csvfile, locale)
 
-        self.writer.writerow(("Customer name", "Start", "Finish"))
-        self.writer.writerow((customer["name"] or customer["email"],
-                              formatter.datetime(report_range["start"]),
-                              formatter.datetime(report_range["finish"])))
-        self.writer.writerow([])
+        yield ("Customer name", "Start", "Finish")
+        yield (customer["name"] or customer["email"],
+               formatter.datetime(report_range["start"]),
+               formatter.datetime(report_range["finish"]))
+        yield []
 
         headers = configuration['headers']
 
@@ -75,11 +92,11 @@ class CSVRender(Render):
 
         if aggregated.get('tariffs'):
             for tariff in aggregated['tariffs']:
-                self.writer.writerow([])
-                self.writer.writerow(('Tariff', 'Tariff currency'))
-                self.writer.writerow((tariff['name'], tariff['currency']))
+                yield []
+                yield ('Tariff', 'Tariff currency')
+                yield (tariff['name'], tariff['currency'])
 
-                self.writer.writerow(list(headers.values()))
+                yield list(headers.values())
                 for service in tariff['usage']:
                     for resource_id, resource_data in service['resources'].items():
                         for interval in resource_data['intervals']:
@@ -93,51 +110,37 @@ class CSVRender(Render):
                                         interval['time_usage'],
                                         interval['volume'],
                                         self.format_money(interval['total_cost'], locale))
-                            row = [getattr(s, h) for h in headers]
-                            self.writer.writerow(row)
-                self.writer.writerow(("Tariff total: ", tariff['total_cost']))
-        return csvfile
+                            yield [getattr(s, h) for h in headers]
+                yield ("Tariff total: ", tariff['total_cost'])
 
     def simple(self, aggregated, configuration, locale, language, **kwargs):
         formatter = LocaleFormatter(locale)
 
-        csvfile = StringIO()
         customer = aggregated["customer"]
         report_range = aggregated["report_range"]
-        self.writer = self.get_writer(csvfile, locale)
-        self.writer.writerow(("Customer name", customer["name"] or customer["email"]))
-        self.writer.writerow(("Start: ", formatter.datetime(report_range["start"])))
-        self.writer.writerow(("Finish: ", formatter.datetime(report_range["finish"])))
-        self.writer.writerow([])
+        yield ("Customer name", customer["name"] or customer["email"])
+        yield ("Start: ", formatter.datetime(report_range["start"]))
+        yield ("Finish: ", formatter.datetime(report_range["finish"]))
+        yield []
 
         header = configuration["headers"]
-        self.writer.writerow(list(header.values()))
+        yield list(header.values())
         for usage in self.linear(aggregated):
-            self.writer.writerow([self.format_money(usage[h], locale) for h in header])
-
-        return csvfile
+            yield [self.format_money(usage[h], locale) for h in header]
 
+    # noinspection PyMethodMayBeStatic
     def receipts(self, aggregated, configuration, locale, language, **kwargs):
-        csvfile = StringIO()
-        self.writer = self.get_writer(csvfile, locale)
-
         header = configuration["headers"]
-        self.writer.writerow(list(header.values()))
+        yield list(header.values())
         for row in aggregated:
-            self.writer.writerow([row[h] for h in header])
-
-        return csvfile
+            yield [row[h] for h in header]
 
+    # noinspection PyMethodMayBeStatic
     def usage(self, aggregated, configuration, locale, language, **kwargs):
-        csvfile = StringIO()
-        self.writer = self.get_writer(csvfile, locale)
-
         header = configuration["headers"]
-        self.writer.writerow(list(header.values()))
+        yield list(header.values())
         for row in aggregated:
-            self.writer.writerow([row[h] for h in header])
-
-        return csvfile
+            yield [row[h] for h in header]
 
 
 class TSVRender(CSVRender):
@@ -146,8 +149,11 @@ class TSVRender(CSVRender):
     def get_writer(self, csvfile, locale):
         return csv.writer(csvfile, dialect='excel-tab')
 
-    def encode(self, csvfile, locale):
-        return codecs.BOM_UTF16_LE + csvfile.getvalue().encode("utf-16le")
+    def encoding(self, locale):
+        return "utf-16le"
+
+    def prefix(self):
+        return codecs.BOM_UTF16_LE
 
     def config_format(self):
         return "csv"
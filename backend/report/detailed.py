@@ -6,7 +6,6 @@ from report.simple import TariffReport as _TariffReport, ServiceReport as Simple
 from collections import Counter
 from utils import cached_property, timed
 from utils.money import decimal_to_string
-from operator import attrgetter
 from decimal import Decimal
 
 
@@ -30,36 +29,18 @@ class ResourceUsageBase(Serialized):
 
 
 class ResourceUsageTime(ResourceUsageBase):
-    def __init__(self, time_label):
-        super().__init__(time_label)
-        self.time_labels = {time_label.label}
-
     def add_usage(self, time_label, usage):
-        if self.volume is not None:
-            raise Exception("Add usage should be called only once")
-        self.volume = usage.usage_volume
-
-        self.time_labels.add(time_label.label)
-        self.min_time_label = min(time_label, self.min_time_label)
-        self.max_time_label = max(time_label, self.max_time_label)
+        if self.volume is None:
+            self.volume = usage.usage_volume
 
+        self.max_time_label = time_label
         self.total_usage_volume += usage.usage_volume or 0
-        self.total_cost += usage.cost
+        self.total_cost += usage.cost or Decimal(0)
         self.time_usage += (usage.end - usage.start).total_seconds() + 1
 
-    def merge(self, other):
-        if self.volume != other.volume:
-            return False
-
-        assert not (self.time_labels & other.time_labels)
-        self.time_labels.union(other.time_labels)
-        self.total_cost += other.total_cost
-        self.time_usage += other.time_usage
-        self.total_usage_volume += other.total_usage_volume
-
-        self.min_time_label = min(other.min_time_label, self.min_time_label)
-        self.max_time_label = max(other.max_time_label, self.max_time_label)
-        return True
+    def continued_by(self, time_label, usage):
+        return self.volume == usage.usage_volume and \
+            time_label.timestamp == self.max_time_label.timestamp + TimeLabel.HOUR
 
 
 class ResourceUsageQuantity(ResourceUsageBase):
@@ -69,9 +50,14 @@ class ResourceUsageQuantity(ResourceUsageBase):
 
     # noinspection PyUnusedLocal
     def add_usage(self, time_label, usage):
+        self.max_time_label = time_label
         self.total_usage_volume += usage.usage_volume or 0
         self.total_cost += usage.cost or Decimal(0)
 
+    # noinspection PyUnusedLocal,PyMethodMayBeStatic
+    def continued_by(self, time_label, usage):
+        return False
+
 
 class ResourceReport(Serialized):
     json_fields = ["total_usage_volume", "total_cost", "intervals", "resource_name"]
@@ -79,69 +65,42 @@ class ResourceReport(Serialized):
     def __init__(self, resource_id, resource_name, service):
         self.resource_id = resource_id
         self.resource_name = resource_name
-        self.time_labels = {}
+        self.intervals = []
         self.total_cost = Decimal(0)
         self.total_usage_volume = 0
         self.service = service
+        measure_type = service.measure.measure_type if service else Measure.QUANTITATIVE
+        self.resource_usage_class = ResourceUsageQuantity if measure_type == Measure.QUANTITATIVE \
+            else ResourceUsageTime
 
     def __str__(self):
         return "<ResourceReport %s %s %s cost: %s, volume: %s>" % (
-            self.service.service_id, self.resource_id, self.resource_name, self.total_cost, self.total_usage_volume)
+            self.service.service_id if self.service else None, self.resource_id, self.resource_name,
+            self.total_cost, self.total_usage_volume)
 
     def __repr__(self):
         return str(self)
 
     def add_usage(self, usage):
-        time_label = TimeLabel.from_str(usage.time_label)
-        current_data = self.time_labels.get(time_label.label)
-
-        if current_data:
+        """
+        Usages should be added in order of time labels, so an hour can be merged only with the last interval.
+        """
+        last = self.intervals[-1] if self.intervals else None
+        if last is not None and last.max_time_label.label == usage.time_label:
             logbook.error("At least two records for resource {} and time_label: {}. "
                           "Usages will be summarized. Usage: {}",
-                          self.resource_id, time_label, usage)
+                          self.resource_id, usage.time_label, usage)
             return
 
-        measure_type = self.service.measure.measure_type if self.service else Measure.QUANTITATIVE
-        quantitative_service = measure_type == Measure.QUANTITATIVE
-        resource_usage_class = ResourceUsageQuantity if quantitative_service else ResourceUsageTime
-        resource_usage = resource_usage_class(time_label)
-        self.time_labels[time_label.label] = resource_usage
-        resource_usage.add_usage(time_label, usage)
-        if not quantitative_service:
-            self.merge_with_neighbor(time_label, resource_usage)
+        time_label = TimeLabel.from_label(usage.time_label)
+        if last is None or not last.continued_by(time_label, usage):
+            last = self.resource_usage_class(time_label)
+            self.intervals.append(last)
+        last.add_usage(time_label, usage)
 
         self.total_cost += usage.cost or Decimal(0)
         self.total_usage_volume += usage.usage_volume or 0
 
-    @property
-    def intervals(self):
-        unique = set(self.time_labels.values())
-        return sorted(unique, key=attrgetter("start"))
-
-    def merge_with_neighbor(self, time_label, object_usage):
-        previous_label = time_label.previous().label
-        previous_usage = self.time_labels.get(previous_label)
-
-        if previous_usage and previous_usage.merge(object_usage):
-            self.time_labels[time_label.label] = previous_usage
-            previous_merged = True
-        else:
-            previous_merged = False
-
-        next_label = time_label.next().label
-        next_usage = self.time_labels.get(next_label)
-        if not next_usage:
-            return
-
-        if previous_merged:
-            if previous_usage.merge(next_usage):
-                self.time_labels[next_label] = previous_usage
-                # previous + current + next are merged
-                return
-
-        if next_usage.merge(object_usage):
-            self.time_labels[time_label.label] = next_usage
-
 
 class DetailedServiceReport(SimpleServiceReport):
     json_fields = ["total_usage_volume", "price", "measure", "total_cost", "name", "category",
@@ -233,19 +192,17 @@ class DetailedReport(CustomerReport):
         if not customer:
             raise Exception("Customer %s not found" % report_id.customer_id)
 
-        with timed("get_usage simple"):
-            aggregated_usage = ServiceUsage.get_detailed_usage(customer, report_id.start, report_id.end)
-
         tariffs = {}
         services = set()
-        for usage in aggregated_usage:
-            tariff = Tariff.get_by_id(usage.tariff_id)
-            tariff_report = tariffs.get(usage.tariff_id)
-            if tariff_report is None:
-                tariff_report = self.tariff_report_type(tariff, customer)
-                tariffs[usage.tariff_id] = tariff_report
-
-            tariff_report.add_usage(usage)
+        with timed("get_usage detailed"):
+            for usage in ServiceUsage.get_detailed_usage(customer, report_id.start, report_id.end):
+                tariff_report = tariffs.get(usage.tariff_id)
+                if tariff_report is None:
+                    tariff = Tariff.get_by_id(usage.tariff_id)
+                    tariff_report = self.tariff_report_type(tariff, customer)
+                    tariffs[usage.tariff_id] = tariff_report
+
+                tariff_report.add_usage(usage)
 
         total = Counter()
         for tariff_id, tariff in tariffs.items():
@@ -99,7 +99,19 @@ class Render(object):
     def _render(self, aggregated, configuration, locale, language, **kwargs):
         raise NotImplementedError()
 
+    def _render_chunks(self, aggregated, configuration, locale, language, **kwargs):
+        yield self._render(aggregated, configuration, locale, language, **kwargs)
+
     def render(self, aggregated, report_type, locale, **kwargs):
         logbook.info("Rendering {} and locale {}", report_type, locale)
         configuration = self.get_configuration(report_type, locale)
         return self._render(aggregated, configuration, locale=locale, language=language_from_locale(locale), **kwargs)
+
+    def render_chunks(self, aggregated, report_type, locale, **kwargs):
+        """ Returns iterator over encoded parts of the report.
+        Formats which can't be rendered by parts return the whole report as one part.
+        """
+        logbook.info("Rendering by chunks {} and locale {}", report_type, locale)
+        configuration = self.get_configuration(report_type, locale)
+        return self._render_chunks(aggregated, configuration, locale=locale, language=language_from_locale(locale),
+                                   **kwargs)
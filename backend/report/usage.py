@@ -11,7 +11,7 @@ class UsageReport(Report):
 
         usage_by_customer = ServiceUsage.customers_get_usage(report_id.start, report_id.end)
         result = []
-        for customer, usages in usage_by_customer.items():
+        for customer, usages in usage_by_customer:
             for usage in usages:
                 currency, withdraw = usage
                 d = {"email": customer.email,
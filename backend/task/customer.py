@@ -43,8 +43,8 @@ def report_file_generate(self, report_id):
         aggregated = ReportCache.unpack_aggregated(ReportCache.pack_aggregated(aggregated))
     report_generator = Report.get_report(report_id.report_type)
     with timed("rendering for %s" % report_id):
-        data = report_generator.render(aggregated, report_id)
-    report_cache.set_report(report_id, data, report_generator.report_cache_time)
+        report_cache.set_report_chunks(report_id, report_generator.render_chunks(aggregated, report_id),
+                                       report_generator.report_cache_time)
     ReportTask().remove(report_id)
 
 
@@ -62,6 +62,28 @@ def clean_up_customer_service_usage(self, customer_id, end_date):
     customer.clean_up_service_usage(end_date)
 
 
+@celery.task(max_retries=conf.tariff.rerating.max_retries,
+             default_retry_delay=conf.tariff.rerating.retry_delay,
+             bind=True)
+@exception_safe_task(new_session=not conf.test)
+def rerate_tariff_usage(self, tariff_id, start, finish, customer_ids=None):
+    from model import Tariff, Customer, RerateCommitFailed
+    tariff = Tariff.get_by_id(tariff_id)
+    if not tariff:
+        logbook.warning("Tariff id '{}' not found for rerating", tariff_id)
+        return
+    customers = None
+    if customer_ids is not None:
+        customers = Customer.query.filter(Customer.customer_id.in_(customer_ids)).all()
+    # every chunk is committed or rolled back as a whole and already rerated chunks don't change balances again,
+    # so the task is retried. Failed commit can leave only usages or only balances of a chunk committed.
+    try:
+        return tariff.rerate_usage(start, finish, customers)
+    except RerateCommitFailed as e:
+        logbook.error("Rerating of {} from {} to {} is stopped and should be checked manually: {}",
+                      tariff, start, finish, e)
+
+
 @celery.task(ignore_result=True)
 @exception_safe_task()
 def auto_report(time_now=None, email_prefix=None):
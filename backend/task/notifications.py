@@ -20,35 +20,16 @@ def send_email_limit_notification(email, days, language):
     send_email.delay(email, subject, body)
 
 
-def check_account_balance_limit(customer):
-    today = arrow.utcnow()
-    yesterday = today - datetime.timedelta(hours=24)
-
-    from model import ServiceUsage
-    day_withdraw = ServiceUsage.get_withdraw(customer, start=yesterday.datetime, finish=today.datetime)
-
-    # Check we found any withdraws
-    if not day_withdraw.get(customer.tariff.currency):
-        return False, 0
-
-    account = customer.get_account(customer.tariff.currency)
-    lifetime = (account.current - customer.balance_limit) / (day_withdraw[customer.tariff.currency])
-    logbook.debug("[check_account_balance_limit] customer: {} balance:{}, current:{}, lifetime:{}.",
-                  customer, account.balance, account.current, lifetime)
-
-    if lifetime <= conf.customer.blocking.notification:
-        return True, lifetime
-    return False, 0
-
-
 @celery.task(bind=True, ignore_result=True)
 @exception_safe_task(auto_commit=False)
 def check_customers_for_balance(self, time_now=None, name_prefix=None):
     logbook.info("Celery task: check customers for balance.")
-    for customer in Customer.query.filter_by(blocked=False):
-        is_send, lifetime = check_account_balance_limit(customer)
-        if is_send:
-            send_email_limit_notification(customer.email, int(lifetime), customer.locale_language())
+    from model import db, BalanceForecast
+    BalanceForecast.update()
+    db.session.commit()
+    for customer, forecast in BalanceForecast.low_balance(conf.customer.blocking.notification):
+        logbook.debug("[check_customers_for_balance] {}", forecast)
+        send_email_limit_notification(customer.email, int(forecast.days_left), customer.locale_language())
 
 
 def send_email_hdd_notification(manager_email, block_date, account):
@@ -6,9 +6,10 @@ import conf
 import uuid
 
 from fitter.aggregation.timelabel import TimeLabel
+from fitter.aggregation.collector import TenantMutex
 from tests.base import BaseTestCaseDB, TestCaseApi, ResponseError, Deferred
 from model import (Customer, db, Subscription, SubscriptionSwitch, Tariff, Quote, Tenant, ServiceUsage, TimeState,
-                   PromoCode, display, CustomerCard)
+                   PromoCode, display, CustomerCard, ServiceUsageDay, ServiceUsageMonth)
 from datetime import timedelta, datetime
 from utils.mail import outbox
 from decimal import Decimal
@@ -172,6 +173,32 @@ class TestCustomer(BaseTestCaseDB):
             filter(TimeState.name == 'block_customer', TimeState.customer_id == customer.customer_id).first()
         self.assertFalse(time_state)
 
+    def test_balance_crossing(self):
+        from model import BalanceForecast
+        Tariff.create_tariff(self.localized_name("tariff_for_balance"), "tariff!!!", "rub", None)
+        customer = Customer.new_customer("email@email.ru", "123qwe", self.admin_user.user_id)
+        customer.modify_balance(Decimal(1000), "RUB", self.admin_user.user_id, "test balance")
+        db.session.add(BalanceForecast(customer_id=customer.customer_id, currency="RUB", day_withdraw=Decimal(100)))
+        db.session.flush()
+        notification = conf.customer.blocking.notification
+
+        outbox_len = len(outbox)
+        customer.withdraw(Decimal(1000 - 100 * notification - 1))
+        self.assertEqual(len(outbox), outbox_len)
+
+        # balance is enough for less than notification days
+        customer.withdraw(Decimal(2))
+        self.assertEqual(len(outbox), outbox_len + 1)
+        self.assertEqual(outbox[-1].to, "email@email.ru")
+
+        # the limit is already crossed
+        customer.withdraw(Decimal(100))
+        self.assertEqual(len(outbox), outbox_len + 1)
+        self.assertFalse(customer.blocked)
+
+        customer.withdraw(Decimal(100 * notification))
+        self.assertTrue(customer.blocked)
+
     def test_blocking_notification(self):
         from task.notifications import check_customers_for_balance
         from model.account.customer import Customer
@@ -221,6 +248,14 @@ class TestCustomer(BaseTestCaseDB):
         check_customers_for_balance()
         self.assertEqual(outbox_len_before+2, len(outbox))
 
+        from model import BalanceForecast
+        forecast = BalanceForecast.get_by_customer(customer3.customer_id)
+        self.assertEqual(forecast.currency, "RUB")
+        self.assertGreater(forecast.day_withdraw, 0)
+        self.assertGreater(forecast.days_left, conf.customer.blocking.notification)
+        self.assertLess(BalanceForecast.get_by_customer(customer2.customer_id).days_left,
+                        conf.customer.blocking.notification)
+
         # Check notification date is changing
         start = finish
         finish = finish + timedelta(hours=24)
@@ -336,10 +371,10 @@ class TestCustomer(BaseTestCaseDB):
         service_usage = ServiceUsage(customer.os_tenant_id, "storage.disk", time_label,
                                      "auto_report_test", customer.tariff,
                                      354 * conf.GIGA, start, finish, resource_name="disk_disk")
-        total_cost = customer.calculate_usage_cost([service_usage])
+        total_cost = customer.calculate_usage_cost([service_usage], add_to_session=False)
         self.assertEqual(total_cost, Decimal(354) * Decimal("12.34"))
         customer.withdraw(total_cost)
-        db.session.add(service_usage)
+        ServiceUsage.bulk_save([service_usage])
         db.session.commit()
 
         auto_report(future)
@@ -351,6 +386,104 @@ class TestCustomer(BaseTestCaseDB):
         self.assertEqual(rub["current"], -total_cost)
         self.assertEqual(rub["balance"], -total_cost)
 
+    def test_rerate_usage(self):
+        default_tariff = Tariff.create_tariff(self.localized_name("tariff1"), "tariff!!!", "rub")
+        default_tariff.mark_immutable()
+        default_tariff.make_default()
+        services = [{"service_id": "storage.disk", "price": "12.34"}]
+        tariff = Tariff.create_tariff(self.localized_name("tariff_rerate"), "tariff!!!", "rub", services=services)
+        customer = Customer.new_customer("email@email.ru", "123qwe", self.admin_user.user_id)
+        tenant = Tenant.create("fake tenant_id", "fake tenant")
+        db.session.add(tenant)
+        db.session.flush()
+        customer.os_tenant_id = tenant.tenant_id
+        customer.tariff_id = tariff.tariff_id
+        customer_id = customer.customer_id
+
+        time_label = TimeLabel(arrow.utcnow().datetime - timedelta(hours=2))
+        start, finish = time_label.datetime_range()
+        service_usage = ServiceUsage(customer.os_tenant_id, "storage.disk", time_label,
+                                     "rerate_test", customer.tariff,
+                                     354 * conf.GIGA, start, finish, resource_name="disk_disk")
+        total_cost = customer.calculate_usage_cost([service_usage], add_to_session=False)
+        customer.withdraw(total_cost)
+        ServiceUsage.bulk_save([service_usage])
+        db.session.commit()
+
+        tariff.update(services=[{"service_id": "storage.disk", "price": "20"}])
+        db.session.commit()
+        delta = Decimal(354) * (Decimal(20) - Decimal("12.34"))
+
+        rerating = tariff.rerate_usage(start, finish + timedelta(hours=1), dry_run=True)
+        self.assertEqual(len(rerating), 1)
+        self.assertEqual(rerating[0]["customer_id"], customer_id)
+        self.assertEqual(rerating[0]["delta"], delta)
+        self.assertEqual(Customer.get_by_id(customer_id).account_dict()["RUB"]["withdraw"], total_cost)
+
+        rerating = tariff.rerate_usage(start, finish + timedelta(hours=1), [customer], chunk_size=1)
+        self.assertEqual(rerating[0]["delta"], delta)
+        db.session.close()
+        self.assertEqual(Customer.get_by_id(customer_id).account_dict()["RUB"]["withdraw"], total_cost + delta)
+        self.assertEqual(ServiceUsage.query.filter_by(resource_id="rerate_test").one().cost, Decimal(354 * 20))
+        day = start.replace(hour=0)
+        self.assertEqual(ServiceUsage.get_withdraw(customer, day, day + timedelta(days=1)),
+                         {"RUB": Decimal(354 * 20)})
+
+        # usages of the tenant are rerated under its mutex
+        with mock.patch.object(TenantMutex, "acquire", autospec=True, side_effect=TenantMutex.acquire) as acquire:
+            self.assertEqual(tariff.rerate_usage(start, finish + timedelta(hours=1)), [])
+        self.assertEqual([call[0][0].tenant_id for call in acquire.call_args_list], ["fake tenant_id"])
+
+    def test_usage_rollups(self):
+        services = [{"service_id": "storage.disk", "price": "12.34"}]
+        tariff = Tariff.create_tariff(self.localized_name("tariff1"), "tariff!!!", "rub", services=services)
+        tariff.mark_immutable()
+        tariff.make_default()
+        customer = Customer.new_customer("email@email.ru", "123qwe", self.admin_user.user_id)
+        tenant = Tenant.create("fake tenant_id", "fake tenant")
+        db.session.add(tenant)
+        db.session.flush()
+        customer.os_tenant_id = tenant.tenant_id
+        customer.fake_usage(customer, datetime(2015, 1, 30, 22), datetime(2015, 2, 2, 1, 59, 59),
+                            "storage.disk", "rollup_test", conf.GIGA)
+        db.session.commit()
+
+        ranges = [(datetime(2015, 1, 31), datetime(2015, 2, 1)),
+                  (datetime(2015, 1, 1), datetime(2015, 3, 1)),
+                  (datetime(2015, 1, 31), datetime(2015, 2, 2)),
+                  (datetime(2015, 1, 30, 23), datetime(2015, 2, 2, 1))]
+        for start, finish in ranges:
+            rollup_usage = ServiceUsage.get_usage(customer, start, finish)
+            with mock.patch.object(conf.report, "usage_rollups", False):
+                self.assertEqual(rollup_usage, ServiceUsage.get_usage(customer, start, finish))
+                self.assertEqual(ServiceUsage.get_withdraw(customer, start, finish), {"RUB": rollup_usage[0][2]})
+            self.assertEqual(ServiceUsage.aggregate_all(start, finish, "service_id", "tariff_id"),
+                             {tenant.tenant_id: rollup_usage})
+            self.assertEqual(list(ServiceUsage.customers_get_usage(start, finish)),
+                             [(customer, [("RUB", rollup_usage[0][2])])])
+
+        self.assertEqual(ServiceUsageMonth.query.filter_by(time_label="201501").one().usage_volume, 26)
+
+        ServiceUsageDay.query.delete()
+        ServiceUsageMonth.query.delete()
+        self.assertEqual(ServiceUsage.rebuild_rollups(), 2)
+        self.assertEqual(ServiceUsageMonth.query.filter_by(time_label="201501").one().usage_volume, 26)
+        self.assertEqual(ServiceUsageDay.query.filter_by(time_label="20150202").one().usage_volume, 2)
+
+        # usage without tariff and currency is summed up in one rollup row
+        deltas = {(tenant.tenant_id, "storage.disk", None, None, "2015030100"): [Decimal(1), 1]}
+        ServiceUsageDay.add(deltas)
+        ServiceUsageDay.add(deltas)
+        self.assertEqual(ServiceUsageDay.query.filter_by(time_label="20150301").one().usage_volume, 2)
+        self.assertEqual(ServiceUsage.aggregate(tenant.tenant_id, datetime(2015, 3, 1), datetime(2015, 3, 2),
+                                                "tariff_id", "currency"), [(None, None, Decimal(2), 2)])
+
+        self.assertIsNone(ServiceUsage.rollup_ranges("2015013023", "2015020200"))
+        self.assertEqual(ServiceUsage.rollup_ranges("2015013000", "2015030200"),
+                         [(ServiceUsageMonth, "201502", "201503"),
+                          (ServiceUsageDay, "20150130", "20150201"),
+                          (ServiceUsageDay, "20150301", "20150302")])
+
     def test_period_is_over(self):
         from model import TimeMachine, TimeState
         tariff = Tariff.create_tariff(self.localized_name("tariff1"), "tariff!!!", "rub")
@@ -1435,6 +1568,24 @@ class TestCustomerApi(TestCaseApi):
         used_quotas = self.cabinet_client.customer.used_quotas('me')["used_quotas"]
         self.assertEqual(used_quotas, [])
 
+    def test_quota_cache_get_many(self):
+        from memdb.quota import QuotaCache
+        from model.account.customer import quota_cache
+        customer1 = Customer.get_by_id(self.cabinet_client.customer.create(**self.customer_info("q1"))["customer_id"])
+        customer2 = Customer.get_by_id(self.cabinet_client.customer.create(**self.customer_info("q2"))["customer_id"])
+        self.assertEqual(quota_cache.get_many([]), [])
+
+        quota_cache.set(customer1, {"instances": 2})
+        quota1, quota2 = quota_cache.get_many([customer1, customer2])
+        self.assertEqual(quota1.used, {"instances": 2})
+        self.assertTrue(quota1.fresh)
+        self.assertLessEqual(quota1.ttl, conf.customer.quota.ttl)
+        self.assertIsNone(quota2)
+        self.assertEqual(quota_cache.get(customer1).used, {"instances": 2})
+
+        quota_cache.redis.set(QuotaCache().key(customer2), b"\xc1")
+        self.assertEqual(quota_cache.get_many([customer2]), [None])
+
     def customer_info(self, customer_name="test_customer"):
         return {"email": "%s@example.com" % customer_name,
                 "password": customer_name + customer_name}
@@ -278,6 +278,26 @@ class Tenant:
         right = bisect.bisect_right(self.timestamps[meter_name], end)
         return self.event[meter_name][left:right]
 
+    def statistics(self, tenant_id, meter_name, start, end, period, source=None):
+        import bisect
+        left = bisect.bisect_left(self.timestamps[meter_name], start)
+        right = bisect.bisect_left(self.timestamps[meter_name], end)
+        statistics = {}
+        for event, timestamp in zip(self.event[meter_name][left:right], self.timestamps[meter_name][left:right]):
+            period_start = start + datetime.timedelta(seconds=(timestamp - start).total_seconds() // period * period)
+            stat = statistics.get((period_start, event.resource_id))
+            if stat is None:
+                stat = statistics[(period_start, event.resource_id)] = mock.Mock(
+                    groupby={"resource_id": event.resource_id}, period_start=period_start, unit=event.counter_unit,
+                    max=event.counter_volume, sum=0, duration_start=timestamp)
+            stat.max = max(stat.max, event.counter_volume)
+            stat.sum += event.counter_volume
+            stat.duration_end = timestamp
+        return list(statistics.values())
+
+    def resources(self, tenant_id):
+        return {event.resource_id: event.metadata for events in self.event.values() for event in events}
+
 
 class OpenStackUser:
     def __init__(self, name, password, email, tenant_id, enabled=True, user_id=None):
@@ -0,0 +1,78 @@
+import datetime
+import json
+import tempfile
+import unittest
+
+from tests.base import TestCaseApi
+from model import Tariff, Tenant, ServiceUsage
+from fitter.benchmark import FitterBenchmark, compare
+from fitter.ceilometer_standin import CeilometerStandIn, RecordedSamples, SyntheticFleet
+
+
+class TestCeilometerStandIn(unittest.TestCase):
+    start = datetime.datetime(2015, 7, 1)
+
+    def test_synthetic_fleet(self):
+        fleet = SyntheticFleet(2, 4, self.start, 48, seed=1)
+        standin = CeilometerStandIn(fleet)
+        end = self.start + datetime.timedelta(hours=48)
+        samples = standin.get_tenant_usage(fleet.tenant_ids[0], "instance", self.start, end)
+        self.assertTrue(samples)
+        self.assertEqual(standin.served_samples, len(samples))
+        self.assertEqual({s.resource_id for s in samples}, {fleet.resource_id(fleet.tenant_ids[0], vm, "instance")
+                                                            for vm in range(4)})
+        timestamps = [s.timestamp for s in samples]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        # the fleet is reproducible by seed
+        same = SyntheticFleet(2, 4, self.start, 48, seed=1).samples(fleet.tenant_ids[0], "instance", self.start, end)
+        self.assertEqual([s._info for s in samples], same)
+
+        project_wide = standin.get_tenant_usage(None, "volume.size", self.start, end)
+        self.assertEqual({s.project_id for s in project_wide}, set(fleet.tenant_ids))
+
+    def test_replay(self):
+        fleet = SyntheticFleet(2, 2, self.start, 3)
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            for meter_name in ("instance", "volume.size"):
+                for info in fleet.samples(None, meter_name, self.start, self.start + datetime.timedelta(hours=3)):
+                    f.write(json.dumps(info) + "\n")
+            f.flush()
+            recorded = RecordedSamples(f.name)
+
+        self.assertEqual(recorded.tenant_ids, fleet.tenant_ids)
+        hour_start, hour_end = self.start + datetime.timedelta(hours=1), self.start + datetime.timedelta(hours=2)
+        self.assertEqual(recorded.samples(fleet.tenant_ids[1], "instance", hour_start, hour_end),
+                         fleet.samples(fleet.tenant_ids[1], "instance", hour_start, hour_end))
+
+    def test_compare(self):
+        baseline = {"samples_per_second": 1000, "tenants_per_second": 10}
+        self.assertEqual(compare({"samples_per_second": 950, "tenants_per_second": 10}, baseline, 0.1), [])
+        self.assertEqual(len(compare({"samples_per_second": 850, "tenants_per_second": 10}, baseline, 0.1)), 1)
+
+
+class TestFitterBenchmark(TestCaseApi):
+    def test_benchmark(self):
+        tariff = Tariff.create_tariff(self.localized_name("Tariff for benchmark"), "tariff", "rub", services=[])
+        tariff.mark_immutable()
+        tariff.make_default()
+
+        start = datetime.datetime(2015, 7, 1)
+        fleet = SyntheticFleet(2, 4, start, 3)
+        benchmark = FitterBenchmark(CeilometerStandIn(fleet), fleet.tenant_ids, start, 3)
+        benchmark.prepare()
+        result = benchmark.run()
+
+        self.assertEqual(result["tenants"], 2)
+        self.assertEqual(result["hours"], 3)
+        self.assertGreater(result["samples"], 0)
+        self.assertEqual(result["phases"]["tenant"]["count"], 2)
+        self.assertIn("fetch", result["phases"])
+        self.assertIn("transform", result["phases"])
+        self.assertTrue(ServiceUsage.query.filter(ServiceUsage.tenant_id.in_(fleet.tenant_ids)).count())
+        for tenant in Tenant.query.filter(Tenant.tenant_id.in_(fleet.tenant_ids)):
+            self.assertGreater(tenant.last_collected, start)
+
+        # the next run collects the same hours again
+        benchmark.prepare()
+        self.assertEqual(benchmark.run()["tenants"], 2)
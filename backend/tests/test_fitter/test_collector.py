@@ -1,6 +1,7 @@
 import datetime
 import asyncio
 import mock
+import unittest
 import tempfile
 import os
 import conf
@@ -9,7 +10,9 @@ from decimal import Decimal
 from tests.base import TestCaseApi
 from tests.test_fitter.openstack_services import Tenant, Disk, Volume, Instance
 from model import db, Customer, Tariff
-from fitter.aggregation.collector import Collector
+from fitter.aggregation.collector import Collector, MeterSamples, TenantMutex, PendingCharge
+from fitter.aggregation.scheduler import TenantScheduler
+from fitter.aggregation.sample_cache import SampleCache
 from utils.money import decimal_to_string
 from utils.mail import outbox
 from os_interfaces.openstack_wrapper import openstack
@@ -180,6 +183,327 @@ class TestCollector(TestCaseApi):
         total_cost = hours * hour_price
         self.assertLess(abs(account["withdraw"] - total_cost), 0.0001)
 
+    def test_collector_concurrent(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        projects = {}
+        for name in ("boss1", "boss2", "boss3"):
+            project = Tenant(name, start_time)
+            disk = Disk(project, "test_disk", start_time, 1234567890)
+            disk.repeat_message(start_time, end_time)
+            project.prepare_messages()
+            projects[project.project_id] = project
+        hour_price = Decimal(self.image_size_price)*2
+
+        def usage(tenant_id, meter_name, start, end, limit=None):
+            return projects[tenant_id].usage(tenant_id, meter_name, start, end, limit)
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(conf.fitter, "workers", 2):
+            openstack.get_tenant_usage = usage
+            tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        self.assertEqual(self.collector.errors, 0)
+        hours = int((end_time - start_time).total_seconds() // 3600) + 1
+        for project in projects.values():
+            self.assertTrue(tenants_usage[project.project_id])
+            account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+            self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_leased_by_other(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        projects = {}
+        for name in ("boss1", "boss2"):
+            project = Tenant(name, start_time)
+            disk = Disk(project, "test_disk", start_time, 1234567890)
+            disk.repeat_message(start_time, end_time)
+            project.prepare_messages()
+            projects[name] = project
+
+        def usage(tenant_id, meter_name, start, end, limit=None):
+            return projects["boss1"].usage(tenant_id, meter_name, start, end, limit)
+
+        other = TenantMutex(projects["boss2"].project_id)
+        self.assertTrue(other.acquire())
+        try:
+            with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                    mock.patch.object(TenantMutex, "acquire", autospec=True) as acquire, \
+                    mock.patch.object(TenantMutex, "release", autospec=True, side_effect=TenantMutex.release) \
+                    as release:
+                openstack.get_tenant_usage = usage
+                tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+        finally:
+            other.release()
+
+        self.assertEqual(self.collector.errors, 0)
+        self.assertTrue(tenants_usage[projects["boss1"].project_id])
+        self.assertNotIn(projects["boss2"].project_id, tenants_usage)
+        # the tenant held by other fitter is skipped without waiting for its mutex
+        acquire.assert_not_called()
+        # mutex of the processed tenant is released right after processing
+        self.assertEqual([call[0][0].tenant_id for call in release.call_args_list], [projects["boss1"].project_id])
+
+    def test_collector_queue(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        projects = {}
+        for name in ("boss1", "boss2", "boss3"):
+            project = Tenant(name, start_time)
+            disk = Disk(project, "test_disk", start_time, 1234567890)
+            disk.repeat_message(start_time, end_time)
+            project.prepare_messages()
+            projects[project.project_id] = project
+        hour_price = Decimal(self.image_size_price)*2
+
+        def usage(tenant_id, meter_name, start, end, limit=None):
+            return projects[tenant_id].usage(tenant_id, meter_name, start, end, limit)
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(conf.fitter.queue, "enabled", True):
+            openstack.get_tenant_usage = usage
+            tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+            self.assertEqual(self.collector.queue.size(), (0, 0))
+
+            # other fitter isn't coordinator and nothing is left in the queue for it
+            self.assertEqual(Collector().run_usage_collection(end_time + datetime.timedelta(hours=10)), {})
+
+        self.assertEqual(self.collector.errors, 0)
+        hours = int((end_time - start_time).total_seconds() // 3600) + 1
+        for project in projects.values():
+            self.assertTrue(tenants_usage[project.project_id])
+            account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+            self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_server_side_aggregation(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        project = Tenant("boss", start_time)
+        disk = Disk(project, "test_disk", start_time, 1234567890)
+        disk.repeat_message(start_time, end_time)
+        project.prepare_messages()
+        hour_price = Decimal(self.image_size_price)*2
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(conf.fitter.collection, "server_side_aggregation", True):
+            openstack.get_tenant_usage = mock.Mock(side_effect=project.usage)
+            openstack.get_tenant_statistics = project.statistics
+            openstack.get_tenant_resources = project.resources
+            tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        self.assertNotIn("image.size", {call[0][1] for call in openstack.get_tenant_usage.call_args_list})
+        self.assertEqual(self.collector.errors, 0)
+        tenant_usage = tenants_usage[project.project_id]
+        hours = int((end_time - start_time).total_seconds() // 3600) + 1
+        self.assertEqual(len(tenant_usage), hours)
+        usage = tenant_usage[min(tenant_usage)][0][0]
+        self.assertEqual(usage["resource_name"], "test_disk")
+        account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+        self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_project_wide(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        projects = {}
+        for name in ("boss1", "boss2"):
+            project = Tenant(name, start_time)
+            disk = Disk(project, "test_disk", start_time, 1234567890)
+            disk.repeat_message(start_time, end_time)
+            project.prepare_messages()
+            projects[project.project_id] = project
+        hour_price = Decimal(self.image_size_price)*2
+        queried_tenants = []
+
+        def usage(tenant_id, meter_name, start, end, limit=None):
+            queried_tenants.append(tenant_id)
+            if tenant_id:
+                return projects[tenant_id].usage(tenant_id, meter_name, start, end, limit)
+            result = []
+            for project_id, project in projects.items():
+                result.extend(project.usage(project_id, meter_name, start, end, limit))
+            return result
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(conf.fitter.collection, "project_wide_window", 6):
+            openstack.get_tenant_usage = usage
+            tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        self.assertEqual(self.collector.errors, 0)
+        self.assertIn(None, queried_tenants)
+        hours = int((end_time - start_time).total_seconds() // 3600) + 1
+        for project in projects.values():
+            self.assertTrue(tenants_usage[project.project_id])
+            account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+            self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_recollect(self):
+        from model import Tenant as TenantDb, ServiceUsage
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        project = Tenant("boss", start_time)
+        disk = Disk(project, "test_disk", start_time, 1234567890)
+        disk.repeat_message(start_time, end_time)
+        hour_price = Decimal(self.image_size_price)*2
+        hours = int((end_time - start_time).total_seconds() // 3600) + 1
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack:
+            openstack.get_tenant_usage = project.usage
+            project.prepare_messages()
+            self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+            usage_count = ServiceUsage.query.filter_by(tenant_id=project.project_id).count()
+
+            tenant = TenantDb.get_by_id(project.project_id)
+            tenant.last_collected = start_time
+            db.session.commit()
+
+            self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        self.assertEqual(self.collector.errors, 0)
+        self.assertEqual(ServiceUsage.query.filter_by(tenant_id=project.project_id).count(), usage_count)
+        account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+        self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_charge_hours(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        project = Tenant("boss", start_time)
+        disk = Disk(project, "test_disk", start_time, 1234567890)
+        disk.repeat_message(start_time, end_time)
+        project.prepare_messages()
+        hour_price = Decimal(self.image_size_price)*2
+        hours = int((end_time - start_time).total_seconds() // 3600) + 1
+        withdraw = Customer.withdraw
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(conf.fitter.collection, "charge_hours", 4), \
+                mock.patch.object(Customer, "withdraw", autospec=True, side_effect=withdraw) as withdraw_mock:
+            openstack.get_tenant_usage = project.usage
+            tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        self.assertEqual(self.collector.errors, 0)
+        self.assertEqual(len(tenants_usage[project.project_id]), hours)
+        self.assertEqual(withdraw_mock.call_count, (hours + 3) // 4)
+        account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+        self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_charge_before_failure(self):
+        from model import Tenant as TenantDb
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+        failed_hour = datetime.datetime(2015, 3, 20, 14)
+
+        project = Tenant("boss", start_time)
+        disk = Disk(project, "test_disk", start_time, 1234567890)
+        disk.repeat_message(start_time, end_time)
+        project.prepare_messages()
+        hour_price = Decimal(self.image_size_price)*2
+        collect_usage = Collector._collect_usage
+
+        def failing_collect_usage(collector, tenant, time_label, customer, samples=None):
+            if time_label.datetime == failed_hour:
+                raise Exception("Test failure")
+            return collect_usage(collector, tenant, time_label, customer, samples)
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(Collector, "_collect_usage", autospec=True, side_effect=failing_collect_usage):
+            openstack.get_tenant_usage = project.usage
+            tenants_usage = self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        # hours before the failed one are charged and aren't collected again
+        self.assertEqual(self.collector.errors, 1)
+        hours = int((failed_hour - start_time).total_seconds() // 3600) + 1
+        self.assertEqual(len(tenants_usage[project.project_id]), hours)
+        self.assertEqual(TenantDb.get_by_id(project.project_id).last_collected, failed_hour)
+        account = Customer.get_by_id(project.customer_id).account_dict()["RUB"]
+        self.assertLess(abs(account["withdraw"] - hours * hour_price), 0.0001)
+
+    def test_collector_crossing_after_commit(self):
+        start_time = datetime.datetime(2015, 3, 20, 9, 12)
+        end_time = datetime.datetime(2015, 3, 21)
+
+        project = Tenant("boss", start_time)
+        disk = Disk(project, "test_disk", start_time, 1234567890)
+        disk.repeat_message(start_time, end_time)
+        project.prepare_messages()
+        charge = PendingCharge.charge
+
+        def failing_charge(pending):
+            charge(pending)
+            raise Exception("Test failure")
+
+        outbox_len = len(outbox)
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack, \
+                mock.patch.object(PendingCharge, "charge", autospec=True, side_effect=failing_charge):
+            openstack.get_tenant_usage = project.usage
+            self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+
+        # the charge exhausts the balance, but it is rolled back
+        self.assertEqual(self.collector.errors, 1)
+        self.assertFalse(Customer.get_by_id(project.customer_id).blocked)
+        self.assertEqual(len(outbox), outbox_len)
+
+        with mock.patch("os_interfaces.openstack_wrapper.openstack") as openstack:
+            openstack.get_tenant_usage = project.usage
+            self.collector.run_usage_collection(end_time + datetime.timedelta(hours=10))
+        self.assertTrue(Customer.get_by_id(project.customer_id).blocked)
+
+    def test_collector_sample_pages(self):
+        from fitter.aggregation.timelabel import TimeLabel
+        from os_interfaces.openstack_wrapper import OpenStackWrapper
+
+        start_time = datetime.datetime(2015, 3, 20, 9)
+        end_time = datetime.datetime(2015, 3, 20, 14)
+        # a sample every 10 minutes, every third timestamp has two samples
+        stored = []
+        for i in range(-6, 37):
+            timestamp = (start_time + datetime.timedelta(minutes=10 * i)).isoformat()
+            for j in range(2 if i % 3 == 0 else 1):
+                stored.append({"id": "%s-%s" % (i, j), "timestamp": timestamp, "project_id": "boss",
+                               "meter": "image.size"})
+
+        operators = {"ge": lambda a, b: a >= b, "lt": lambda a, b: a < b, "le": lambda a, b: a <= b,
+                     "eq": lambda a, b: a == b}
+
+        def list_samples(q, limit):
+            # ceilometer returns the newest samples first
+            def match(sample):
+                for f in q:
+                    value, bound = sample[f["field"]], f["value"]
+                    if f["field"] == "timestamp":
+                        value, bound = Collector.parse_timestamp(value), Collector.parse_timestamp(bound)
+                    if not operators[f["op"]](value, bound):
+                        return False
+                return True
+            page = sorted(filter(match, stored), key=lambda sample: sample["timestamp"], reverse=True)[:limit]
+            return [mock.Mock(**sample) for sample in page]
+
+        ceilometer = mock.Mock()
+        ceilometer.new_samples.list.side_effect = list_samples
+        collected = []
+        with mock.patch.object(OpenStackWrapper, "client_ceilometer", ceilometer), \
+                mock.patch.object(conf.fitter.collection, "sample_page_size", 4):
+            # the first window ends in the middle of a page
+            for window_start, window_end in [(start_time, start_time + datetime.timedelta(hours=2)),
+                                             (start_time + datetime.timedelta(hours=2), end_time)]:
+                time_label, window_end = TimeLabel(window_start), TimeLabel(window_end)
+                start, end = self.collector._fetch_range(time_label, window_end)
+                samples = MeterSamples(self.collector.fetch_meter_samples("boss", "image.size", start, end))
+                while time_label < window_end:
+                    collected.extend(sample.id for sample in samples.between(time_label.datetime, time_label.next().datetime))
+                    time_label = time_label.next()
+
+        self.assertGreater(ceilometer.new_samples.list.call_count, 2)
+        expected = [sample["id"] for sample in stored
+                    if start_time <= Collector.parse_timestamp(sample["timestamp"]) < end_time]
+        self.assertEqual(sorted(collected), sorted(expected))
+
     def _test_collector(self):
         # full test of collector daemon
         @asyncio.coroutine
@@ -188,3 +512,96 @@ class TestCollector(TestCaseApi):
             self.collector.stop()
 
         self.loop.run_until_complete(asyncio.wait([self.collector.start(), test()]))
+
+
+class TestMeterSamples(unittest.TestCase):
+    def test_between(self):
+        start = datetime.datetime(2015, 3, 20, 9)
+        samples = [mock.Mock(timestamp=start + datetime.timedelta(minutes=10 * i)) for i in range(18)]
+        meter_samples = MeterSamples(samples)
+        self.assertEqual(len(meter_samples), 18)
+
+        hour = meter_samples.between(start + datetime.timedelta(hours=1), start + datetime.timedelta(hours=2))
+        self.assertEqual(hour, samples[6:12])
+
+        leading = datetime.timedelta(minutes=10)
+        hour = meter_samples.between(start + datetime.timedelta(hours=1) - leading,
+                                     start + datetime.timedelta(hours=2) + leading)
+        self.assertEqual(hour, samples[5:13])
+        self.assertEqual(meter_samples.between(start - leading, start), [])
+
+    def test_batch_between(self):
+        start = datetime.datetime(2015, 3, 20, 9)
+        samples = [mock.Mock(timestamp=start + datetime.timedelta(minutes=10 * i), counter_volume=i,
+                             resource_id="r%s" % (i % 2), source="openstack") for i in range(18)]
+        meter_samples = MeterSamples(samples)
+
+        hour = meter_samples.batch_between(start + datetime.timedelta(hours=1), start + datetime.timedelta(hours=2))
+        self.assertEqual(hour.samples, samples[6:12])
+        self.assertEqual(hour.volumes, list(range(6, 12)))
+        self.assertEqual(hour.datetime(0), start + datetime.timedelta(hours=1))
+
+        by_resource = Collector.filter_and_group(hour)
+        self.assertEqual(by_resource["r0"].volumes, [6, 8, 10])
+        self.assertEqual(by_resource["r1"].samples, samples[7:12:2])
+
+    def test_parse_timestamp(self):
+        self.assertEqual(Collector.parse_timestamp("2015-03-20T09:10:11"), datetime.datetime(2015, 3, 20, 9, 10, 11))
+        self.assertEqual(Collector.parse_timestamp("2015-03-20T09:10:11.123"),
+                         datetime.datetime(2015, 3, 20, 9, 10, 11, 123000))
+        self.assertEqual(Collector.parse_timestamp("2015-03-20T09:10:11.123456+00:00"),
+                         datetime.datetime(2015, 3, 20, 9, 10, 11, 123456))
+
+
+class TestTenantScheduler(unittest.TestCase):
+    def test_due_tenants(self):
+        config = mock.Mock(max_tenants_per_run=2, min_sleep=5, jitter=0)
+        scheduler = TenantScheduler(config)
+        now = 1000000
+        tenants = [mock.Mock(tenant_id="t%s" % i) for i in range(4)]
+
+        self.assertEqual(scheduler.due_tenants(tenants, now), tenants[:2])
+        self.assertEqual(scheduler.next_delay(now), 5)
+
+        scheduler.processed("t0", True, now)
+        scheduler.processed("t1", False, now)
+        self.assertEqual(scheduler.due_tenants(tenants, now), tenants[2:])
+        self.assertEqual(scheduler.next_delay(now), min(conf.fitter.min_tenant_interval, conf.fitter.fetch_interval))
+
+        # tenant without usage is polled less often
+        now += conf.fitter.min_tenant_interval
+        self.assertEqual(scheduler.due_tenants(tenants[:2], now), tenants[:2])
+        scheduler.processed("t0", True, now)
+        scheduler.processed("t1", False, now)
+        now += conf.fitter.min_tenant_interval
+        self.assertEqual(scheduler.due_tenants(tenants[:2], now), tenants[:1])
+
+
+class TestSampleCache(unittest.TestCase):
+    def test_get(self):
+        start = datetime.datetime(2015, 3, 20, 9)
+        samples = [mock.Mock(timestamp=start + datetime.timedelta(minutes=10 * i)) for i in range(30)]
+        timestamps = [sample.timestamp for sample in samples]
+        requests = []
+
+        def fetch(fetch_start, fetch_end):
+            requests.append((fetch_start, fetch_end))
+            return [s for s, t in zip(samples, timestamps) if fetch_start <= t < fetch_end]
+
+        config = mock.Mock(enabled=True, tail=30 * 60, settle_time=0, max_entries=10)
+        cache = SampleCache(config)
+        leading = datetime.timedelta(minutes=10)
+        hour = datetime.timedelta(hours=1)
+
+        first = cache.get("t", "m", start - leading, start + hour + leading, fetch)
+        self.assertEqual(first, samples[:7])
+        second = cache.get("t", "m", start + hour - leading, start + 2 * hour + leading, fetch)
+        self.assertEqual(second, samples[5:13])
+        self.assertEqual(requests[-1], (start + hour + leading, start + 2 * hour + leading))
+
+        # window before the cached tail is fetched again
+        cache.get("t", "m", start, start + hour, fetch)
+        self.assertEqual(requests[-1], (start, start + hour))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+        self.assertEqual(cache.stats()["cached_samples"], 2)
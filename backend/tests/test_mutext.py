@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import time
+from threading import Thread, Timer
 from tests.base import BaseTestCaseDB
 
 from memdb import MemDbModel
-from memdb.mutex import RedisMutex
+from memdb.mutex import RedisMutex, RedisMutexBatch
 
 
 class RedisMutexTest(BaseTestCaseDB):
@@ -40,3 +41,72 @@ class RedisMutexTest(BaseTestCaseDB):
 
         with RedisMutex("test_test_expiring", MemDbModel.redis, ttl_ms=10000) as l:
             self.assertFalse(l)
+
+    def test_blocking(self):
+        l = RedisMutex("test_blocking", MemDbModel.redis, ttl_ms=10000)
+        self.assertTrue(l.acquire())
+
+        m = RedisMutex("test_blocking", MemDbModel.redis, ttl_ms=10000)
+        started = time.time()
+        self.assertFalse(m.acquire(blocking=True, timeout=0.2))
+        self.assertGreaterEqual(time.time() - started, 0.2)
+
+        Timer(0.2, l.release).start()
+        self.assertTrue(m.acquire(blocking=True, timeout=5))
+        self.assertTrue(m.release())
+
+    def test_fifo(self):
+        l = RedisMutex("test_fifo", MemDbModel.redis, ttl_ms=10000)
+        self.assertTrue(l.acquire())
+
+        acquired = []
+
+        def wait(mutex):
+            if mutex.acquire(blocking=True, timeout=5):
+                acquired.append(mutex)
+                mutex.release()
+
+        waiters = [RedisMutex("test_fifo", MemDbModel.redis, ttl_ms=10000) for _ in range(3)]
+        threads = []
+        for waiter in waiters:
+            threads.append(Thread(target=wait, args=(waiter,)))
+            threads[-1].start()
+            time.sleep(0.1)
+
+        # lock isn't granted out of the queue
+        self.assertTrue(l.release())
+        self.assertFalse(RedisMutex("test_fifo", MemDbModel.redis, ttl_ms=10000).acquire())
+
+        for thread in threads:
+            thread.join()
+        self.assertEqual(acquired, waiters)
+
+    def test_update_ttl(self):
+        l = RedisMutex("test_update_ttl", MemDbModel.redis, ttl_ms=10000)
+        self.assertTrue(l.acquire())
+        self.assertTrue(l.update_ttl())
+        l.redis.set(l.key, "test")
+        self.assertFalse(l.update_ttl())
+        self.assertEqual(l.redis.get(l.key), b"test")
+
+    def test_batch(self):
+        held = RedisMutex("test_batch_1", MemDbModel.redis, ttl_ms=10000)
+        self.assertTrue(held.acquire())
+        guard = RedisMutex("test_batch_guard_2", MemDbModel.redis, ttl_ms=10000)
+        self.assertTrue(guard.acquire())
+
+        mutexes = [RedisMutex("test_batch_%s" % i, MemDbModel.redis, ttl_ms=10000) for i in range(4)]
+        guards = [RedisMutex("test_batch_guard_%s" % i, MemDbModel.redis) for i in range(4)]
+        with RedisMutexBatch(mutexes) as batch:
+            self.assertEqual(batch.acquire(guards=guards), [mutexes[0], mutexes[3]])
+            self.assertEqual(batch.guarded, {mutexes[2]})
+            self.assertTrue(mutexes[0].acquired)
+            self.assertFalse(RedisMutex("test_batch_0", MemDbModel.redis, ttl_ms=10000).acquire())
+
+            self.assertTrue(mutexes[3].update_ttl())
+            MemDbModel.redis.set(mutexes[3].key, "test")
+            self.assertEqual(batch.renew(), [mutexes[0]])
+
+        self.assertIsNone(mutexes[0].acquired)
+        self.assertTrue(RedisMutex("test_batch_0", MemDbModel.redis, ttl_ms=10000).acquire())
+        self.assertTrue(held.release())
@@ -6,13 +6,15 @@ import uuid
 import mock
 from tests.base import TestCaseApi
 from datetime import datetime, timedelta
-from model import db, Customer, Tenant
+from model import db, Customer, Tenant, Measure
 from arrow import utcnow
 from decimal import Decimal
 from unittest import TestCase
 from report.segments import WeightSegments
 from os_interfaces.openstack_wrapper import openstack
 from mock import patch
+from collections import namedtuple
+from report.detailed import ResourceReport
 
 
 class TestReportApi(TestCaseApi):
@@ -679,3 +681,68 @@ class TestWeightSegment(TestCase):
 
         s.add_range(16, 17, 1)
         self.assertEqual(s.edges, [16, 17, 23, 116])
+
+
+class TestResourceReport(TestCase):
+    Usage = namedtuple("Usage", ["time_label", "usage_volume", "cost", "start", "end"])
+
+    def usage(self, hour, volume):
+        start = datetime(2015, 4, 1, hour)
+        return self.Usage(start.strftime("%Y%m%d%H"), volume, Decimal(volume),
+                          start, start + timedelta(hours=1, seconds=-1))
+
+    def test_merge_neighbour_hours(self):
+        service = mock.MagicMock()
+        service.measure.measure_type = Measure.TIME
+        resource = ResourceReport("resource", "resource name", service)
+        for hour, volume in [(0, 1), (1, 1), (2, 2), (3, 2), (3, 2), (5, 2), (6, 2)]:
+            resource.add_usage(self.usage(hour, volume))
+
+        self.assertEqual([(interval.start, interval.finish, interval.total_usage_volume)
+                          for interval in resource.intervals],
+                         [(1427846400, 1427853599, 2), (1427853600, 1427860799, 4), (1427864400, 1427871599, 4)])
+        self.assertEqual(resource.total_cost, Decimal(10))
+
+    def test_quantitative_service(self):
+        resource = ResourceReport("resource", "resource name", None)
+        for hour in range(3):
+            resource.add_usage(self.usage(hour, 5))
+        self.assertEqual(len(resource.intervals), 3)
+        self.assertEqual(resource.total_usage_volume, 15)
+
+
+class TestCSVRender(TestCase):
+    def test_render_chunks(self):
+        from report.render import Render
+
+        aggregated = [{"email": "customer%s@example.com" % i, "withdraw": Decimal(i), "currency": "RUB"}
+                      for i in range(100)]
+        for report_format in ("csv", "tsv"):
+            render = Render.get_render(report_format)
+            whole = render.render(aggregated, "usage", "en_us")
+            with mock.patch.object(conf.report, "chunk_size", 100):
+                chunks = list(render.render_chunks(aggregated, "usage", "en_us"))
+            self.assertGreater(len(chunks), 10)
+            self.assertEqual(b"".join(chunks), whole)
+            self.assertTrue(whole.startswith(render.prefix()))
+
+
+class TestReportCache(TestCase):
+    def test_report_replaced_during_reading(self):
+        from memdb.report_cache import ReportCache, ReportId, ReportChanged
+        report_cache = ReportCache()
+        report_id = ReportId(datetime(2015, 1, 1), datetime(2015, 2, 1), "test", "csv", uuid.uuid4().hex)
+        report_cache.set_report_chunks(report_id, [b"abc", b"def", b"gh"])
+
+        size, chunks = report_cache.open_report(report_id, chunk_size=3)
+        self.assertEqual(size, 8)
+        self.assertEqual(b"".join(chunks), b"abcdefgh")
+
+        size, chunks = report_cache.open_report(report_id, chunk_size=3)
+        self.assertEqual(next(chunks), b"abc")
+        report_cache.set_report_chunks(report_id, [b"012345678"])
+        with self.assertRaises(ReportChanged):
+            next(chunks)
+
+        report_cache.redis.delete(report_cache.key(report_id), report_cache.version_key(report_id))
+        self.assertEqual(report_cache.open_report(report_id), (0, None))
@@ -1,7 +1,8 @@
+import mock
 from arrow import utcnow
 import errors
 from tests.base import BaseTestCaseDB, TestCaseApi, format_api_date
-from model import Tariff, db, TariffHistory, User, ServicePrice
+from model import Tariff, db, TariffHistory, User, ServicePrice, TariffPriceIndex
 from decimal import Decimal
 from copy import deepcopy
 from datetime import timedelta
@@ -71,6 +72,37 @@ class TestTariff(BaseTestCaseDB):
         self.assertEqual(tt.services_as_dict()["m1.micro"].price, Decimal("231.333333"))
         self.assertEqual(len(tt.services), 1)  # m1.small was removed
 
+    def test_tariff_price_index(self):
+        t = Tariff.create_tariff(self.localized_name("tariff_price_index"), "Tariff price index", "RUB", None)
+        t.update(services=[{"service_id": "m1.small", "price": "12.3456"}])
+        db.session.commit()
+
+        prices = t.price_index()
+        self.assertEqual(prices["m1.small"].price, Decimal("12.3456"))
+        self.assertEqual(prices["m1.small"].currency, "RUB")
+        self.assertIs(t.price_index(), prices)
+
+        # missing service rebuilds the index only once per revision of the tariff
+        with mock.patch.object(TariffPriceIndex, "build", side_effect=TariffPriceIndex.build) as build:
+            prices = TariffPriceIndex.get_missing(t, "m1.micro")
+            self.assertIs(TariffPriceIndex.get_missing(t, "m1.micro"), prices)
+            self.assertIs(t.price_index(), prices)
+        self.assertEqual(build.call_count, 1)
+
+        t.update(services=[{"service_id": "m1.small", "price": "23.1"}])
+        db.session.commit()
+        prices = Tariff.get_by_id(t.tariff_id).price_index()
+        self.assertEqual(prices["m1.small"].price, Decimal("23.1"))
+        self.assertNotIn("m1.micro", prices)
+
+        # prices are changed by other process, so the index of this process isn't invalidated
+        with mock.patch.object(TariffPriceIndex, "invalidate"):
+            for price in ("34.5", "45.6"):
+                t = Tariff.get_by_id(t.tariff_id)
+                t.update(services=[{"service_id": "m1.small", "price": price}])
+                db.session.commit()
+                self.assertEqual(Tariff.get_by_id(t.tariff_id).price_index()["m1.small"].price, Decimal(price))
+
     def test_tariff_history(self):
         t = Tariff.create_tariff(self.localized_name("tariff_and_services"), "Test tariff with services", "RUB", None)
         user = User.query.first()
@@ -1,5 +1,7 @@
 import errors
 import re
+import time
+import mock
 from api import API_ADMIN
 from tests.base import BaseTestCaseDB, TestCaseApi, ApiAdminClient
 from model import User, db
@@ -24,6 +26,79 @@ class TestUser(BaseTestCaseDB):
         db.session.rollback()
 
 
+    def test_user_token_index(self):
+        from memdb.token import UserToken
+        user = User.new_user("email@email.ru", "123qwe", "admin", "test user")
+        db.session.flush()
+        other = User.new_user("other@email.ru", "123qwe", "admin", "other user")
+        db.session.flush()
+
+        tokens = [UserToken.create(user) for _ in range(3)]
+        other_token = UserToken.create(other)
+        self.assertEqual(sorted(t.id for t in UserToken.find_by(user.user_id)), sorted(t.id for t in tokens))
+
+        UserToken.remove(tokens[0])
+        self.assertEqual(len(UserToken.find_by(user.user_id)), 2)
+
+        UserToken.redis().delete(UserToken.index_key(user.user_id))
+        self.assertEqual(UserToken.find_by(user.user_id), [])
+        self.assertGreaterEqual(UserToken.rebuild_index(), 3)
+        self.assertEqual(len(UserToken.find_by(user.user_id)), 2)
+
+        UserToken.remove_by(user.user_id)
+        self.assertEqual(UserToken.find_by(user.user_id), [])
+        with self.assertRaises(errors.UserInvalidToken):
+            UserToken.get(tokens[1].id)
+        self.assertEqual(UserToken.get(other_token.id).user_id, str(other.user_id))
+
+
+    def test_user_token_cache(self):
+        from memdb.token import UserToken, token_cache
+        user = User.new_user("email@email.ru", "123qwe", "admin", "test user")
+        db.session.flush()
+        token = UserToken.create(user)
+
+        for _ in range(100):
+            token_cache.get("")  # starts listener of revoked tokens
+            if token_cache.subscribed:
+                break
+            time.sleep(0.05)
+        self.assertTrue(token_cache.subscribed)
+
+        hits = token_cache.hits
+        self.assertEqual(UserToken.get_cached(token.id), token)
+        self.assertEqual(UserToken.get_cached(token.id), token)
+        self.assertEqual(token_cache.hits, hits + 1)
+
+        UserToken.remove_by(user.user_id)
+        with self.assertRaises(errors.UserInvalidToken):
+            UserToken.get_cached(token.id)
+
+        # token revoked after it is fetched isn't cached
+        token = UserToken.create(user)
+        get = UserToken.get
+
+        def get_and_revoke(token_id):
+            fetched = get(token_id)
+            UserToken.remove(fetched)
+            return fetched
+
+        with mock.patch.object(UserToken, "get", side_effect=get_and_revoke):
+            self.assertEqual(UserToken.get_cached(token.id), token)
+        with self.assertRaises(errors.UserInvalidToken):
+            UserToken.get_cached(token.id)
+
+
+    def test_user_token_get_many(self):
+        from memdb.token import UserToken
+        user = User.new_user("email@email.ru", "123qwe", "admin", "test user")
+        db.session.flush()
+        token1 = UserToken.create(user)
+        token2 = UserToken.create(user)
+        self.assertEqual(UserToken.get_many([token1.id, "unknown", token2.id]), [token1, None, token2])
+        self.assertEqual(sorted(UserToken.find_by(user.user_id)), sorted([token1, token2]))
+
+
 class TestUserApi(TestCaseApi):
     new_user = {"email": "admin@yandex.ru", "password": "SuperHardPassword01234Я",
                 "role": "admin", "name": "Superman Adminman"}
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import time
+from tests.base import BaseTestCaseDB
+
+from memdb.work_queue import WorkQueue
+
+
+class WorkQueueTest(BaseTestCaseDB):
+    def test_pull(self):
+        queue = WorkQueue("test", "worker1")
+        self.assertEqual(queue.push([("a", 3), ("b", 1), ("c", 2)]), 3)
+        self.assertEqual(queue.push([("a", 0)]), 0)
+        self.assertEqual(queue.pull(2, 10), ["a", "b"])
+        self.assertEqual(queue.size(), (1, 2))
+
+        # leased items aren't queued again
+        self.assertEqual(queue.push([("a", 0)]), 0)
+        self.assertEqual(WorkQueue("test", "worker2").pull(10, 10), ["c"])
+        self.assertEqual(queue.pull(10, 10), [])
+
+        self.assertEqual(WorkQueue("test", "worker2").ack("a"), 0)
+        self.assertEqual(queue.ack("a", "b"), 2)
+        self.assertEqual(queue.size(), (0, 1))
+
+    def test_redelivery(self):
+        queue = WorkQueue("test", "worker1")
+        queue.push([("a", 1), ("b", 2)])
+        self.assertEqual(queue.pull(1, 0.3), ["a"])
+        self.assertEqual(queue.pull(1, 10), ["b"])
+        self.assertEqual(queue.extend(["b"], 0.3), 1)
+        time.sleep(0.5)
+
+        other = WorkQueue("test", "worker2")
+        self.assertEqual(sorted(other.pull(10, 10)), ["a", "b"])
+        self.assertEqual(queue.ack("a", "b"), 0)
+        self.assertEqual(other.ack("a", "b"), 2)
+        self.assertEqual(queue.size(), (0, 0))
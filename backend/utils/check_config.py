@@ -26,9 +26,9 @@ def check_default_tariff():
 
 
 def check_redis_write():
-    from memdb import create_redis_client
+    from memdb import redis_client
     redis_health = {}
-    redis = create_redis_client()
+    redis = redis_client()
     try:
         redis_health['redis_write'] = redis.set('health_check', utcnow().isoformat())
     except Exception as e:
@@ -37,8 +37,8 @@ def check_redis_write():
 
 
 def check_redis_read():
-    from memdb import create_redis_client
-    redis = create_redis_client()
+    from memdb import redis_client
+    redis = redis_client()
     try:
         redis.get('health_check')
     except Exception as e:
@@ -2,10 +2,30 @@
 Management of BOSS infrastructure
 
 Usage: bossmngr checkconfig
+       bossmngr rerate <tariff_id> <start> <finish> [--customer=<customer_id>...] [--dry-run] [--chunk-size=<rows>]
+       bossmngr rebuild_rollups [--start=<date>] [--finish=<date>]
+       bossmngr rebuild_token_indexes
+       bossmngr fitter_benchmark [--tenants=<n>] [--vms=<n>] [--hours=<n>] [--start=<date>] [--seed=<seed>]
+                                 [--replay=<file>] [--workers=<n>] [--output=<file>] [--baseline=<file>]
+                                 [--tolerance=<ratio>]
 
 Options:
     --prefix=<prefix> Prefix to delete
     --field=<field> Field to search in
+    --customer=<customer_id> Rerate only usage of this customer
+    --dry-run Only show changes of balances
+    --chunk-size=<rows> Max number of usage ids updated by one statement
+    --start=<date> Rebuild rollups of months since this date
+    --finish=<date> Rebuild rollups of months before this date
+    --tenants=<n> Number of tenants of synthetic fleet, 100 by default
+    --vms=<n> Number of vms of every tenant of synthetic fleet, 20 by default
+    --hours=<n> Number of collected hours, 24 by default
+    --seed=<seed> Seed of synthetic fleet
+    --replay=<file> Replay samples dumped by "metrics --dump" instead of synthetic fleet
+    --workers=<n> Number of tenants collected in parallel, fitter.workers by default
+    --output=<file> Save result as json
+    --baseline=<file> Fail if throughput is lower than in this saved result
+    --tolerance=<ratio> Allowed throughput decrease compared to baseline, 0.1 by default
 
 """
 import sys
@@ -13,6 +33,88 @@ SUCCESS = 0
 FAILED = 1
 
 
+def rerate(tariff_id, start, finish, customer_ids, dry_run, chunk_size):
+    import arrow
+    from model import Tariff, Customer
+    from utils import setup_backend_logbook
+
+    with setup_backend_logbook("stderr"):
+        tariff = Tariff.get_by_id(tariff_id)
+        if not tariff:
+            print("Tariff %s not found" % tariff_id)
+            return FAILED
+        customers = None
+        if customer_ids:
+            customers = Customer.query.filter(Customer.customer_id.in_(customer_ids)).all()
+        start = arrow.get(start).datetime.replace(tzinfo=None)
+        finish = arrow.get(finish).datetime.replace(tzinfo=None)
+        rerating = tariff.rerate_usage(start, finish, customers, dry_run=dry_run, chunk_size=chunk_size)
+
+    for item in rerating:
+        print("{customer_id}\t{tenant_id}\t{currency}\t{delta}".format(**item))
+    return SUCCESS
+
+
+def rebuild_rollups(start, finish):
+    import arrow
+    from model import ServiceUsage
+    from utils import setup_backend_logbook
+
+    with setup_backend_logbook("stderr"):
+        start = arrow.get(start).datetime.replace(tzinfo=None) if start else None
+        finish = arrow.get(finish).datetime.replace(tzinfo=None) if finish else None
+        months = ServiceUsage.rebuild_rollups(start, finish)
+    print("Rebuilt rollups of %s months" % months)
+    return SUCCESS
+
+
+def rebuild_token_indexes():
+    from memdb.token import UserToken, CustomerToken
+    from utils import setup_backend_logbook
+
+    with setup_backend_logbook("stderr"):
+        for token_class in (UserToken, CustomerToken):
+            count = token_class.rebuild_index()
+            print("%s tokens are added to indexes of %s" % (count, token_class.__name__))
+    return SUCCESS
+
+
+def fitter_benchmark(tenants, vms, hours, start, seed, replay, workers, output, baseline, tolerance):
+    import arrow
+    import json
+    from datetime import datetime, timedelta
+    from fitter.benchmark import FitterBenchmark, compare, load_baseline, print_result
+    from fitter.ceilometer_standin import CeilometerStandIn, RecordedSamples, SyntheticFleet
+    from utils import setup_backend_logbook
+
+    with setup_backend_logbook("stderr"):
+        source = RecordedSamples(replay) if replay else None
+        if start:
+            start = arrow.get(start).datetime.replace(tzinfo=None)
+        elif source:
+            start = source.start
+        else:
+            start = datetime.utcnow() - timedelta(hours=hours + 1)
+        start = start.replace(minute=0, second=0, microsecond=0)
+        if not source:
+            source = SyntheticFleet(tenants, vms, start, hours, seed=seed)
+        benchmark = FitterBenchmark(CeilometerStandIn(source), source.tenant_ids, start, hours, workers)
+        benchmark.prepare()
+        result = benchmark.run()
+
+    print_result(result)
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    if baseline:
+        regressions = compare(result, load_baseline(baseline), tolerance)
+        for regression in regressions:
+            print("Regression of %s" % regression)
+        if regressions:
+            return FAILED
+    return SUCCESS
+
+
 def main():
     import docopt
     from utils.check_config import print_check_config
@@ -21,6 +123,19 @@ def main():
     if opt['checkconfig']:
         status = print_check_config()
         return SUCCESS if status else FAILED
+    if opt['rerate']:
+        chunk_size = int(opt['--chunk-size']) if opt['--chunk-size'] else None
+        return rerate(int(opt['<tariff_id>']), opt['<start>'], opt['<finish>'],
+                      [int(customer_id) for customer_id in opt['--customer']], opt['--dry-run'], chunk_size)
+    if opt['rebuild_rollups']:
+        return rebuild_rollups(opt['--start'], opt['--finish'])
+    if opt['rebuild_token_indexes']:
+        return rebuild_token_indexes()
+    if opt['fitter_benchmark']:
+        return fitter_benchmark(int(opt['--tenants'] or 100), int(opt['--vms'] or 20), int(opt['--hours'] or 24),
+                                opt['--start'], opt['--seed'] or 0, opt['--replay'],
+                                int(opt['--workers']) if opt['--workers'] else None,
+                                opt['--output'], opt['--baseline'], float(opt['--tolerance'] or 0.1))
 
 
 if __name__ == '__main__':
@@ -19,9 +19,11 @@ class PeriodicTask:
     def run(self):
         logbook.info("Periodic task '{}' with period {} is run", self.task_name, self.interval)
         while not self._stop.is_set():
-            self.task()
-            yield from asyncio.sleep(self.interval)
+            delay = self.task()
+            yield from asyncio.sleep(self.interval if delay is None else delay)
         logbook.info("Periodic task '{}' is stopped", self.task_name, self.interval)
 
     def task(self):
+        """ Runs the task. It can return delay till the next run, otherwise the task is run every interval.
+        """
         raise NotImplemented()